@@ -0,0 +1,110 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`benchmarks.rebuild`
+=========================
+
+Measures a rebuild after every source file was touched (eg. by a branch
+switch or a CI cache that was restored with new timestamps) with the
+native executor, once comparing modification times only and once with
+content digests (``--content-hash``). Also measures the no-op build
+after that, where all digests are served from the cache.
+
+.. code:: sh
+
+  python -m benchmarks.rebuild --targets 1000
+"""
+
+from craftr.core import build
+from craftr.core.digest import DigestDatabase
+from craftr.core.executor import DepLog, Executor
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+class QuietExecutor(Executor):
+
+  def report(self, result, finished, total):
+    self.executed += 1
+
+  def build(self, targets=None):
+    self.executed = 0
+    tstart = time.perf_counter()
+    if not super().build(targets):
+      raise RuntimeError('build failed')
+    return time.perf_counter() - tstart
+
+
+def create_project(directory, count):
+  """
+  Create *count* source files and a graph with one target per file that
+  copies it into the build directory.
+  """
+
+  os.makedirs(os.path.join(directory, 'src'))
+  if shutil.which('cp'):
+    command = ['cp', '$in', '$out']
+  else:
+    command = [sys.executable, '-c', 'import shutil, sys; shutil.copy(*sys.argv[1:])', '$in', '$out']
+  graph = build.Graph()
+  for index in range(count):
+    source = os.path.join(directory, 'src', 'file{}.c'.format(index))
+    with open(source, 'w') as fp:
+      fp.write('int value{} = {};\n'.format(index, index) * 100)
+    output = os.path.join(directory, 'build', 'file{}.o'.format(index))
+    graph.add_target(build.Target('t{}'.format(index), [command], [source], [output]))
+  return graph
+
+
+def touch_sources(directory):
+  now = time.time()
+  for name in os.listdir(os.path.join(directory, 'src')):
+    os.utime(os.path.join(directory, 'src', name), (now, now))
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='python -m benchmarks.rebuild')
+  parser.add_argument('--targets', type=int, default=1000)
+  parser.add_argument('--jobs', type=int, default=4)
+  args = parser.parse_args()
+
+  root = tempfile.mkdtemp(prefix='craftr-bench-')
+  try:
+    for mode in ('mtime', 'digest'):
+      directory = os.path.join(root, mode)
+      graph = create_project(directory, args.targets)
+      digests = DigestDatabase(os.path.join(directory, '.digests')) if mode == 'digest' else None
+      executor = QuietExecutor(graph, build.get_platform_helper(), jobs=args.jobs,
+          deplog=DepLog(os.path.join(directory, '.deplog')), digests=digests)
+      results = []
+      for step in ('initial', 'touch-all', 'no-op'):
+        if step == 'touch-all':
+          time.sleep(0.01)
+          touch_sources(directory)
+        elapsed = executor.build()
+        results.append('{} {:.2f}s ({} actions)'.format(step, elapsed, executor.executed))
+      print('{:6}: {}'.format(mode, ', '.join(results)))
+  finally:
+    shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,108 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`benchmarks.unique`
+========================
+
+Measures the de-duplication of a link command with many libraries (10k
+by default), as the linker of ``lang.cxx`` does for the libraries of all
+frameworks. :func:`craftr.utils.pyutils.unique_list`,
+:func:`~craftr.utils.pyutils.unique_extend` and
+:func:`~craftr.utils.pyutils.strip_flags` are compared against the
+linear-scan implementations that they replaced.
+
+.. code:: sh
+
+  python -m benchmarks.unique --libs 10000
+"""
+
+from craftr.utils import pyutils
+
+import argparse
+import random
+import time
+
+
+def scan_unique_list(iterable):
+  result = []
+  for item in iterable:
+    pyutils.unique_append(result, item)
+  return result
+
+
+def scan_unique_extend(lst, iterable):
+  for item in iterable:
+    pyutils.unique_append(lst, item)
+
+
+def scan_strip_flags(command, flags):
+  for flag in set(flags):
+    while True:
+      try:
+        command.remove(flag)
+      except ValueError:
+        break
+  return command
+
+
+def generate_libs(count, seed=0):
+  """
+  Returns a list of *count* library names in which every library is
+  listed a few times, like the transitive libraries of many frameworks.
+  """
+
+  rand = random.Random(seed)
+  names = ['-lname{}'.format(i) for i in range(count)]
+  result = names + [rand.choice(names) for __ in range(count * 2)]
+  rand.shuffle(result)
+  return result
+
+
+def measure(func, *args):
+  tstart = time.perf_counter()
+  result = func(*args)
+  return time.perf_counter() - tstart, result
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='python -m benchmarks.unique')
+  parser.add_argument('--libs', type=int, default=10000)
+  args = parser.parse_args()
+
+  libs = generate_libs(args.libs)
+  print('{} arguments, {} unique'.format(len(libs), args.libs))
+
+  old, old_result = measure(scan_unique_list, libs)
+  new, new_result = measure(pyutils.unique_list, libs)
+  assert old_result == new_result
+  print('unique_list:   linear scan {:.3f}s, hash set {:.3f}s'.format(old, new))
+
+  half = len(libs) // 2
+  old_list, new_list = scan_unique_list(libs[:half]), pyutils.unique_list(libs[:half])
+  old, __ = measure(scan_unique_extend, old_list, libs[half:])
+  new, __ = measure(pyutils.unique_extend, new_list, libs[half:])
+  assert old_list == new_list
+  print('unique_extend: linear scan {:.3f}s, hash set {:.3f}s'.format(old, new))
+
+  flags = libs[::10]
+  old, old_result = measure(scan_strip_flags, list(libs), flags)
+  new, new_result = measure(pyutils.strip_flags, list(libs), flags)
+  assert old_result == new_result
+  print('strip_flags:   per flag {:.3f}s, one pass {:.3f}s'.format(old, new))
+
+
+if __name__ == '__main__':
+  main()
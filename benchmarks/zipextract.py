@@ -0,0 +1,117 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`benchmarks.zipextract`
+============================
+
+Measures :func:`craftr.utils.zipextract.extract` with a generated archive
+of many small members (50k by default):
+
+- the first extraction into an empty directory,
+- extracting again into the up-to-date directory, where every file is
+  skipped,
+- filtering the member names with the ``unpack_exclude`` patterns
+  compiled into one regex, against the per-pattern :func:`fnmatch.fnmatch`
+  loop that was used before.
+
+.. code:: sh
+
+  python -m benchmarks.zipextract --members 50000 --jobs 4
+"""
+
+from craftr.utils import zipextract
+
+import argparse
+import fnmatch
+import os
+import random
+import shutil
+import tempfile
+import time
+import zipfile
+
+#: The exclude patterns of the filter benchmark.
+PATTERNS = ['*/test/*', '*/doc/*', '*.md', '*/examples/*', '*.png']
+
+
+def generate_archive(filename, members, seed=0):
+  """
+  Write a zip archive with *members* files of up to 1 KiB in a single
+  top-level directory, spread over nested directories like a source tree.
+  """
+
+  rand = random.Random(seed)
+  dirs = ['src', 'include', 'test', 'doc', 'examples']
+  words = [b'int', b'return', b'void', b'struct', b'const', b'static']
+  with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as zf:
+    for index in range(members):
+      name = 'project-1.0/{}/d{}/file{}.{}'.format(rand.choice(dirs),
+          index % 100, index, rand.choice(['c', 'h', 'md', 'png']))
+      data = b' '.join(rand.choice(words) for __ in range(rand.randrange(200)))
+      zf.writestr(name, data)
+
+
+def fnmatch_filter(names, patterns):
+  return [n for n in names if not any(fnmatch.fnmatch(n, p) for p in patterns)]
+
+
+def regex_filter(names, patterns):
+  regex = zipextract.compile_patterns(patterns)
+  return [n for n in names if not regex.match(n)]
+
+
+def measure(func, *args, **kwargs):
+  tstart = time.perf_counter()
+  result = func(*args, **kwargs)
+  return time.perf_counter() - tstart, result
+
+
+def main():
+  parser = argparse.ArgumentParser(prog='python -m benchmarks.zipextract')
+  parser.add_argument('--members', type=int, default=50000)
+  parser.add_argument('--jobs', type=int, help='defaults to the number of CPUs')
+  args = parser.parse_args()
+
+  directory = tempfile.mkdtemp(prefix='craftr-bench-')
+  try:
+    archive = os.path.join(directory, 'archive.zip')
+    elapsed, __ = measure(generate_archive, archive, args.members)
+    print('generated {} members ({:.1f} MB) in {:.2f}s'.format(args.members,
+        os.path.getsize(archive) / 1e6, elapsed))
+
+    with zipfile.ZipFile(archive) as zf:
+      names = zf.namelist()
+    fn_time, fn_result = measure(fnmatch_filter, names, PATTERNS)
+    re_time, re_result = measure(regex_filter, names, PATTERNS)
+    assert fn_result == re_result
+    print('filter with {} patterns: fnmatch {:.3f}s, regex {:.3f}s'.format(
+        len(PATTERNS), fn_time, re_time))
+
+    output = os.path.join(directory, 'out')
+    elapsed, (extracted, skipped) = measure(zipextract.extract, archive, output,
+        unpack_single_dir=True, jobs=args.jobs)
+    print('first extraction: {:.2f}s ({} extracted, {} skipped)'.format(
+        elapsed, extracted, skipped))
+    elapsed, (extracted, skipped) = measure(zipextract.extract, archive, output,
+        unpack_single_dir=True, jobs=args.jobs)
+    print('up-to-date extraction: {:.2f}s ({} extracted, {} skipped)'.format(
+        elapsed, extracted, skipped))
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main()
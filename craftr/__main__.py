@@ -14,17 +14,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from craftr import core
+from craftr import client, core
 from craftr.core.config import read_config_file, InvalidConfigError
 from craftr.core.logging import logger
 from craftr.core.session import session, Session, Module, MANIFEST_FILENAME
-from craftr.utils import path, shell
+from craftr.utils import path, shell, sysinfo
 from nr.types.version import Version, VersionCriteria
 
 import abc
 import argparse
 import atexit
 import configparser
+import craftr.core.cache
+import craftr.core.daemon
+import craftr.core.digest
+import craftr.core.executor
+import craftr.core.jobserver
+import craftr.core.jobtokens
+import craftr.core.jobwrapper
+import craftr.core.persistent
+import craftr.core.remote
+import craftr.core.vendor
+import craftr.core.watch
 import craftr.defaults
 import craftr.targetbuilder
 import functools
@@ -32,6 +43,7 @@ import json
 import os
 import sys
 import textwrap
+import traceback
 
 CONFIG_FILENAME = '.craftrconfig'
 
@@ -47,6 +59,15 @@ def parse_cmdline_options(options):
       session.options[key] = value
 
 
+def get_bool_option(key, default=False):
+  """
+  Returns the value of the option *key* in :attr:`Session.options` converted
+  to a boolean. Raises a :class:`ValueError` if the value is invalid.
+  """
+
+  return core.manifest.BoolOption(key, default)(session.options.get(key, ''))
+
+
 def read_cache(cachefile):
   try:
     with open(cachefile) as fp:
@@ -110,6 +131,16 @@ def get_volatile_module_version(name):
   return name, version
 
 
+def module_name_version(ident):
+  """
+  Splits a module identifier as returned by :attr:`Module.ident` into the
+  module name and :class:`Version`.
+  """
+
+  name, version = ident.rpartition('-')[::2]
+  return name, Version(version)
+
+
 @functools.lru_cache()
 def get_ninja_version(ninja_bin):
   ''' Read the ninja version from the `ninja` program and return it. '''
@@ -144,45 +175,52 @@ class BaseCommand(object, metaclass=abc.ABCMeta):
 
 class ExportOrBuildCommand(BaseCommand):
 
+  #: The :class:`core.daemon.Daemon` that executes the command, if any.
+  daemon = None
+
   def __init__(self, is_export):
     self.is_export = is_export
 
   def build_parser(self, parser):
     if self.is_export:
       parser.add_argument('-m', '--module')
+      parser.add_argument('--vendor', metavar='BUNDLE',
+          help='take the sources of the loaders from a bundle that was '
+            'created with "craftr vendor"')
     else:
       parser.add_argument('targets', metavar='TARGET', nargs='*')
+      parser.add_argument('-j', '--jobs', type=int)
+      parser.add_argument('--executor', choices=['ninja', 'native'])
+      parser.add_argument('--content-hash', action='store_true')
     parser.add_argument('-b', '--build-dir', default='build')
     parser.add_argument('-i', '--include-path', action='append', default=[])
 
   def execute(self, parser, args):
-    session.path.extend(map(path.norm, args.include_path))
+    self.extend_path(args.include_path)
 
     if self.is_export:
-      # Determine the module to execute, either from the current working
-      # directory or find it by name if one is specified.
-      if not args.module:
-        for fn in [MANIFEST_FILENAME, path.join('craftr', MANIFEST_FILENAME)]:
-          if path.isfile(fn):
-            module = session.parse_manifest(fn)
-            break
-        else:
-          parser.error('"{}" does not exist'.format(MANIFEST_FILENAME))
-      else:
-        # TODO: For some reason, prints to stdout are not visible here.
-        # TODO: Prints to stderr however work fine.
-        try:
-          module_name, version = parse_module_spec(args.module)
-        except ValueError as exc:
-          parser.error('{} (note: you have to escape > and < characters)'.format(exc))
-        try:
-          module = session.find_module(module_name, version)
-        except Module.NotFound as exc:
-          parser.error('module not found: ' + str(exc))
+      module = self.find_main_module(parser, args.module)
     else:
       module = None
 
-    ninja_bin, ninja_version = get_ninja_info()
+    if self.is_export:
+      # Also reset by the daemon for commands without a bundle.
+      session.vendor_bundle = None
+      if args.vendor:
+        try:
+          session.vendor_bundle = core.vendor.VendorBundle(path.abs(args.vendor))
+        except (core.vendor.VendorError, OSError) as exc:
+          logger.error('craftr:', exc)
+          return 1
+
+    if self.is_export:
+      executor = 'ninja'
+    else:
+      executor = args.executor or session.options.get('craftr.executor', 'ninja')
+      if executor not in ('ninja', 'native'):
+        parser.error('invalid craftr.executor: {!r}'.format(executor))
+    if executor == 'ninja':
+      ninja_bin, ninja_version = get_ninja_info()
 
     # Create and switch to the build directory.
     session.builddir = path.abs(args.build_dir)
@@ -200,7 +238,7 @@ class ExportOrBuildCommand(BaseCommand):
       session.cache['build'] = {}
       try:
         write_cache(cachefile)
-        module.run()
+        module = self.run_main_module(module)
       except (Module.InvalidOption, Module.LoaderInitializationError) as exc:
         for error in exc.format_errors():
           logger.error(error)
@@ -213,15 +251,9 @@ class ExportOrBuildCommand(BaseCommand):
       session.cache['build']['targets'] = list(session.graph.targets.keys())
       session.cache['build']['main'] = module.ident
       session.cache['build']['options'] = args.options
+      self.write_ninja_manifest(ninja_version)
       write_cache(cachefile)
 
-      # Write the Ninja manifest.
-      with open("build.ninja", 'w') as fp:
-        platform = core.build.get_platform_helper()
-        context = core.build.ExportContext(ninja_version)
-        writer = core.build.NinjaWriter(fp)
-        session.graph.export(writer, context, platform)
-
     else:
       parse_cmdline_options(session.cache['build']['options'])
       main = session.cache['build']['main']
@@ -243,12 +275,483 @@ class ExportOrBuildCommand(BaseCommand):
           parser.error('no such target: {}'.format(target))
         targets.append(target)
 
+      if executor == 'native':
+        return self.build_native(module_name_version(main), targets, args)
+
       # Execute the ninja build.
       cmd = [ninja_bin]
       if args.verbose:
         cmd += ['-v']
+      try:
+        tokens = self.get_job_tokens()
+      except (ValueError, RuntimeError, OSError) as exc:
+        logger.error('craftr:', exc)
+        return 1
+      if tokens is not None and not session.cache['build'].get('wrap_commands'):
+        logger.warn('craftr: build.ninja was exported without craftr.jobtokens, '
+            'the build does not take host-wide job tokens')
+        tokens = None
+
+      # Ninja does not respect the CPU quota of containers.
+      jobs = args.jobs or sysinfo.default_jobs()
+      cmd += ['-j', str(jobs)]
       cmd += targets
-      shell.run(cmd)
+
+      # If the manifest was exported with recursive targets, every command
+      # takes a token from the jobserver (see core.jobwrapper), thus this
+      # process keeps none for itself.
+      jobserver = None
+      if session.cache['build'].get('recursive'):
+        try:
+          jobserver = self.get_jobserver(jobs, implicit=False)
+        except ValueError as exc:
+          logger.error('craftr:', exc)
+          return 1
+      try:
+        if jobserver is not None or tokens is not None:
+          shell.run(cmd, env=core.jobwrapper.get_environ(jobserver, tokens),
+              pass_fds=jobserver.fds if jobserver is not None else ())
+        else:
+          shell.run(cmd)
+      finally:
+        if jobserver is not None:
+          jobserver.close()
+
+  def find_main_module(self, parser, module_spec):
+    """
+    Determine the module to execute, either from the current working
+    directory or find it by name if *module_spec* is specified.
+    """
+
+    if not module_spec:
+      for fn in [MANIFEST_FILENAME, path.join('craftr', MANIFEST_FILENAME)]:
+        if path.isfile(fn):
+          return session.parse_manifest(fn)
+      parser.error('"{}" does not exist'.format(MANIFEST_FILENAME))
+
+    # TODO: For some reason, prints to stdout are not visible here.
+    # TODO: Prints to stderr however work fine.
+    try:
+      module_name, version = parse_module_spec(module_spec)
+    except ValueError as exc:
+      parser.error('{} (note: you have to escape > and < characters)'.format(exc))
+    try:
+      return session.find_module(module_name, version)
+    except Module.NotFound as exc:
+      parser.error('module not found: ' + str(exc))
+
+  def extend_path(self, include_path):
+    """
+    Add the directories of the *include_path* to the search path of the
+    session. Directories that are already in the search path (eg. from a
+    previous command executed by the daemon) are not added again.
+    """
+
+    for directory in map(path.norm, include_path):
+      if directory not in session.path:
+        session.path.append(directory)
+    if self.daemon is not None:
+      # Pick up manifests that were added since the previous command.
+      session.update_manifest_cache(force=True)
+
+  def run_main_module(self, module):
+    """
+    Execute the main *module*. If the command is executed by a daemon, only
+    the modules that changed since the previous command are executed.
+
+    :return: The main module, which is a different object if the daemon
+      parsed its manifest again.
+    """
+
+    if self.daemon is not None:
+      return self.daemon.run_module(module)
+    module.run()
+    return module
+
+  def write_ninja_manifest(self, ninja_version):
+    """
+    Write the build graph of the session to ``build.ninja``.
+    """
+
+    # Ninja runs the commands of recursive targets with the jobserver, and
+    # all other commands must take tokens from it too to stay within -j.
+    # Host-wide job tokens are taken by every command as well.
+    recursive = os.name != 'nt' and get_bool_option('craftr.jobserver', True) and \
+        any(t.recursive for t in session.graph.targets.values())
+    wrap_commands = recursive or (os.name != 'nt' and get_bool_option('craftr.jobtokens'))
+    session.cache['build']['recursive'] = recursive
+    session.cache['build']['wrap_commands'] = wrap_commands
+    with open("build.ninja", 'w') as fp:
+      platform = core.build.get_platform_helper()
+      context = core.build.ExportContext(ninja_version, wrap_commands)
+      writer = core.build.NinjaWriter(fp)
+      session.graph.export(writer, context, platform)
+
+  def build_native(self, main, targets, args):
+    """
+    Re-executes the main module to construct the build graph in memory and
+    builds the *targets* with the :class:`core.executor.Executor` instead
+    of invoking Ninja.
+    """
+
+    module = session.find_module(*main)
+    try:
+      self.run_main_module(module)
+    except (Module.InvalidOption, Module.LoaderInitializationError) as exc:
+      for error in exc.format_errors():
+        logger.error(error)
+      return 1
+    except craftr.defaults.ModuleError as exc:
+      logger.error(exc)
+      return 1
+
+    executor = self.create_executor(args)
+    if executor is None:
+      return 1
+    try:
+      if not executor.build(targets):
+        return 1
+    except core.executor.BuildError as exc:
+      logger.error('craftr:', exc)
+      return 1
+    finally:
+      self.close_executor(executor)
+
+  def create_executor(self, args):
+    """
+    Create the :class:`core.executor.Executor` for the graph of the session
+    from the command-line *args* and the ``craftr.*`` options. Returns
+    :const:`None` if an option is invalid.
+    """
+
+    digests = core.digest.DigestDatabase(path.abs(core.digest.DIGESTS_FILENAME))
+    try:
+      content_hash = get_bool_option('craftr.content_hash')
+      persistent_workers = get_bool_option('craftr.persistent_workers', True)
+      cache = self.get_action_cache(digests)
+      tokens = self.get_job_tokens()
+      jobserver = self.get_jobserver(args.jobs or sysinfo.default_jobs())
+    except (ValueError, RuntimeError, OSError) as exc:
+      logger.error('craftr:', exc)
+      return None
+
+    remote = None
+    workers = session.options.get('craftr.remote.workers')
+    if workers:
+      try:
+        addresses = [core.remote.parse_address(x.strip()) for x in workers.split(',') if x.strip()]
+      except ValueError as exc:
+        logger.error('craftr: invalid craftr.remote.workers:', exc)
+        return None
+      remote = core.remote.RemoteExecutor(addresses,
+          roots=[session.maindir, session.builddir], digests=digests)
+
+    platform = core.build.get_platform_helper()
+    workers = core.persistent.WorkerPool() if persistent_workers else None
+    return core.executor.Executor(session.graph, platform,
+        jobs=args.jobs, verbose=args.verbose, cache=cache, remote=remote,
+        workers=workers, tokens=tokens, jobserver=jobserver,
+        digests=digests if (args.content_hash or content_hash) else None)
+
+  def close_executor(self, executor):
+    """
+    Release the resources of an executor created with :meth:`create_executor`.
+    """
+
+    if executor.workers is not None:
+      executor.workers.close()
+    if executor.remote is not None:
+      executor.remote.close()
+    if executor.jobserver is not None:
+      executor.jobserver.close()
+
+  def get_jobserver(self, jobs, implicit=True):
+    """
+    Join the GNU make jobserver of the parent process or create a new
+    jobserver with *jobs* tokens. Returns :const:`None` if the
+    ``craftr.jobserver`` option is disabled or the platform does not
+    support the jobserver.
+
+    :param implicit: Whether this process keeps its implicit token. If not,
+      it is put into the pipe of a new jobserver or lent to a joined one
+      (see :meth:`core.jobserver.Jobserver.lend_implicit`).
+    """
+
+    if os.name == 'nt' or not get_bool_option('craftr.jobserver', True):
+      return None
+    jobserver = core.jobserver.Jobserver.from_environ()
+    if jobserver is None:
+      jobserver = core.jobserver.Jobserver(jobs, implicit=implicit)
+    elif not implicit:
+      jobserver.lend_implicit()
+    return jobserver
+
+  def get_job_tokens(self):
+    """
+    Create the :class:`core.jobtokens.TokenPool` that is shared by all
+    builds on the machine if the ``craftr.jobtokens`` option is enabled,
+    otherwise return :const:`None`. The number of tokens defaults to the
+    number of CPUs.
+    """
+
+    if not get_bool_option('craftr.jobtokens'):
+      return None
+    directory = session.options.get('craftr.jobtokens.dir')
+    slots = session.options.get('craftr.jobtokens.slots')
+    try:
+      slots = int(slots) if slots else sysinfo.cpu_count()
+    except ValueError:
+      raise ValueError('invalid craftr.jobtokens.slots: {!r}'.format(slots))
+    if directory:
+      return core.jobtokens.TokenPool(path.abs(directory), slots)
+    try:
+      return core.jobtokens.TokenPool(core.jobtokens.DEFAULT_DIRECTORY, slots)
+    except PermissionError as exc:
+      # Another user may have created the shared directory to redirect
+      # the slot files, only share the tokens with our own builds then.
+      logger.warn('craftr: can not use the shared job token directory:', exc)
+      return core.jobtokens.TokenPool(core.jobtokens.get_user_directory(), slots, shared=False)
+
+  def get_action_cache(self, digests):
+    """
+    Create the :class:`core.cache.ActionCache` from the ``craftr.cache.*``
+    options, or return :const:`None` if the cache is not enabled.
+    """
+
+    remote_url = session.options.get('craftr.cache.remote')
+    if not get_bool_option('craftr.cache') and not remote_url:
+      return None
+    directory = session.options.get('craftr.cache.dir') or path.user_cache_dir('actions')
+    max_size = core.cache.parse_size(session.options.get('craftr.cache.max_size', '5G'))
+    remote = core.cache.RemoteCache(remote_url) if remote_url else None
+    return core.cache.ActionCache(path.abs(directory), max_size=max_size,
+        compress=get_bool_option('craftr.cache.compress'),
+        hardlink=get_bool_option('craftr.cache.hardlink'), digests=digests,
+        remote=remote, upload=get_bool_option('craftr.cache.upload', True),
+        base_dir=session.maindir)
+
+
+class WatchCommand(ExportOrBuildCommand):
+  """
+  Exports and builds the project, then keeps the build graph in memory and
+  rebuilds the affected targets with the native executor whenever a source
+  file changes. Modules whose Craftrfile or manifest changed are executed
+  again, together with the modules that depend on them, and the Ninja
+  manifest is updated.
+  """
+
+  def __init__(self):
+    super().__init__(is_export=False)
+
+  def build_parser(self, parser):
+    parser.add_argument('targets', metavar='TARGET', nargs='*')
+    parser.add_argument('-m', '--module')
+    parser.add_argument('-j', '--jobs', type=int)
+    parser.add_argument('--content-hash', action='store_true')
+    parser.add_argument('--poll', action='store_true',
+        help='poll for changes instead of using inotify')
+    parser.add_argument('-b', '--build-dir', default='build')
+    parser.add_argument('-i', '--include-path', action='append', default=[])
+
+  def execute(self, parser, args):
+    self.extend_path(args.include_path)
+    module = self.find_main_module(parser, args.module)
+    try:
+      ninja_version = get_ninja_info()[1]
+    except (OSError, shell.CalledProcessError) as exc:
+      logger.warn('craftr: can not run Ninja, build.ninja is not updated:', exc)
+      ninja_version = None
+
+    session.builddir = path.abs(args.build_dir)
+    path.makedirs(session.builddir)
+    os.chdir(session.builddir)
+    cachefile = path.join(session.builddir, '.craftrcache')
+    read_cache(cachefile)
+    session.cache['build'] = {}
+
+    targets = []
+    for target in args.targets:
+      if '.' not in target:
+        target = module.ident + '.' + target
+      elif target.startswith('.'):
+        target = module.ident + target
+      targets.append(target)
+
+    live = core.watch.LiveSession(session, module)
+    if not self.run_module(live, module.run, args, ninja_version):
+      return 1
+    executor = self.create_executor(args)
+    if executor is None:
+      return 1
+
+    watcher = core.watch.create_watcher(args.poll)
+    module_files = {}
+    build_targets = targets
+    try:
+      while True:
+        if build_targets is not None:
+          try:
+            executor.build(build_targets)
+          except core.executor.BuildError as exc:
+            logger.error('craftr:', exc)
+
+        module_files.update(live.module_files())
+        files = set(module_files) | live.source_files(executor.deplog)
+        watcher.watch(files)
+        logger.info('craftr: watching {} files for changes'.format(len(files)))
+        changed = watcher.wait()
+
+        modules = []
+        manifests = []
+        for filename in changed:
+          if filename in module_files:
+            changed_module = module_files[filename]
+            modules.append(changed_module)
+            if path.basename(filename) == MANIFEST_FILENAME:
+              manifests.append(changed_module)
+        if modules:
+          reload = lambda: live.reload(modules, manifests)
+          if not self.run_module(live, reload, args, ninja_version):
+            build_targets = None
+            continue
+          executor.reset()
+          build_targets = targets
+        else:
+          build_targets = self.get_affected_targets(live, executor, changed, targets)
+          if not build_targets:
+            logger.info('craftr: no targets affected')
+            build_targets = None
+    except KeyboardInterrupt:
+      return 0
+    finally:
+      watcher.close()
+      self.close_executor(executor)
+
+  def run_module(self, live, func, args, ninja_version):
+    """
+    Calls *func* to (re-)execute modules, then writes the cache and the
+    Ninja manifest. Errors are logged and False is returned.
+    """
+
+    try:
+      func()
+    except (Module.InvalidOption, Module.LoaderInitializationError) as exc:
+      for error in exc.format_errors():
+        logger.error(error)
+      return False
+    except core.manifest.Manifest.Invalid as exc:
+      logger.error('craftr: invalid manifest:', exc)
+      return False
+    except craftr.defaults.ModuleError as exc:
+      logger.error(exc)
+      return False
+    except Exception:
+      logger.error('craftr: error while executing modules')
+      traceback.print_exc()
+      return False
+
+    session.cache['build']['targets'] = list(session.graph.targets.keys())
+    session.cache['build']['main'] = live.module.ident
+    session.cache['build']['options'] = args.options
+    if ninja_version is not None:
+      self.write_ninja_manifest(ninja_version)
+    write_cache(path.join(session.builddir, '.craftrcache'))
+    return True
+
+  def get_affected_targets(self, live, executor, changed, targets):
+    """
+    Returns the names of the targets that read one of the *changed* files
+    and that are required to build the *targets*.
+    """
+
+    affected = live.affected_targets(changed, executor.deplog)
+    try:
+      required = set(a.target.name for a in executor.collect(targets))
+    except core.executor.BuildError as exc:
+      logger.error('craftr:', exc)
+      return []
+    return sorted(affected & required)
+
+
+class VendorCommand(ExportOrBuildCommand):
+  """
+  Runs the loaders of the main module and all of its dependencies and packs
+  the sources that they fetched into a bundle (see :mod:`craftr.core.vendor`).
+  The project can then be exported without network access with
+  ``craftr export --vendor BUNDLE``.
+  """
+
+  def __init__(self):
+    super().__init__(is_export=True)
+
+  def build_parser(self, parser):
+    parser.add_argument('-m', '--module')
+    parser.add_argument('-o', '--output', default='vendor.tar',
+        help='the name of the bundle (default: vendor.tar)')
+    parser.add_argument('-b', '--build-dir', default='build')
+    parser.add_argument('-i', '--include-path', action='append', default=[])
+
+  def execute(self, parser, args):
+    self.extend_path(args.include_path)
+    module = self.find_main_module(parser, args.module)
+    output = path.abs(args.output)
+
+    # The loaders share their directories with the build directory.
+    session.builddir = path.abs(args.build_dir)
+    path.makedirs(session.builddir)
+    os.chdir(session.builddir)
+    cachefile = path.join(session.builddir, '.craftrcache')
+    read_cache(cachefile)
+    session.vendor_bundle = None
+
+    try:
+      module.init_options(recursive=True)
+    except Module.InvalidOption as exc:
+      for error in exc.format_errors():
+        logger.error(error)
+      return 1
+    except Module.NotFound as exc:
+      logger.error('module not found:', exc)
+      return 1
+
+    modules = [module] + module.get_dependencies(recursive=True)
+    try:
+      core.session.init_loaders(modules)
+    except ValueError as exc:
+      logger.error('craftr:', exc)
+      return 1
+
+    sources = []
+    for dep in modules:
+      if not dep.manifest.loaders:
+        continue
+      try:
+        dep.init_loader()
+      except Module.LoaderInitializationError as exc:
+        # Like for the export, dependencies are not necessarily loaded
+        # (eg. lang.cxx.msvc on Linux).
+        if dep is module:
+          for error in exc.format_errors():
+            logger.error(error)
+          return 1
+        logger.warn('{} is not vendored, none of its loaders matched'.format(dep.ident))
+        continue
+      loader = dep.loader
+      if loader.vendor_key:
+        sources.append((loader.vendor_key, dep.ident,
+            path.basename(loader.directory), loader.directory))
+      else:
+        logger.info('{} has nothing to vendor ({} loader)'.format(dep.ident, loader.name))
+    write_cache(cachefile)
+
+    try:
+      index = core.vendor.write_bundle(output, sources)
+    except OSError as exc:
+      logger.error('craftr:', exc)
+      return 1
+    for key, entry in sorted(index['sources'].items()):
+      logger.info('{}: {} files from {}'.format(entry['module'], entry['files'], key))
+    logger.info('Wrote {} sources to "{}"'.format(len(sources), output))
 
 
 class StartpackageCommand(BaseCommand):
@@ -302,6 +805,90 @@ class StartpackageCommand(BaseCommand):
     with open(sfile, 'w') as fp:
       print('# {}'.format(args.name), file=fp)
 
+class WorkerCommand(BaseCommand):
+  """
+  Runs a worker for the distributed execution of hermetic targets.
+  """
+
+  def build_parser(self, parser):
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=core.remote.DEFAULT_PORT)
+    parser.add_argument('-j', '--jobs', type=int)
+    parser.add_argument('--dir')
+
+  def execute(self, parser, args):
+    directory = path.abs(args.dir or path.user_cache_dir('worker'))
+    worker = core.remote.Worker(directory, args.jobs)
+    server = core.remote.WorkerServer((args.host, args.port), worker)
+    logger.info('craftr worker: listening on {}:{} with {} jobs'.format(
+        args.host, server.server_address[1], worker.jobs))
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+
+
+class DaemonCommand(BaseCommand):
+  """
+  Runs a daemon for the project in the current directory that keeps the
+  session warm. The ``craftr`` command forwards ``export`` and ``build``
+  to the daemon while it is running.
+  """
+
+  def build_parser(self, parser):
+    parser.add_argument('--idle-timeout', type=float,
+        default=core.daemon.DEFAULT_IDLE_TIMEOUT,
+        help='exit after this many seconds without a command')
+    parser.add_argument('--background', action='store_true',
+        help='detach from the terminal')
+    parser.add_argument('--stop', action='store_true',
+        help='stop the daemon of the current directory')
+
+  def execute(self, parser, args):
+    if args.stop:
+      try:
+        stopped = core.daemon.stop(os.getcwd())
+      except PermissionError as exc:
+        logger.error('craftr daemon:', exc)
+        return 1
+      if not stopped:
+        logger.error('craftr daemon: not running')
+        return 1
+      return 0
+
+    daemon = core.daemon.Daemon(os.getcwd(), main, args.idle_timeout)
+    try:
+      daemon.bind()
+    except (RuntimeError, OSError) as exc:
+      logger.error('craftr daemon:', exc)
+      return 1
+    logger.info('craftr daemon: listening on "{}"'.format(daemon.socket_path))
+
+    if args.background:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      if os.fork() != 0:
+        os._exit(0)
+      os.setsid()
+      null = os.open(os.devnull, os.O_RDWR)
+      for fd in (0, 1, 2):
+        os.dup2(null, fd)
+      os.close(null)
+
+    # Leave the context of the current session, the daemon enters the
+    # context of its own session for every command.
+    previous, Session.current = Session.current, None
+    try:
+      daemon.serve()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      Session.current = previous
+    return 0
+
+
 class version(BaseCommand):
 
   def build_parser(self, parser):
@@ -310,7 +897,14 @@ class version(BaseCommand):
   def execute(self, parser, args):
     print(craftr.__version__)
 
-def main():
+def main(argv=None, daemon=None):
+  """
+  Execute the ``craftr`` command with the command-line arguments *argv*
+  (defaults to :data:`sys.argv`). If a *daemon* is specified, the command
+  is executed in the warm :class:`Session` of the
+  :class:`core.daemon.Daemon`.
+  """
+
   # Create argument parsers and dynamically include all BaseCommand
   # subclasses into it.
   parser = argparse.ArgumentParser(prog='craftr', description='The Craftr build system')
@@ -324,13 +918,18 @@ def main():
   commands = {
     'export': ExportOrBuildCommand(is_export=True),
     'build': ExportOrBuildCommand(is_export=False),
-    'startpackage': StartpackageCommand()
+    'watch': WatchCommand(),
+    'vendor': VendorCommand(),
+    'startpackage': StartpackageCommand(),
+    'worker': WorkerCommand(),
+    'daemon': DaemonCommand()
   }
   for key, cmd in commands.items():
     cmd.build_parser(subparsers.add_parser(key))
+    cmd.daemon = daemon
 
   # Parse the arguments.
-  args = parser.parse_args()
+  args = parser.parse_args(argv)
   if not args.command:
     parser.print_usage()
     return 0
@@ -339,8 +938,15 @@ def main():
     logger.set_level(logger.DEBUG)
   elif args.quiet:
     logger.set_level(logger.WARNING)
+  else:
+    logger.set_level(logger.INFO)
 
-  session = Session()
+  if daemon is not None:
+    if args.command not in client.FORWARDED_COMMANDS:
+      parser.error('"{}" can not be executed by the daemon'.format(args.command))
+    session = daemon.session
+  else:
+    session = Session()
 
   # Parse the user configuration file.
   try:
@@ -0,0 +1,232 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The entry point of the ``craftr`` command. If a ``craftr daemon`` is
+running for the current directory, ``export`` and ``build`` commands are
+forwarded to it over a Unix socket together with the standard file
+descriptors, the working directory and the environment. Otherwise, or if
+the ``CRAFTR_NO_DAEMON`` environment variable is set, the command is
+executed in this process by :mod:`craftr.__main__`.
+
+This module must only import modules of the standard library that are
+cheap to import, since it is imported on every invocation.
+"""
+
+import array
+import hashlib
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+
+#: The commands that are forwarded to the daemon.
+FORWARDED_COMMANDS = ('export', 'build')
+
+#: Global options of the ``craftr`` command that consume an argument.
+_OPTIONS_WITH_ARGUMENT = ('-c', '--config', '-d', '--option')
+
+
+def get_socket_path(directory):
+  """
+  Returns the path of the Unix socket of the daemon for the project in
+  *directory*. The socket is located in a directory that is only
+  accessible by the current user.
+  """
+
+  base = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+  key = hashlib.sha1(os.path.abspath(directory).encode('utf8')).hexdigest()[:16]
+  return os.path.join(base, 'craftr-{}'.format(os.getuid()), key + '.sock')
+
+
+def check_socket_directory(directory):
+  """
+  Check that the socket *directory* is a real directory that is owned by
+  the current user and only accessible by them. Otherwise, another user
+  could have created it to plant a socket that receives our environment.
+
+  :raise PermissionError: If the directory is not safe to use.
+  :raise OSError: If the directory does not exist.
+  """
+
+  st = os.lstat(directory)
+  if not stat.S_ISDIR(st.st_mode):
+    raise PermissionError('"{}" is not a directory'.format(directory))
+  if st.st_uid != os.getuid():
+    raise PermissionError('"{}" is not owned by the current user'.format(directory))
+  if stat.S_IMODE(st.st_mode) != 0o700:
+    raise PermissionError('"{}" must have mode 0700, has {:04o}'.format(
+        directory, stat.S_IMODE(st.st_mode)))
+
+
+def make_socket_directory(directory):
+  """
+  Create the socket *directory* with mode 0700 if it does not exist and
+  check it with :func:`check_socket_directory`.
+  """
+
+  try:
+    os.mkdir(directory, 0o700)
+  except FileExistsError:
+    pass
+  check_socket_directory(directory)
+
+
+def check_socket(socket_path):
+  """
+  Check that *socket_path* is a socket that is owned by the current user
+  in a directory that passes :func:`check_socket_directory`.
+
+  :raise PermissionError: If the socket is not safe to use.
+  :raise OSError: If the socket or its directory does not exist.
+  """
+
+  check_socket_directory(os.path.dirname(socket_path))
+  st = os.lstat(socket_path)
+  if not stat.S_ISSOCK(st.st_mode):
+    raise PermissionError('"{}" is not a socket'.format(socket_path))
+  if st.st_uid != os.getuid():
+    raise PermissionError('"{}" is not owned by the current user'.format(socket_path))
+
+
+def get_peer_uid(sock):
+  """
+  Returns the user ID of the process on the other end of the connected
+  Unix socket *sock*, or :const:`None` if the platform does not support
+  ``SO_PEERCRED``.
+  """
+
+  if not hasattr(socket, 'SO_PEERCRED'):
+    return None
+  size = struct.calcsize('3i')
+  pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, size))
+  return uid
+
+
+def check_peer(sock):
+  """
+  :raise PermissionError: If the peer of *sock* is not the current user.
+  """
+
+  uid = get_peer_uid(sock)
+  if uid is not None and uid != os.getuid():
+    raise PermissionError('the peer of the socket is user {}'.format(uid))
+
+
+def get_command(argv):
+  """
+  Returns the name of the subcommand in the command-line arguments *argv*
+  or :const:`None`.
+  """
+
+  index = 0
+  while index < len(argv):
+    arg = argv[index]
+    if arg in _OPTIONS_WITH_ARGUMENT:
+      index += 2
+    elif arg.startswith('-'):
+      index += 1
+    else:
+      return arg
+  return None
+
+
+def send_request(sock, request, fds=()):
+  """
+  Send a JSON *request* and optionally file descriptors over the Unix
+  socket *sock*.
+  """
+
+  data = json.dumps(request).encode('utf8') + b'\n'
+  ancdata = []
+  if fds:
+    ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+  sock.sendmsg([data], ancdata)
+
+
+def recv_line(sock):
+  """
+  Receive a JSON object terminated by a newline from *sock*.
+
+  :raise ConnectionError: If the connection was closed before.
+  """
+
+  data = b''
+  while not data.endswith(b'\n'):
+    chunk = sock.recv(4096)
+    if not chunk:
+      raise ConnectionError('connection closed by the daemon')
+    data += chunk
+  return json.loads(data.decode('utf8'))
+
+
+def forward(argv, directory=None):
+  """
+  Forward the command-line *argv* to the daemon for *directory* (defaults
+  to the current working directory).
+
+  :return: The exit code of the command or :const:`None` if the command
+    could not be forwarded.
+  """
+
+  if not hasattr(socket, 'AF_UNIX') or os.environ.get('CRAFTR_NO_DAEMON'):
+    return None
+  if get_command(argv) not in FORWARDED_COMMANDS:
+    return None
+  directory = directory or os.getcwd()
+  socket_path = get_socket_path(directory)
+  if not os.path.exists(socket_path):
+    return None
+  try:
+    check_socket(socket_path)
+  except PermissionError as exc:
+    print('craftr: not using the daemon:', exc, file=sys.stderr)
+    return None
+  except OSError:
+    return None
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    try:
+      sock.connect(socket_path)
+      check_peer(sock)
+    except PermissionError as exc:
+      print('craftr: not using the daemon:', exc, file=sys.stderr)
+      return None
+    except OSError:
+      return None  # The daemon is not running anymore.
+    try:
+      request = {'argv': argv, 'cwd': directory, 'environ': dict(os.environ)}
+      send_request(sock, request, [0, 1, 2])
+    except OSError:
+      return None  # The daemon is not running anymore.
+    try:
+      return int(recv_line(sock)['exit_code'])
+    except (OSError, ValueError, KeyError, TypeError):
+      return 1
+    except KeyboardInterrupt:
+      return 130
+  finally:
+    sock.close()
+
+
+def main_and_exit():
+  exit_code = forward(sys.argv[1:])
+  if exit_code is None:
+    from craftr.__main__ import main_and_exit
+    main_and_exit()
+  sys.exit(exit_code)
@@ -20,6 +20,7 @@
 This module provides all the API to generate a Ninja build manifest.
 """
 
+from craftr.core import jobwrapper
 from craftr.utils import argspec
 from craftr.utils import path
 from craftr.utils import pyutils
@@ -34,6 +35,25 @@ import re
 import stat
 import sys
 
+#: The name of the pool of targets with ``recursive=True`` that don't
+#: specify a pool. Unless it is added explicitly, it has a depth of one.
+RECURSIVE_POOL = 'recursive'
+
+# Validators for the parameters of frequently constructed objects. These
+# are compiled once since there may be many thousand targets in a graph.
+_check_str = argspec.compile({'type': str})
+_check_opt_str = argspec.compile({'type': [None, str]})
+_check_bool = argspec.compile({'type': bool})
+_check_opt_dict = argspec.compile({'type': [None, dict]})
+_check_files = argspec.compile({'type': [list, tuple], 'items': {'type': str}})
+_check_worker = argspec.compile({'type': [None, list, tuple], 'items': {'type': str}})
+_check_frameworks = argspec.compile({'type': [list, tuple], 'items': {'type': dict}})
+_check_tool_command = argspec.compile(
+    {'type': [list, tuple], 'allowEmpty': False, 'items': {'type': str}})
+_check_tool_preamble = argspec.compile(
+    {'type': [None, list, tuple], 'items':
+      {'type': [list, tuple], 'allowEmpty': False, 'items': {'type': str}}})
+
 
 class DuplicateOutputError(Exception):
   """
@@ -78,6 +98,11 @@ class Graph(object):
   .. attributes:: vars
 
     A dictionary of variables that will be exported to the Ninja manifest.
+
+  .. attribute:: pools
+
+    Read-only. A dictionary that maps the names of the pools that have been
+    added with :meth:`add_pool` to their depth.
   """
 
   def __init__(self):
@@ -86,6 +111,7 @@ class Graph(object):
     self.outfiles = {}
     self.vars = {}
     self.tools = {}
+    self.pools = {}
 
   def add_tool(self, tool):
     """
@@ -99,6 +125,24 @@ class Graph(object):
           .format(tool.name))
     self.tools[tool.name] = tool
 
+  def add_pool(self, name, depth):
+    """
+    Add a pool to the Graph. Targets that specify the *name* as their
+    :attr:`Target.pool` are not executed more than *depth* times in
+    parallel. The ``console`` pool is built into Ninja and can not be
+    added.
+
+    :raise ValueError: If the *name* is already used or the *depth* is
+      smaller than one.
+    """
+
+    _check_str('name', name)
+    if name == 'console' or name in self.pools:
+      raise ValueError('a pool with the name {!r} already exists'.format(name))
+    if not isinstance(depth, int) or depth < 1:
+      raise ValueError('invalid pool depth: {!r}'.format(depth))
+    self.pools[name] = depth
+
   def add_target(self, target):
     """
     Add a :class:`Target` to the Graph.
@@ -111,11 +155,13 @@ class Graph(object):
       is already created by another target.
     """
 
-    argspec.validate('target', target, {'type': Target})
+    _check_target('target', target)
     if target.name in self.targets:
       raise ValueError('a target with the name {!r} already exists'
         .format(target.name))
     self.targets[target.name] = target
+    if target.pool == RECURSIVE_POOL and RECURSIVE_POOL not in self.pools:
+      self.pools[RECURSIVE_POOL] = 1
     for infile in target.inputs:
       self.infiles.setdefault(infile, []).append(target)
     for outfile in target.outputs:
@@ -123,6 +169,33 @@ class Graph(object):
       if other is not target:
         raise DuplicateOutputError(outfile, target, other)
 
+  def remove_target(self, name):
+    """
+    Remove the :class:`Target` with the specified *name* from the Graph.
+
+    :raise KeyError: If there is no target with that name.
+    """
+
+    target = self.targets.pop(name)
+    for infile in target.inputs:
+      targets = self.infiles.get(infile)
+      if targets is not None:
+        targets[:] = [x for x in targets if x is not target]
+        if not targets:
+          del self.infiles[infile]
+    for outfile in target.outputs:
+      if self.outfiles.get(outfile) is target:
+        del self.outfiles[outfile]
+
+  def remove_tool(self, name):
+    """
+    Remove the :class:`Tool` with the specified *name* from the Graph.
+
+    :raise KeyError: If there is no tool with that name.
+    """
+
+    del self.tools[name]
+
   def export(self, writer, context, platform):
     """
     Export the build graph to a Ninja manifest.
@@ -142,6 +215,11 @@ class Graph(object):
         writer.variable(key, value)
       writer.newline()
 
+    if self.pools:
+      for name, depth in sorted(self.pools.items()):
+        writer.pool(name, depth)
+      writer.newline()
+
     if self.tools:
       writer.comment('Tools')
       writer.comment('-----')
@@ -163,32 +241,48 @@ class Target(object):
   A higher level abstraction of a Target that can be added to a :class:`Graph`
   and then exported into a Ninja build manifest. A target should be treated
   as read-only always.
+
+  A target that is *hermetic* only reads its inputs, implicit dependencies
+  and the dependencies reported via *deps* and only writes its outputs and
+  depfile. The native executor can run such targets on remote workers.
+
+  If a *worker* command is specified, the program of the target supports
+  the :mod:`craftr.core.persistent` protocol when started with this
+  command. The native executor then sends the arguments of the target's
+  command to a persistent worker process instead of starting the program
+  for every action.
+
+  A *recursive* target runs a nested build, eg. ``make`` or ``cmake
+  --build``. It receives the GNU make jobserver of the build in its
+  ``MAKEFLAGS`` so the nested build shares the jobs of the outer build.
+  Unless a *pool* is specified, it is put into the :data:`RECURSIVE_POOL`.
   """
 
   def __init__(self, name, commands, inputs, outputs, implicit_deps=(),
                order_only_deps=(), pool=None, deps=None, depfile=None,
                msvc_deps_prefix=None, explicit=False, foreach=False,
                description=None, metadata=None, cwd=None, environ=None,
-               frameworks=()):
-    argspec.validate('name', name, {'type': str})
-    argspec.validate('commands', commands,
-      {'type': list, 'allowEmpty': False, 'items':
-        {'type': list, 'allowEmpty': False, 'items': {'type': [Tool, Target, str]}}})
-    argspec.validate('inputs', inputs, {'type': [list, tuple], 'items': {'type': str}})
-    argspec.validate('outputs', outputs, {'type': [list, tuple], 'items': {'type': str}})
-    argspec.validate('implicit_deps', implicit_deps, {'type': [list, tuple], 'items': {'type': str}})
-    argspec.validate('order_only_deps', order_only_deps, {'type': [list, tuple], 'items': {'type': str}})
-    argspec.validate('pool', pool, {'type': [None, str]})
-    argspec.validate('deps', deps, {'type': [None, str], 'enum': ['msvc', 'gcc']})
-    argspec.validate('depfile', depfile, {'type': [None, str]})
-    argspec.validate('msvc_deps_prefix', msvc_deps_prefix, {'type': [None, str]})
-    argspec.validate('explicit', explicit, {'type': bool})
-    argspec.validate('foreach', foreach, {'type': bool})
-    argspec.validate('description', description, {'type': [None, str]})
-    argspec.validate('metadata', metadata, {'type': [None, dict]})
-    argspec.validate('cwd', cwd, {'type': [None, str]})
-    argspec.validate('environ', environ, {'type': [None, dict]})
-    argspec.validate('frameworks', frameworks, {'type': [list, tuple], 'items': {'type': dict}})
+               frameworks=(), hermetic=False, worker=None, recursive=False):
+    _check_str('name', name)
+    _check_commands('commands', commands)
+    _check_files('inputs', inputs)
+    _check_files('outputs', outputs)
+    _check_files('implicit_deps', implicit_deps)
+    _check_files('order_only_deps', order_only_deps)
+    _check_opt_str('pool', pool)
+    _check_opt_str('deps', deps)
+    _check_opt_str('depfile', depfile)
+    _check_opt_str('msvc_deps_prefix', msvc_deps_prefix)
+    _check_bool('explicit', explicit)
+    _check_bool('foreach', foreach)
+    _check_opt_str('description', description)
+    _check_opt_dict('metadata', metadata)
+    _check_opt_str('cwd', cwd)
+    _check_opt_dict('environ', environ)
+    _check_frameworks('frameworks', frameworks)
+    _check_bool('hermetic', hermetic)
+    _check_worker('worker', worker)
+    _check_bool('recursive', recursive)
 
     # Make sure we have a copy of the implicit_deps so we can modify
     # it safely.
@@ -216,7 +310,7 @@ class Target(object):
     self.outputs = list(map(path.norm, outputs))
     self.implicit_deps = list(map(path.norm, implicit_deps))
     self.order_only_deps = list(map(path.norm, order_only_deps))
-    self.pool = pool
+    self.pool = pool or (RECURSIVE_POOL if recursive else None)
     self.deps = deps
     self.depfile = depfile
     self.msvc_deps_prefix = msvc_deps_prefix
@@ -227,6 +321,9 @@ class Target(object):
     self.cwd = cwd
     self.environ = environ or {}
     self.frameworks = frameworks
+    self.hermetic = hermetic
+    self.worker = list(worker) if worker else None
+    self.recursive = recursive
 
     if self.foreach and len(self.inputs) != len(self.outputs):
       raise ValueError('foreach target must have the same number of output '
@@ -255,28 +352,45 @@ class Target(object):
       raise TypeError("Target.__lshift__() expected Target or str")
     return self
 
-  def export(self, writer, context, platform):
+  def get_rule_command(self, platform, wrapper=None):
     """
-    Export the target to a Ninja manifest.
+    Returns the command of the target as a single string in the format of
+    a Ninja rule command. The string can contain references to the ``$in``,
+    ``$out`` and ``$depfile`` variables and to the variables of
+    :class:`Tools<Tool>`. If the target can not be expressed as a single
+    command, a command file will be written to the ``.commands/`` directory.
+
+    :param wrapper: A list of arguments that are prepended to the command
+      (see :func:`craftr.core.jobwrapper.get_command`).
     """
 
-    writer.comment("target: {}".format(self.name))
-    writer.comment("--------" + "-" * len(self.name))
     commands = platform.prepare_commands([list(map(str, c)) for c in self.commands])
 
     # Check if we need to export a command file or can export the command
     # directly.
     if not self.environ and len(commands) == 1:
-      commands = [platform.prepare_single_command(commands[0], self.cwd)]
+      commands = [platform.prepare_single_command((wrapper or []) + commands[0], self.cwd)]
     else:
       filename = path.join('.commands', self.name)
       command, __ = platform.write_command_file(filename, commands,
         self.inputs, self.outputs, cwd=self.cwd, environ=self.environ,
         foreach=self.foreach)
-      commands = [command]
+      commands = [(wrapper or []) + command]
 
     assert len(commands) == 1
-    command = shell.join(commands[0], for_ninja=True)
+    return shell.join(commands[0], for_ninja=True)
+
+  def export(self, writer, context, platform):
+    """
+    Export the target to a Ninja manifest.
+    """
+
+    writer.comment("target: {}".format(self.name))
+    writer.comment("--------" + "-" * len(self.name))
+    wrapper = None
+    if context.wrap_commands:
+      wrapper = jobwrapper.get_command(recursive=self.recursive)
+    command = self.get_rule_command(platform, wrapper)
 
     writer.rule(self.name, command, pool=self.pool, deps=self.deps,
       depfile=self.depfile, description=self.description)
@@ -347,13 +461,10 @@ class Tool(object):
   """
 
   def __init__(self, name, command, preamble=None, environ=None):
-    argspec.validate('name', name, {'type': str})
-    argspec.validate('command', command,
-        {'type': [list, tuple], 'allowEmpty': False, 'items': {'type': str}})
-    argspec.validate('preamble', preamble,
-        {'type': [None, list, tuple], 'items':
-          {'type': [list, tuple], 'allowEmpty': False, 'items': {'type': str}}})
-    argspec.validate('environ', environ, {'type': [None, dict]})
+    _check_str('name', name)
+    _check_tool_command('command', command)
+    _check_tool_preamble('preamble', preamble)
+    _check_opt_dict('environ', environ)
 
     self.name = name
     self.command = command
@@ -369,17 +480,39 @@ class Tool(object):
 
     return '$CraftrTool_{}'.format(self.name.replace('.', '_'))
 
-  def export(self, writer, context, platform):
-    name = str(self)[1:]
+  @property
+  def variable_name(self):
+    """
+    The name of the Ninja variable that contains the command of the tool.
+    """
+
+    return str(self)[1:]
+
+  def get_exported_command(self, platform):
+    """
+    Compute the command to invoke the tool, writing a command file to the
+    ``.tools/`` directory if necessary. The result is also stored in the
+    :attr:`exported_command` member.
+    """
+
     if not self.preamble and not self.environ:
-      self.exported_command = shlex.join(self.command)
+      self.exported_command = shell.join(self.command)
     else:
-      filename = path.join('.tools', name)
+      filename = path.join('.tools', self.variable_name)
       command, filename = platform.write_command_file(
           filename, list(self.preamble) + [self.command], environ=self.environ,
           accept_additional_args=True)
       self.exported_command = shell.join(command)
-    writer.variable(name, self.exported_command)
+    return self.exported_command
+
+  def export(self, writer, context, platform):
+    writer.variable(self.variable_name, self.get_exported_command(platform))
+
+
+_check_target = argspec.compile({'type': Target})
+_check_commands = argspec.compile(
+    {'type': list, 'allowEmpty': False, 'items':
+      {'type': list, 'allowEmpty': False, 'items': {'type': [Tool, Target, str]}}})
 
 
 class ExportContext(object):
@@ -389,10 +522,16 @@ class ExportContext(object):
   the exported manifest.
 
   .. attribute:: ninja_version
+
+  .. attribute:: wrap_commands
+
+    If True, the commands of all targets are wrapped with
+    :mod:`craftr.core.jobwrapper`, so that they take job tokens.
   """
 
-  def __init__(self, ninja_version):
+  def __init__(self, ninja_version, wrap_commands=False):
     self.ninja_version = ninja_version
+    self.wrap_commands = wrap_commands
 
 
 class PlatformHelper(object, metaclass=abc.ABCMeta):
@@ -518,6 +657,7 @@ class WindowsPlatformHelper(PlatformHelper):
       inputs, outputs = ['%1'], ['%2']
 
     commands = self.replace_commands_inout_vars(commands, inputs, outputs)
+    environ = environ or {}
     if dry:
       return result, filename
 
@@ -546,7 +686,7 @@ class UnixPlatformHelper(PlatformHelper):
 
   def prepare_single_command(self, command, cwd):
     if cwd is not None:
-      command = [[shell.safe('('), 'cd', cwd, shell.safe('&&')] + command + [shell.safe(')')]]
+      command = [shell.safe('('), 'cd', cwd, shell.safe('&&')] + command + [shell.safe(')')]
     return command
 
   def write_command_file(self, filename, commands, inputs=None, outputs=None,
@@ -561,6 +701,7 @@ class UnixPlatformHelper(PlatformHelper):
       inputs, outputs = ['%1'], ['%2']
 
     commands = self.replace_commands_inout_vars(commands, inputs, outputs)
+    environ = environ or {}
     if dry:
       return result, filename
 
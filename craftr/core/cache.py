@@ -0,0 +1,694 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.cache`
+========================
+
+This module implements an action cache for the native executor. The outputs
+of an action are stored in a :class:`ContentStore` and can be restored
+instead of executing the action again if its command, environment and the
+contents of its input files are identical.
+
+The cache uses a two-level key, since the dependencies that a compiler
+discovers (eg. header files) are only known after the action was executed.
+The first level key is computed from the command, environment and the
+digests of the explicit inputs and implicit dependencies. It maps to a
+list of candidates that each store the digests of the discovered
+dependencies and the outputs that were produced with them. Absolute paths
+inside the base directory of the project are replaced by a placeholder in
+the keys and entries, thus the cache can be shared between checkouts in
+different locations.
+"""
+
+from craftr.core.digest import DigestDatabase, hash_file
+from craftr.core.logging import logger
+from craftr.utils import httputils
+from craftr.utils import path
+
+import concurrent.futures
+import hashlib
+import http.client
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import zlib
+
+#: Replaces the base directory in cache keys and entries.
+PLACEHOLDER = '@CRAFTR_BASEDIR@'
+
+#: The maximum number of candidates that are stored for a first level key.
+MAX_CANDIDATES = 8
+
+#: The minimum number of seconds between two evictions of the cache.
+EVICT_INTERVAL = 600
+
+
+def parse_size(value):
+  """
+  Parses a size string like ``'512M'`` or ``'10G'`` into a number of bytes.
+  Integers are returned unchanged.
+  """
+
+  if isinstance(value, int):
+    return value
+  match = re.match(r'^\s*(\d+)\s*([kmgt]?)b?\s*$', value, re.I)
+  if not match:
+    raise ValueError('invalid size: {!r}'.format(value))
+  exponent = ' kmgt'.index(match.group(2).lower() or ' ')
+  return int(match.group(1)) * (1024 ** exponent)
+
+
+class ContentStore(object):
+  """
+  A directory that stores files by the digest of their contents. Blobs are
+  evicted in least recently used order when the size of the store exceeds
+  *max_size*.
+
+  :param directory: The directory of the store.
+  :param max_size: The maximum size of the store in bytes or :const:`None`.
+  :param compress: Compress newly stored blobs with :mod:`zlib`.
+  """
+
+  def __init__(self, directory, max_size=None, compress=False):
+    self.directory = directory
+    self.max_size = max_size
+    self.compress = compress
+
+  def blob_path(self, digest, compressed=False):
+    filename = path.join(self.directory, digest[:2], digest[2:])
+    return filename + '.z' if compressed else filename
+
+  def find(self, digest):
+    """
+    Returns a tuple of the filename of the blob for *digest* and whether it
+    is compressed, or :const:`None` if the blob is not in the store.
+    """
+
+    for compressed in (False, True):
+      filename = self.blob_path(digest, compressed)
+      if path.isfile(filename):
+        return filename, compressed
+    return None
+
+  def has(self, digest):
+    return self.find(digest) is not None
+
+  def put(self, filename, digest=None, move=False):
+    """
+    Adds the contents of *filename* to the store and returns the digest.
+    If *move* is True, the file is moved into the store (or removed if
+    the store already contains it).
+    """
+
+    if digest is None:
+      digest = hash_file(filename)
+    found = self.find(digest)
+    if found:
+      _touch(found[0])
+      if move:
+        path.remove(filename, silent=True)
+      return digest
+
+    dest = self.blob_path(digest, self.compress)
+    path.makedirs(path.dirname(dest))
+    if move and not self.compress:
+      os.replace(filename, dest)
+      return digest
+    temp = dest + '.' + uuid.uuid4().hex
+    try:
+      if self.compress:
+        _copy_compressed(filename, temp)
+      else:
+        shutil.copyfile(filename, temp)
+      os.replace(temp, dest)
+    finally:
+      path.remove(temp, silent=True)
+    if move:
+      path.remove(filename, silent=True)
+    return digest
+
+  def open(self, digest):
+    """
+    Returns a readable binary file object for the uncompressed contents of
+    the blob for *digest* or :const:`None` if it is not in the store.
+    """
+
+    found = self.find(digest)
+    if not found:
+      return None
+    filename, compressed = found
+    try:
+      if compressed:
+        with open(filename, 'rb') as fp:
+          return io.BytesIO(zlib.decompress(fp.read()))
+      return open(filename, 'rb')
+    except (OSError, IOError, zlib.error):
+      return None
+
+  def restore(self, digest, dest, hardlink=False):
+    """
+    Restores the blob for *digest* to the file *dest*. If *hardlink* is True
+    and the blob is not compressed, a hard link is created instead of a
+    copy. The output file is replaced atomically.
+
+    :return: True if the blob was restored, False if it is not in the store.
+    """
+
+    found = self.find(digest)
+    if not found:
+      return False
+    filename, compressed = found
+    path.makedirs(path.dirname(dest))
+    temp = dest + '.' + uuid.uuid4().hex
+    try:
+      if hardlink and not compressed:
+        try:
+          os.link(filename, temp)
+        except OSError:
+          shutil.copyfile(filename, temp)
+      elif compressed:
+        _copy_decompressed(filename, temp)
+      else:
+        shutil.copyfile(filename, temp)
+      os.replace(temp, dest)
+    except (OSError, IOError):
+      return False
+    finally:
+      path.remove(temp, silent=True)
+    # Restored outputs must be newer than the inputs of the action and the
+    # blob is marked as recently used, so that it is not evicted.
+    _touch(dest)
+    _touch(filename)
+    return True
+
+  def evict(self, extra_dirs=()):
+    """
+    Removes the least recently used files from the store (and from the
+    *extra_dirs*) until the total size is below :attr:`max_size`.
+    """
+
+    if not self.max_size:
+      return
+    files = []
+    total = 0
+    for directory in (self.directory,) + tuple(extra_dirs):
+      for root, __, names in os.walk(directory):
+        for name in names:
+          filename = path.join(root, name)
+          try:
+            st = os.stat(filename)
+          except OSError:
+            continue
+          files.append((st.st_mtime, st.st_size, filename))
+          total += st.st_size
+    if total <= self.max_size:
+      return
+    files.sort()
+    for mtime, size, filename in files:
+      if total <= self.max_size:
+        break
+      path.remove(filename, silent=True)
+      total -= size
+
+
+class ActionCache(object):
+  """
+  Caches the outputs of :class:`executor.Action` objects in a
+  :class:`ContentStore`.
+
+  :param directory: The root directory of the cache.
+  :param max_size: The maximum size of the cache in bytes or :const:`None`.
+  :param compress: Compress the stored outputs.
+  :param hardlink: Restore outputs with hard links instead of copies.
+    Commands that modify their outputs in place must not be used with
+    this option as they would alter the contents of the cache.
+  :param digests: The :class:`DigestDatabase` that is used to compute the
+    digests of input files. Defaults to a database in the cache directory.
+  :param remote: A :class:`RemoteCache` that is consulted when an action is
+    not in the local cache.
+  :param upload: Upload newly stored actions to the *remote* cache.
+  :param base_dir: Absolute paths inside this directory are replaced by
+    :data:`PLACEHOLDER` when computing keys and storing entries.
+
+  .. attribute:: hits
+
+  .. attribute:: remote_hits
+
+    The number of hits that were served from the remote cache.
+
+  .. attribute:: misses
+
+  .. attribute:: stores
+  """
+
+  def __init__(self, directory, max_size=None, compress=False, hardlink=False,
+      digests=None, remote=None, upload=True, base_dir=None):
+    self.directory = directory
+    self.store = ContentStore(path.join(directory, 'cas'), max_size, compress)
+    self.ac_dir = path.join(directory, 'ac')
+    self.hardlink = hardlink
+    self.digests = digests or DigestDatabase(path.join(directory, 'digests'))
+    self.remote = remote
+    self.upload = upload
+    self.base_dir = path.norm(base_dir) if base_dir else None
+    self.hits = 0
+    self.remote_hits = 0
+    self.misses = 0
+    self.stores = 0
+    self._lock = threading.Lock()
+
+  def load(self):
+    self.digests.load()
+
+  def save(self):
+    if self.remote is not None:
+      self.remote.flush()
+    self.digests.save()
+    try:
+      self.evict()
+    except OSError as exc:
+      logger.warn('craftr: action cache eviction failed:', exc)
+
+  def evict(self):
+    """
+    Evicts the least recently used entries if the cache exceeds its maximum
+    size. This is done at most every :data:`EVICT_INTERVAL` seconds.
+    """
+
+    if not self.store.max_size:
+      return
+    stamp = path.join(self.directory, 'last-evict')
+    try:
+      if time.time() - os.path.getmtime(stamp) < EVICT_INTERVAL:
+        return
+    except OSError:
+      pass
+    path.makedirs(self.directory)
+    with open(stamp, 'w'):
+      pass
+    self.store.evict([self.ac_dir])
+
+  def normalize(self, text):
+    if self.base_dir:
+      text = text.replace(self.base_dir, PLACEHOLDER)
+    return text
+
+  def expand(self, text):
+    if self.base_dir:
+      text = text.replace(PLACEHOLDER, self.base_dir)
+    return text
+
+  def is_cacheable(self, action):
+    """
+    Returns True if the outputs of the *action* can be cached. Actions
+    without outputs and actions in the ``console`` pool are never cached.
+    """
+
+    return bool(action.outputs) and action.pool != 'console'
+
+  def compute_key(self, action):
+    """
+    Computes the first level key of the *action* from its command, the
+    environment variables of its target and the digests of its inputs and
+    implicit dependencies.
+
+    :return: The key or :const:`None` if an input file does not exist.
+    """
+
+    files = []
+    for filename in action.inputs + action.implicit_deps:
+      digest = self.digests.digest(filename)
+      if digest is None:
+        return None
+      files.append([self.normalize(filename), digest])
+    environ = action.target.environ or {}
+    data = {
+      'command': self.normalize(action.command),
+      'environ': {k: self.normalize(v) for k, v in environ.items()},
+      'inputs': files,
+      'outputs': [self.normalize(x) for x in action.outputs]
+    }
+    data = json.dumps(data, sort_keys=True).encode('utf8')
+    return hashlib.sha1(data).hexdigest()
+
+  def read_entry(self, key):
+    """
+    Returns the list of candidates stored for the first level *key*. The
+    entry is marked as recently used.
+    """
+
+    filename = path.join(self.ac_dir, key[:2], key[2:])
+    try:
+      with open(filename) as fp:
+        candidates = json.load(fp)
+    except (OSError, IOError, ValueError):
+      return []
+    _touch(filename)
+    return candidates if isinstance(candidates, list) else []
+
+  def write_entry(self, key, candidates):
+    filename = path.join(self.ac_dir, key[:2], key[2:])
+    path.makedirs(path.dirname(filename))
+    temp = filename + '.' + uuid.uuid4().hex
+    try:
+      with open(temp, 'w') as fp:
+        json.dump(candidates, fp)
+      os.replace(temp, filename)
+    finally:
+      path.remove(temp, silent=True)
+
+  def match_candidate(self, candidates):
+    """
+    Returns the first candidate whose discovered dependencies have the
+    same digests as the files on disk, or :const:`None`.
+    """
+
+    for candidate in candidates:
+      deps = candidate.get('deps', [])
+      if all(self.digests.digest(self.expand(x)) == d for x, d in deps):
+        return candidate
+    return None
+
+  def lookup(self, action):
+    """
+    Restores the outputs of the *action* from the cache.
+
+    :return: The list of dependencies that were discovered when the action
+      was executed, or :const:`None` if the action was not in the cache.
+    """
+
+    key = self.compute_key(action)
+    deps = remote_deps = None
+    if key:
+      deps = self._restore(action, key, self.read_entry(key), False)
+      if deps is None and self.remote is not None:
+        deps = remote_deps = self._restore(action, key, self.remote.get_action(key), True)
+    with self._lock:
+      if deps is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+        if remote_deps is not None:
+          self.remote_hits += 1
+    return deps
+
+  def _restore(self, action, key, candidates, remote):
+    candidate = self.match_candidate(candidates)
+    if candidate is None:
+      return None
+    outputs = {self.expand(x): d for x, d in candidate.get('outputs', {}).items()}
+    if set(outputs) != set(action.outputs):
+      return None
+    for digest in outputs.values():
+      if not self.store.has(digest):
+        if not remote or not self.remote.fetch_blob(digest, self.store):
+          return None
+    if not all(self.store.restore(d, x, self.hardlink) for x, d in outputs.items()):
+      return None
+    if remote:
+      self._add_candidate(key, candidate)
+    return [self.expand(x) for x, __ in candidate.get('deps', [])]
+
+  def _add_candidate(self, key, candidate):
+    with self._lock:
+      candidates = [x for x in self.read_entry(key) if x.get('deps') != candidate['deps']]
+      candidates.insert(0, candidate)
+      self.write_entry(key, candidates[:MAX_CANDIDATES])
+
+  def update(self, action, deps):
+    """
+    Stores the outputs of the *action* after it was executed successfully.
+
+    :param deps: The list of dependencies discovered by executing the
+      action.
+    """
+
+    key = self.compute_key(action)
+    if key is None:
+      return
+    dep_digests = []
+    for filename in deps:
+      digest = self.digests.digest(filename)
+      if digest is None:
+        return
+      dep_digests.append([self.normalize(filename), digest])
+    outputs = {}
+    for filename in action.outputs:
+      if not path.isfile(filename):
+        return
+      digest = self.store.put(filename, self.digests.digest(filename))
+      outputs[self.normalize(filename)] = digest
+
+    candidate = {'deps': dep_digests, 'outputs': outputs}
+    self._add_candidate(key, candidate)
+    with self._lock:
+      self.stores += 1
+    if self.remote is not None and self.upload:
+      self.remote.upload_async(key, candidate, self.store)
+
+  def report(self):
+    """
+    Print the hit/miss statistics of the cache.
+    """
+
+    total = self.hits + self.misses
+    if total:
+      logger.info('craftr: action cache: {} hits, {} misses ({:.0f}% hit rate), '
+          '{} stored'.format(self.hits, self.misses, 100.0 * self.hits / total,
+          self.stores))
+    if self.remote is not None and (total or self.remote.errors):
+      logger.info('craftr: remote cache: {} hits, {} uploaded, {} errors'.format(
+          self.remote_hits, self.remote.uploaded, self.remote.errors))
+
+
+class RemoteCache(object):
+  """
+  Client for an HTTP action cache server that is shared by multiple
+  machines. The server must support ``GET``, ``HEAD`` and ``PUT`` requests
+  for action entries at ``/ac/<key>`` and for blobs at ``/cas/<digest>``
+  and respond with status 404 for missing entries.
+
+  Connections are reused with a :class:`httputils.ConnectionPool`. Uploads
+  are performed in background threads, :meth:`flush` waits for them to
+  complete. Errors never fail the build, they are counted in
+  :attr:`errors` and the first one is logged as a warning.
+
+  :param url: The base URL of the server.
+  :param jobs: The number of threads for uploads and existence checks.
+  :param timeout: The connection timeout in seconds.
+
+  .. attribute:: uploaded
+
+    The number of action entries that have been uploaded.
+
+  .. attribute:: errors
+  """
+
+  def __init__(self, url, jobs=4, timeout=30):
+    self.url = url.rstrip('/')
+    self.connections = httputils.ConnectionPool(timeout)
+    self.uploaded = 0
+    self.errors = 0
+    self._uploader = concurrent.futures.ThreadPoolExecutor(jobs)
+    self._checker = concurrent.futures.ThreadPoolExecutor(jobs)
+    self._pending = []
+    self._known = set()
+    self._lock = threading.Lock()
+
+  def request(self, method, kind, name, body=None, headers=None):
+    url = '{}/{}/{}'.format(self.url, kind, name)
+    return self.connections.request(method, url, body, headers)
+
+  def get_action(self, key):
+    """
+    Returns the list of candidates for the first level *key* on the server.
+    """
+
+    try:
+      response = self.request('GET', 'ac', key)
+      data = response.read()
+    except (http.client.HTTPException, OSError) as exc:
+      self._error(exc)
+      return []
+    if response.status != 200:
+      return []
+    try:
+      candidates = json.loads(data.decode('utf8'))
+    except ValueError:
+      return []
+    return candidates if isinstance(candidates, list) else []
+
+  def put_action(self, key, candidates):
+    data = json.dumps(candidates).encode('utf8')
+    response = self.request('PUT', 'ac', key, data,
+        {'Content-Type': 'application/json'})
+    response.read()
+    if response.status >= 300:
+      raise OSError('PUT /ac/{} failed with status {}'.format(key, response.status))
+
+  def fetch_blob(self, digest, store):
+    """
+    Downloads the blob for *digest* into the :class:`ContentStore` *store*.
+    The contents are verified against the *digest*.
+
+    :return: True if the blob was downloaded, False otherwise.
+    """
+
+    path.makedirs(store.directory)
+    temp = path.join(store.directory, 'download-' + uuid.uuid4().hex)
+    try:
+      response = self.request('GET', 'cas', digest)
+      if response.status != 200:
+        response.read()
+        return False
+      hasher = hashlib.sha1()
+      with open(temp, 'wb') as fp:
+        while True:
+          data = response.read(1 << 16)
+          if not data:
+            break
+          hasher.update(data)
+          fp.write(data)
+      if hasher.hexdigest() != digest:
+        raise OSError('digest mismatch for /cas/{}'.format(digest))
+      store.put(temp, digest, move=True)
+    except (http.client.HTTPException, OSError) as exc:
+      self._error(exc)
+      return False
+    finally:
+      path.remove(temp, silent=True)
+    with self._lock:
+      self._known.add(digest)
+    return True
+
+  def put_blob(self, digest, fp):
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    fp.seek(0)
+    response = self.request('PUT', 'cas', digest, fp,
+        {'Content-Length': str(size), 'Content-Type': 'application/octet-stream'})
+    response.read()
+    if response.status >= 300:
+      raise OSError('PUT /cas/{} failed with status {}'.format(digest, response.status))
+    with self._lock:
+      self._known.add(digest)
+
+  def find_missing(self, digests):
+    """
+    Checks which of the *digests* are not available on the server. The
+    checks are sent concurrently and blobs that are known to exist from
+    previous requests are not checked again.
+
+    :return: A list of the missing digests.
+    """
+
+    with self._lock:
+      digests = [x for x in set(digests) if x not in self._known]
+
+    def check(digest):
+      response = self.request('HEAD', 'cas', digest)
+      response.read()
+      if response.status == 200:
+        with self._lock:
+          self._known.add(digest)
+        return None
+      return digest
+
+    return [x for x in self._checker.map(check, digests) if x is not None]
+
+  def upload_async(self, key, candidate, store):
+    """
+    Upload the outputs of *candidate* from the *store* and add it to the
+    action entry for *key* in the background.
+    """
+
+    future = self._uploader.submit(self._upload, key, candidate, store)
+    with self._lock:
+      self._pending = [x for x in self._pending if not x.done()]
+      self._pending.append(future)
+
+  def _upload(self, key, candidate, store):
+    try:
+      for digest in self.find_missing(candidate['outputs'].values()):
+        fp = store.open(digest)
+        if fp is None:
+          return
+        with fp:
+          self.put_blob(digest, fp)
+      candidates = [x for x in self.get_action(key) if x.get('deps') != candidate['deps']]
+      candidates.insert(0, candidate)
+      self.put_action(key, candidates[:MAX_CANDIDATES])
+    except (http.client.HTTPException, OSError) as exc:
+      self._error(exc)
+    else:
+      with self._lock:
+        self.uploaded += 1
+
+  def flush(self):
+    """
+    Wait for all pending uploads to complete.
+    """
+
+    with self._lock:
+      pending, self._pending = self._pending, []
+    concurrent.futures.wait(pending)
+
+  def close(self):
+    self.flush()
+    self._uploader.shutdown()
+    self._checker.shutdown()
+    self.connections.close()
+
+  def _error(self, exc):
+    with self._lock:
+      self.errors += 1
+      first = (self.errors == 1)
+    if first:
+      logger.warn('craftr: remote cache error:', exc)
+
+
+def _touch(filename):
+  try:
+    os.utime(filename, None)
+  except OSError:
+    pass
+
+
+def _copy_compressed(src, dst, blocksize=1 << 16):
+  compressor = zlib.compressobj()
+  with open(src, 'rb') as ifp, open(dst, 'wb') as ofp:
+    while True:
+      data = ifp.read(blocksize)
+      if not data:
+        break
+      ofp.write(compressor.compress(data))
+    ofp.write(compressor.flush())
+
+
+def _copy_decompressed(src, dst, blocksize=1 << 16):
+  decompressor = zlib.decompressobj()
+  with open(src, 'rb') as ifp, open(dst, 'wb') as ofp:
+    while True:
+      data = ifp.read(blocksize)
+      if not data:
+        break
+      ofp.write(decompressor.decompress(data))
+    ofp.write(decompressor.flush())
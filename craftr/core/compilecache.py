@@ -0,0 +1,445 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.compilecache`
+===============================
+
+A compiler cache for GCC and Clang compile commands, similar to ``ccache``.
+It is used as a wrapper around the compiler command:
+
+.. code:: sh
+
+  python -m craftr.core.compilecache --mode direct --base-dir /src/project \\
+    -- gcc -c main.c -o main.o -MD -MF main.o.d
+
+The cache key consists of the compiler identity, the normalized flags and
+either the preprocessed source (``preprocessed`` mode) or the source file
+and the headers that it included the last time it was compiled (``direct``
+mode). Warning flags are part of the key too, since they change the
+compiler output that is replayed on a hit and, with ``-Werror``, whether
+the compile succeeds at all. Absolute paths inside the *base directory*
+are replaced by a placeholder, thus the same sources compiled in different
+checkouts share cache entries. Object files and
+depfiles are stored in a :class:`cache.ContentStore`.
+"""
+
+from craftr.core.cache import ContentStore, PLACEHOLDER, parse_size
+from craftr.core.digest import hash_file
+from craftr.core.executor import parse_depfile
+from craftr.utils import path
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+
+#: The minimum number of seconds between two evictions of the cache.
+EVICT_INTERVAL = 600
+
+#: Increment to invalidate all existing cache entries.
+CACHE_VERSION = 2
+
+#: Flags that are followed by a separate argument.
+ARG_FLAGS = frozenset([
+  '-I', '-D', '-U', '-include', '-imacros', '-isystem', '-iquote',
+  '-idirafter', '-isysroot', '--sysroot', '-x', '-arch', '-target', '-F',
+  '-framework', '-Xclang', '-Xpreprocessor', '-MT', '-MQ'
+])
+
+#: Flags that generate dependency information. They are not passed to the
+#: preprocessor in ``preprocessed`` mode.
+DEP_FLAGS = frozenset(['-MD', '-MMD', '-MP'])
+
+
+class UnsupportedCommand(Exception):
+  """
+  Raised by :class:`CompileCommand` if the command can not be cached.
+  """
+
+
+class CompileCommand(object):
+  """
+  Parses a GCC or Clang command that compiles a single source file to an
+  object file.
+
+  .. attribute:: args
+
+  .. attribute:: source
+
+  .. attribute:: output
+
+  .. attribute:: depfile
+
+  .. attribute:: flags
+
+    A list of the flags that affect the compiler output, excluding the
+    source, output and depfile names.
+
+  .. attribute:: debug
+
+    True if the command generates debug information.
+
+  :raise UnsupportedCommand: If the command does not compile exactly one
+    source file with ``-c``.
+  """
+
+  def __init__(self, args):
+    self.args = args
+    self.source = None
+    self.output = None
+    self.depfile = None
+    self.flags = []
+    self.debug = False
+    compile_only = False
+
+    index = 1
+    while index < len(args):
+      arg = args[index]
+      index += 1
+      if arg == '-c':
+        compile_only = True
+      elif arg == '-o' or arg == '-MF':
+        if index >= len(args):
+          raise UnsupportedCommand('missing argument for ' + arg)
+        if arg == '-o':
+          self.output = args[index]
+        else:
+          self.depfile = args[index]
+        index += 1
+      elif arg in ARG_FLAGS:
+        if index >= len(args):
+          raise UnsupportedCommand('missing argument for ' + arg)
+        self.flags += [arg, args[index]]
+        index += 1
+      elif arg in ('-E', '-S', '-M', '-MM') or arg.startswith('@'):
+        raise UnsupportedCommand('unsupported flag: ' + arg)
+      elif arg.startswith('-'):
+        if arg.startswith('-g') and arg != '-g0':
+          self.debug = True
+        self.flags.append(arg)
+      elif self.source is None:
+        self.source = arg
+      else:
+        raise UnsupportedCommand('multiple source files')
+
+    if not compile_only or not self.source or not self.output:
+      raise UnsupportedCommand('not a single source compile command')
+    if self.depfile is None and ('-MD' in args or '-MMD' in args):
+      self.depfile = path.setsuffix(self.output, '.d')
+
+  def preprocessor_args(self):
+    """
+    Returns the command that writes the preprocessed source to stdout.
+    """
+
+    result = [self.args[0]]
+    index = 1
+    while index < len(self.args):
+      arg = self.args[index]
+      index += 1
+      if arg in ('-c', '-o', '-MF') or arg in DEP_FLAGS:
+        if arg in ('-o', '-MF'):
+          index += 1
+        continue
+      if arg in ('-MT', '-MQ'):
+        index += 1
+        continue
+      if arg in ARG_FLAGS:
+        result += [arg, self.args[index]]
+        index += 1
+        continue
+      result.append(arg)
+    return result + ['-E']
+
+
+class CompileCache(object):
+  """
+  Implements the lookup and storage of compile results.
+
+  :param directory: The cache directory.
+  :param base_dir: Absolute paths inside this directory are replaced by a
+    placeholder when computing cache keys and storing depfiles.
+  :param compiler_id: A string that identifies the compiler, eg. its name,
+    version and target.
+  :param max_size: The maximum size of the cache in bytes.
+  """
+
+  def __init__(self, directory, base_dir=None, compiler_id='', max_size=None):
+    self.directory = directory
+    self.base_dir = path.norm(base_dir) if base_dir else None
+    self.compiler_id = compiler_id
+    self.store = ContentStore(path.join(directory, 'cas'), max_size)
+    self.manifest_dir = path.join(directory, 'manifests')
+    self.result_dir = path.join(directory, 'results')
+
+  def normalize(self, text):
+    if self.base_dir:
+      text = text.replace(self.base_dir, PLACEHOLDER)
+    return text
+
+  def expand(self, text):
+    if self.base_dir:
+      text = text.replace(PLACEHOLDER, self.base_dir)
+    return text
+
+  def common_key(self, command):
+    """
+    Returns the list of key components that are shared by both modes.
+    """
+
+    program = shutil.which(command.args[0]) or command.args[0]
+    try:
+      st = os.stat(program)
+      stamp = [st.st_size, st.st_mtime_ns]
+    except OSError:
+      stamp = None
+    key = [CACHE_VERSION, self.compiler_id, program, stamp,
+        [self.normalize(x) for x in command.flags]]
+    if command.debug:
+      # Debug information contains absolute paths, we can not share those
+      # objects between different directories.
+      key.append(os.getcwd())
+    return key
+
+  def run(self, args, mode='direct'):
+    """
+    Runs the compile command *args* or restores its outputs from the cache.
+
+    :return: The exit code of the compiler.
+    """
+
+    try:
+      command = CompileCommand(args)
+    except UnsupportedCommand:
+      return subprocess.call(args)
+    if mode == 'direct' and not command.depfile:
+      mode = 'preprocessed'
+
+    key = self.common_key(command)
+    manifest_key = None
+    if mode == 'direct':
+      source = path.norm(command.source)
+      try:
+        key += ['direct', self.normalize(source), hash_file(source)]
+      except (OSError, IOError):
+        return subprocess.call(args)
+      manifest_key = _hash(key)
+      result_key = self.lookup_manifest(manifest_key)
+    else:
+      proc = subprocess.Popen(command.preprocessor_args(),
+          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+      preprocessed = proc.communicate()[0]
+      if proc.returncode != 0:
+        return subprocess.call(args)
+      preprocessed = self.normalize(preprocessed.decode('utf8', 'surrogateescape'))
+      key += ['preprocessed', hashlib.sha1(
+          preprocessed.encode('utf8', 'surrogateescape')).hexdigest()]
+      result_key = _hash(key)
+
+    if result_key and self.restore(result_key, command):
+      return 0
+
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    sys.stdout.buffer.write(stdout)
+    sys.stdout.flush()
+    sys.stderr.buffer.write(stderr)
+    sys.stderr.flush()
+    if proc.returncode != 0:
+      return proc.returncode
+
+    try:
+      if mode == 'direct':
+        result_key = self.update_manifest(manifest_key, command, key)
+      else:
+        result_key = _hash(key)
+      if result_key:
+        self.store_result(result_key, command, stdout, stderr)
+      self.evict()
+    except (OSError, IOError) as exc:
+      print('craftr.core.compilecache: warning:', exc, file=sys.stderr)
+    return 0
+
+  def lookup_manifest(self, manifest_key):
+    """
+    Returns the result key of the first candidate in the manifest for which
+    all headers have the same contents as the files on disk.
+    """
+
+    for candidate in _read_json(_entry_path(self.manifest_dir, manifest_key), []):
+      for filename, digest in candidate['headers']:
+        try:
+          if hash_file(self.expand(filename)) != digest:
+            break
+        except (OSError, IOError):
+          break
+      else:
+        return candidate['result']
+    return None
+
+  def update_manifest(self, manifest_key, command, key):
+    """
+    Adds a candidate for the headers listed in the depfile of the *command*
+    to the manifest and returns its result key.
+    """
+
+    try:
+      with open(command.depfile, encoding='utf8', errors='surrogateescape') as fp:
+        deps = parse_depfile(fp.read())
+    except (OSError, IOError):
+      return None
+    source = path.norm(command.source)
+    headers = []
+    for filename in deps:
+      filename = path.norm(filename)
+      if filename == source:
+        continue
+      headers.append([self.normalize(filename), hash_file(filename)])
+    result_key = _hash(key + [headers])
+
+    filename = _entry_path(self.manifest_dir, manifest_key)
+    candidates = [x for x in _read_json(filename, []) if x['headers'] != headers]
+    candidates.insert(0, {'headers': headers, 'result': result_key})
+    _write_json(filename, candidates[:16])
+    return result_key
+
+  def store_result(self, result_key, command, stdout, stderr):
+    result = {
+      'object': self.store.put(command.output),
+      'depfile': None,
+      'stdout': self.normalize(stdout.decode('utf8', 'surrogateescape')),
+      'stderr': self.normalize(stderr.decode('utf8', 'surrogateescape'))
+    }
+    if command.depfile and path.isfile(command.depfile):
+      with open(command.depfile, encoding='utf8', errors='surrogateescape') as fp:
+        depfile = self.normalize(fp.read())
+      temp = path.join(self.directory, 'tmp-' + uuid.uuid4().hex)
+      with open(temp, 'w', encoding='utf8', errors='surrogateescape') as fp:
+        fp.write(depfile)
+      result['depfile'] = self.store.put(temp, move=True)
+    _write_json(_entry_path(self.result_dir, result_key), result)
+
+  def restore(self, result_key, command):
+    """
+    Restores the object file and depfile of the *command* from the result
+    with the specified key and prints the compiler output.
+
+    :return: True on success, False if the result is not in the cache.
+    """
+
+    result = _read_json(_entry_path(self.result_dir, result_key), None)
+    if not result:
+      return False
+    if result['depfile']:
+      if not command.depfile:
+        return False
+      fp = self.store.open(result['depfile'])
+      if fp is None:
+        return False
+      with fp:
+        depfile = self.expand(fp.read().decode('utf8', 'surrogateescape'))
+    if not self.store.restore(result['object'], command.output):
+      return False
+    if result['depfile']:
+      with open(command.depfile, 'w', encoding='utf8', errors='surrogateescape') as fp:
+        fp.write(depfile)
+    sys.stdout.write(self.expand(result['stdout']))
+    sys.stdout.flush()
+    sys.stderr.write(self.expand(result['stderr']))
+    sys.stderr.flush()
+    return True
+
+  def evict(self):
+    """
+    Evicts the least recently used entries if the cache exceeds its maximum
+    size. This is done at most every :data:`EVICT_INTERVAL` seconds.
+    """
+
+    if not self.store.max_size:
+      return
+    stamp = path.join(self.directory, 'last-evict')
+    try:
+      if time.time() - os.path.getmtime(stamp) < EVICT_INTERVAL:
+        return
+    except OSError:
+      pass
+    path.makedirs(self.directory)
+    with open(stamp, 'w'):
+      pass
+    self.store.evict([self.manifest_dir, self.result_dir])
+
+
+def _hash(data):
+  return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def _entry_path(directory, key):
+  return path.join(directory, key[:2], key[2:])
+
+
+def _read_json(filename, default):
+  try:
+    with open(filename) as fp:
+      data = json.load(fp)
+  except (OSError, IOError, ValueError):
+    return default
+  try:
+    os.utime(filename, None)
+  except OSError:
+    pass
+  return data
+
+
+def _write_json(filename, data):
+  path.makedirs(path.dirname(filename))
+  temp = filename + '.' + uuid.uuid4().hex
+  try:
+    with open(temp, 'w') as fp:
+      json.dump(data, fp)
+    os.replace(temp, filename)
+  finally:
+    path.remove(temp, silent=True)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m craftr.core.compilecache')
+  parser.add_argument('--mode', choices=['direct', 'preprocessed'], default='direct')
+  parser.add_argument('--dir', default=None)
+  parser.add_argument('--base-dir', default=None)
+  parser.add_argument('--compiler-id', default='')
+  parser.add_argument('--max-size', default='5G')
+  parser.add_argument('command', nargs=argparse.REMAINDER)
+  args = parser.parse_args(argv)
+
+  command = args.command
+  if command and command[0] == '--':
+    command = command[1:]
+  if not command:
+    parser.error('missing compiler command')
+
+  directory = args.dir or path.user_cache_dir('compile')
+  cache = CompileCache(directory, args.base_dir, args.compiler_id,
+      parse_size(args.max_size))
+  return cache.run(command, args.mode)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
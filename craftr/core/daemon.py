@@ -0,0 +1,300 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.daemon`
+=========================
+
+The ``craftr daemon`` keeps a warm :class:`Session` for a project
+directory: The imported Python modules, the parsed manifests, the executed
+modules (including the results of compiler detection) and the build graph.
+The ``craftr`` command (see :mod:`craftr.client`) forwards ``export`` and
+``build`` commands to the daemon over a Unix socket.
+
+Modules are only executed again if their Craftrfile or manifest changed
+since the previous command (together with the modules that depend on
+them), or all modules if the options or the main module changed. The
+daemon executes one command at a time. It uses the standard file
+descriptors of the client while the command runs, so the output of
+commands like Ninja goes directly to the client's terminal.
+"""
+
+from craftr.client import (get_socket_path, recv_line, check_peer,
+    check_socket, make_socket_directory)
+from craftr.core import build
+from craftr.core.logging import logger
+from craftr.core.session import Session
+from craftr.core.watch import LiveSession
+
+import json
+import os
+import socket
+import sys
+import traceback
+
+#: The default number of seconds after which an idle daemon exits.
+DEFAULT_IDLE_TIMEOUT = 3 * 60 * 60
+
+
+def _recv_request(conn):
+  """
+  Receive the request of a client together with its file descriptors.
+  """
+
+  fds = []
+  data = b''
+  while not data.endswith(b'\n'):
+    chunk, ancdata, __, __ = conn.recvmsg(65536, socket.CMSG_SPACE(16 * 4))
+    if not chunk:
+      raise ConnectionError('connection closed by the client')
+    for level, kind, cdata in ancdata:
+      if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+        count = len(cdata) // 4
+        fds += list(memoryview(cdata)[:count * 4].cast('i'))
+    data += chunk
+  return json.loads(data.decode('utf8')), fds
+
+
+class Daemon(object):
+  """
+  Serves the commands of clients for the project in *directory* with a
+  warm :class:`Session`.
+
+  :param directory: The project directory that clients run ``craftr`` in.
+  :param main: A function that executes the command-line arguments that
+    it receives in the context of a daemon and returns the exit code (see
+    :func:`craftr.__main__.main`).
+  :param idle_timeout: The number of seconds after which the daemon exits
+    if it received no command.
+
+  .. attribute:: session
+
+    The :class:`Session` that is used for all commands.
+  """
+
+  def __init__(self, directory, main, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    self.directory = os.path.abspath(directory)
+    self.main = main
+    self.idle_timeout = idle_timeout
+    self.socket_path = get_socket_path(self.directory)
+    self.session = Session(self.directory)
+    self.module = None
+    self.options = None
+    self.mtimes = {}
+    self.requests = 0
+    self._running = False
+
+  def run_module(self, module):
+    """
+    Execute the main *module* of a command, or only the modules that
+    changed since the previous command if the *module* and the options
+    are the same as before.
+
+    :return: The main module, which is a new object if its manifest was
+      parsed again.
+    """
+
+    options = dict(self.session.options)
+    previous, self.module = self.module, None
+    if module is not previous or options != self.options or not module.executed:
+      self.reset()
+      module.run()
+    else:
+      modules, manifests = self.get_changed_modules(module)
+      if modules:
+        live = LiveSession(self.session, module)
+        live.reload(modules, manifests)
+        module = live.module
+      else:
+        logger.debug('craftr daemon: modules are up to date')
+    self.module = module
+    self.options = options
+    self.mtimes = {}
+    for filename in LiveSession(self.session, module).module_files():
+      self.mtimes[filename] = self._get_mtime(filename)
+    return module
+
+  def reset(self):
+    """
+    Reset all modules of the session so that they are executed again and
+    clear the build graph.
+    """
+
+    for versions in self.session.modules.values():
+      for module in versions.values():
+        module.reset()
+        module.options = None
+        module.loader = None
+        module.loader_error = None
+    self.session.graph = build.Graph()
+
+  def get_changed_modules(self, module):
+    """
+    Returns a tuple of the modules whose Craftrfile or manifest changed
+    since the previous command, and of those whose manifest changed.
+    """
+
+    modules = []
+    manifests = []
+    for filename, owner in LiveSession(self.session, module).module_files().items():
+      if self.mtimes.get(filename) != self._get_mtime(filename):
+        if owner not in modules:
+          modules.append(owner)
+        if filename.endswith('.json') and owner not in manifests:
+          manifests.append(owner)
+    return modules, manifests
+
+  @staticmethod
+  def _get_mtime(filename):
+    try:
+      return os.stat(filename).st_mtime
+    except OSError:
+      return None
+
+  def bind(self):
+    """
+    Create the Unix socket of the daemon.
+
+    :raise RuntimeError: If another daemon is running for the directory.
+    :raise PermissionError: If the socket directory or an existing socket
+      is not owned by the current user or accessible by other users.
+    """
+
+    directory = os.path.dirname(self.socket_path)
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    make_socket_directory(directory)
+    if os.path.lexists(self.socket_path):
+      check_socket(self.socket_path)
+      probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        probe.connect(self.socket_path)
+      except OSError:
+        os.remove(self.socket_path)  # stale socket
+      else:
+        raise RuntimeError('a daemon is already running for "{}"'.format(self.directory))
+      finally:
+        probe.close()
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.bind(self.socket_path)
+    self.sock.listen(8)
+
+  def serve(self):
+    """
+    Serve commands until the daemon is stopped or idle for longer than
+    :attr:`idle_timeout` seconds.
+    """
+
+    self._running = True
+    self.sock.settimeout(self.idle_timeout)
+    try:
+      while self._running:
+        try:
+          conn, __ = self.sock.accept()
+        except socket.timeout:
+          logger.info('craftr daemon: idle for {} seconds, exiting'.format(self.idle_timeout))
+          break
+        conn.settimeout(None)
+        try:
+          self.handle(conn)
+        except (OSError, ValueError) as exc:
+          logger.error('craftr daemon: invalid request:', exc)
+        finally:
+          conn.close()
+    finally:
+      self.sock.close()
+      try:
+        os.remove(self.socket_path)
+      except OSError:
+        pass
+
+  def handle(self, conn):
+    """
+    Handle the request of a client on the connection *conn*.
+    """
+
+    check_peer(conn)
+    request, fds = _recv_request(conn)
+    try:
+      if request.get('stop'):
+        self._running = False
+        exit_code = 0
+      else:
+        exit_code = self.execute(request, fds)
+    finally:
+      for fd in fds:
+        os.close(fd)
+    conn.sendall(json.dumps({'exit_code': exit_code}).encode('utf8') + b'\n')
+
+  def execute(self, request, fds):
+    """
+    Execute the command of a *request* with the standard file descriptors
+    of the client (*fds*), its working directory and environment.
+    """
+
+    self.requests += 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(fd) for fd in range(len(fds))]
+    saved_environ = dict(os.environ)
+    saved_cwd = os.getcwd()
+    try:
+      for target_fd, fd in enumerate(fds):
+        os.dup2(fd, target_fd)
+      os.environ.clear()
+      os.environ.update(request.get('environ', {}))
+      os.chdir(request.get('cwd') or self.directory)
+      try:
+        return self.main(request['argv'], daemon=self) or 0
+      except SystemExit as exc:
+        return exc.code if isinstance(exc.code, int) else (0 if exc.code is None else 1)
+      except Exception:
+        traceback.print_exc()
+        self.module = None  # Execute all modules again in the next command.
+        return 1
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      for target_fd, fd in enumerate(saved_fds):
+        os.dup2(fd, target_fd)
+        os.close(fd)
+      os.environ.clear()
+      os.environ.update(saved_environ)
+      os.chdir(saved_cwd)
+
+
+def stop(directory):
+  """
+  Stop the daemon that is running for *directory*.
+
+  :raise PermissionError: If the socket is not safe to use (see
+    :func:`craftr.client.check_socket`).
+  :return: True if a daemon was stopped, False if none was running.
+  """
+
+  socket_path = get_socket_path(directory)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    check_socket(socket_path)
+    sock.connect(socket_path)
+    check_peer(sock)
+    sock.sendall(json.dumps({'stop': True}).encode('utf8') + b'\n')
+    recv_line(sock)
+    return True
+  except PermissionError:
+    raise
+  except OSError:
+    return False
+  finally:
+    sock.close()
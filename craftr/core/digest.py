@@ -0,0 +1,137 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.digest`
+=========================
+
+This module provides the :class:`DigestDatabase` which computes and caches
+the content digests of files. A digest is only recomputed if the stat
+information of the file (modification time, size and inode) changed since
+it was last computed.
+
+Like the "racy clean" check of Git's index, a cached digest is not trusted
+if the file was modified shortly before the digest was computed. The file
+could have been written again within the granularity of the modification
+time, keeping the same size and inode, and the stat information would not
+change.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+#: The name of the file in the build directory that contains the
+#: :class:`DigestDatabase` of the native executor.
+DIGESTS_FILENAME = '.craftr_digests'
+
+#: The number of nanoseconds that a file must have been unmodified when its
+#: digest was computed for the cached digest to be used. This covers coarse
+#: timestamps (FAT has a resolution of two seconds) and the delay of the
+#: clock that the kernel uses for timestamps.
+RACY_INTERVAL_NS = 2 * 10**9
+
+
+def hash_file(filename, algorithm='sha1', blocksize=1 << 16):
+  """
+  Compute the hex digest of the contents of *filename*.
+  """
+
+  hasher = hashlib.new(algorithm)
+  with open(filename, 'rb') as fp:
+    while True:
+      data = fp.read(blocksize)
+      if not data:
+        break
+      hasher.update(data)
+  return hasher.hexdigest()
+
+
+def stat_key(st):
+  """
+  Returns the list of stat information that is used to determine if the
+  cached digest of a file is still valid.
+  """
+
+  return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+class DigestDatabase(object):
+  """
+  A persistent cache of file content digests, keyed by the filename and
+  its stat information. Every entry also records the time at which the
+  digest was computed, see :data:`RACY_INTERVAL_NS`. The database can be
+  used from multiple threads.
+
+  :param filename: The file to load from and save the database to.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.entries = {}
+    self.dirty = False
+    self._lock = threading.Lock()
+
+  def load(self):
+    try:
+      with open(self.filename) as fp:
+        entries = json.load(fp)
+    except (OSError, IOError, ValueError):
+      entries = {}
+    self.entries = entries if isinstance(entries, dict) else {}
+    self.dirty = False
+
+  def save(self):
+    with self._lock:
+      if not self.dirty:
+        return
+      entries = dict(self.entries)
+      self.dirty = False
+    with open(self.filename, 'w') as fp:
+      json.dump(entries, fp)
+
+  def digest(self, filename):
+    """
+    Returns the digest of the contents of *filename* or :const:`None` if
+    the file does not exist.
+    """
+
+    now = int(time.time() * 10**9)
+    try:
+      key = stat_key(os.stat(filename))
+    except OSError:
+      return None
+    entry = self.entries.get(filename)
+    if entry is not None and entry[0] == key and len(entry) > 2 \
+        and key[0] + RACY_INTERVAL_NS <= entry[2]:
+      return entry[1]
+    try:
+      digest = hash_file(filename)
+    except (OSError, IOError):
+      return None
+    with self._lock:
+      self.entries[filename] = [key, digest, now]
+      self.dirty = True
+    return digest
+
+  def digest_all(self, filenames):
+    """
+    Returns a dictionary that maps every filename in *filenames* to its
+    digest (or :const:`None` if the file does not exist).
+    """
+
+    return {x: self.digest(x) for x in filenames}
@@ -0,0 +1,381 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.dlcache`
+==========================
+
+A machine-wide cache for the archives that are downloaded by loaders and
+the directory trees that they are extracted to, shared by all build
+directories of the current user. The cache directory has the following
+layout:
+
+* ``urls/<sha1(url)>.json`` -- the SHA256 of the archive that was last
+  downloaded from a URL, with the ``ETag`` and ``Last-Modified`` headers
+  to revalidate it
+* ``blobs/<sha256>/<filename>`` -- the downloaded archives, except for
+  tar archives, which are not stored
+* ``trees/<sha256>[-<variant>]/`` -- the extracted archives, with write
+  permissions removed from all files
+* ``git/<sha1(url)>.git`` -- bare repositories of the Git loader
+* ``tmp/`` -- partial downloads, which are resumed, and tar archives that
+  are extracted while they are downloaded
+
+The SHA256 directory names are split after the second character.
+
+Build directories link to the extracted trees with a symbolic link, or
+with a copy of hard links if symbolic links are not supported.
+"""
+
+from craftr.core.digest import hash_file
+from craftr.core.logging import logger
+from craftr.utils import httputils
+from craftr.utils import path
+from craftr.utils import tarstream
+from craftr.utils import zipextract
+
+import contextlib
+import hashlib
+import json
+import nr.misc.archive
+import os
+import shutil
+import stat
+import urllib.request
+import uuid
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+#: The number of seconds to wait for the server when a cached download
+#: is revalidated.
+REVALIDATE_TIMEOUT = 10
+
+
+@contextlib.contextmanager
+def lock_file(filename):
+  """
+  A context manager that holds an exclusive lock on *filename* (which is
+  created if it doesn't exist) to serialize access to a cache entry between
+  processes and threads. Does nothing on platforms without :mod:`fcntl`.
+  """
+
+  if fcntl is None:
+    yield
+    return
+  path.makedirs(path.dirname(filename))
+  with open(filename, 'a') as fp:
+    fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def _touch(filename):
+  try:
+    os.utime(filename, None)
+  except OSError:
+    pass
+
+
+def _make_readonly(directory):
+  # Only the files are made read-only, so that the trees can still be
+  # deleted without changing their permissions first.
+  mask = ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+  for root, __, names in os.walk(directory):
+    for name in names:
+      filename = path.join(root, name)
+      if not os.path.islink(filename):
+        os.chmod(filename, os.stat(filename).st_mode & mask)
+
+
+def _link_or_copy(src, dst):
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy2(src, dst)
+
+
+class DownloadCache(object):
+  """
+  A content-addressed cache for downloaded archives and their extracted
+  directory trees.
+
+  :param directory: The directory of the cache.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def _url_key(self, url):
+    return hashlib.sha1(url.encode('utf8')).hexdigest()
+
+  def read_entry(self, url):
+    """
+    Returns the cache entry of *url* or :const:`None`.
+    """
+
+    filename = path.join(self.directory, 'urls', self._url_key(url) + '.json')
+    try:
+      with open(filename) as fp:
+        entry = json.load(fp)
+    except (OSError, ValueError):
+      return None
+    if not isinstance(entry, dict) or entry.get('url') != url:
+      return None
+    return entry
+
+  def write_entry(self, url, entry):
+    filename = path.join(self.directory, 'urls', self._url_key(url) + '.json')
+    path.makedirs(path.dirname(filename))
+    temp = filename + '.' + uuid.uuid4().hex
+    with open(temp, 'w') as fp:
+      json.dump(entry, fp)
+    os.replace(temp, filename)
+
+  def get_git_dir(self, url):
+    """
+    Returns the directory of the bare Git repository that the commits
+    fetched from *url* are stored in.
+    """
+
+    return path.join(self.directory, 'git', self._url_key(url) + '.git')
+
+  def find_blob(self, digest):
+    """
+    Returns the filename of the archive with the SHA256 *digest* or
+    :const:`None` if it is not in the cache.
+    """
+
+    directory = path.join(self.directory, 'blobs', digest[:2], digest[2:])
+    for name in path.easy_listdir(directory):
+      return path.join(directory, name)
+    return None
+
+  def is_fresh(self, url, entry):
+    """
+    Revalidate the cache *entry* of *url* with a conditional request. Entries
+    without an ``ETag`` or ``Last-Modified`` header and entries that can not
+    be revalidated because the server is not reachable are assumed to be
+    fresh.
+    """
+
+    headers = {}
+    if entry.get('etag'):
+      headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+      headers['If-Modified-Since'] = entry['last_modified']
+    if not headers:
+      return True
+    request = urllib.request.Request(url, headers=headers, method='HEAD')
+    try:
+      response = urllib.request.urlopen(request, timeout=REVALIDATE_TIMEOUT)
+    except httputils.HTTPError as exc:
+      if exc.code == 304:
+        return True
+      if exc.code in (405, 501):
+        return True  # HEAD is not supported, can not revalidate
+      return False
+    except (httputils.URLError, OSError) as exc:
+      logger.info('Can not revalidate {} ({}), using cached download'.format(url, exc))
+      return True
+    response.close()
+    etag = response.headers.get('ETag')
+    if entry.get('etag') and etag:
+      return etag == entry['etag']
+    modified = response.headers.get('Last-Modified')
+    return bool(modified) and modified == entry.get('last_modified')
+
+  def fetch(self, url, sha256=None, progress=None):
+    """
+    Returns the filename of the archive downloaded from *url*, downloading
+    it if it is not in the cache or if it changed on the server. Partial
+    downloads are resumed.
+
+    :param sha256: The expected SHA256 of the archive. If an archive with
+      this hash is in the cache, the server is not contacted.
+    :param progress: Passed to :func:`httputils.download_file`.
+    :raise httputils.URLError:
+    :raise httputils.HTTPError:
+    :raise httputils.ChecksumError:
+    :return: A tuple of the filename and the SHA256 of the archive.
+    """
+
+    sha256 = sha256.lower() if sha256 else None
+    if sha256:
+      blob = self.find_blob(sha256)
+      if blob:
+        _touch(blob)
+        return blob, sha256
+
+    key = self._url_key(url)
+    with lock_file(path.join(self.directory, 'tmp', key + '.lock')):
+      entry = self.read_entry(url)
+      if entry and (not sha256 or entry.get('sha256') == sha256):
+        blob = self.find_blob(entry['sha256'])
+        if blob and self.is_fresh(url, entry):
+          logger.info('Reusing cached download', path.basename(blob))
+          _touch(blob)
+          return blob, entry['sha256']
+
+      headers = {}
+      def progress_wrapper(data):
+        if data['begin']:
+          headers.update(data['response'].headers)
+        if progress:
+          return progress(data)
+
+      filename, __ = httputils.download_file(url,
+          directory=path.join(self.directory, 'tmp', key),
+          on_exists='overwrite', progress=progress_wrapper, sha256=sha256)
+      digest = sha256 or hash_file(filename, 'sha256')
+      blob = path.join(self.directory, 'blobs', digest[:2], digest[2:],
+          path.basename(filename))
+      path.makedirs(path.dirname(blob))
+      os.replace(filename, blob)
+      self.write_entry(url, {'url': url, 'sha256': digest,
+          'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')})
+      return blob, digest
+
+  def _tree_path(self, digest, variant):
+    name = digest[2:] + ('-' + variant if variant else '')
+    return path.join(self.directory, 'trees', digest[:2], name)
+
+  def find_tree(self, digest, variant=''):
+    """
+    Returns the directory of the extracted archive with the SHA256 *digest*
+    or :const:`None` if it is not in the cache.
+    """
+
+    tree = self._tree_path(digest, variant)
+    if path.isdir(tree):
+      _touch(tree)
+      return tree
+    return None
+
+  def _commit_tree(self, temp, digest, variant):
+    # Move the extracted directory *temp* into the cache.
+    tree = self._tree_path(digest, variant)
+    _make_readonly(temp)
+    path.makedirs(path.dirname(tree))
+    try:
+      os.rename(temp, tree)
+    except OSError:
+      if not path.isdir(tree):
+        raise
+      # Another process extracted the archive at the same time.
+    return tree
+
+  def extract(self, archive, digest, suffix, variant='',
+      check_extract_file=None, progress_callback=None):
+    """
+    Returns the directory of the extracted *archive*, extracting it if it
+    is not in the cache. The files in the directory must not be modified.
+
+    :param digest: The SHA256 of the *archive*.
+    :param suffix: The suffix of the archive type.
+    :param variant: A string that distinguishes trees that were extracted
+      from the same archive with different *check_extract_file* functions.
+    """
+
+    tree = self.find_tree(digest, variant)
+    if tree:
+      return tree
+
+    temp = self._tree_path(digest, variant) + '.' + uuid.uuid4().hex
+    try:
+      if suffix == '.zip':
+        zipextract.extract(archive, temp, unpack_single_dir=True,
+            check_extract_file=check_extract_file,
+            progress_callback=progress_callback)
+      else:
+        nr.misc.archive.extract(archive, temp, suffix=suffix,
+            unpack_single_dir=True, check_extract_file=check_extract_file,
+            progress_callback=progress_callback)
+      return self._commit_tree(temp, digest, variant)
+    finally:
+      if path.isdir(temp):
+        path.remove(temp, recursive=True)
+
+  def fetch_tree(self, url, mode, sha256=None, variant='',
+      check_extract_file=None, progress=None):
+    """
+    Like :meth:`fetch` followed by :meth:`extract`, but tar archives that
+    need to be downloaded are extracted while they are downloaded (see
+    :func:`tarstream.download_and_extract`) and are not stored in the
+    cache, only the extracted tree is.
+
+    :param mode: The :mod:`tarfile` stream mode of the archive.
+    :raise tarstream.ExtractError:
+    :return: A tuple of the extracted directory and the SHA256 of the archive.
+    """
+
+    sha256 = sha256.lower() if sha256 else None
+    if sha256:
+      tree = self.find_tree(sha256, variant)
+      if tree:
+        return tree, sha256
+
+    key = self._url_key(url)
+    with lock_file(path.join(self.directory, 'tmp', key + '.lock')):
+      entry = self.read_entry(url)
+      if entry and (not sha256 or entry.get('sha256') == sha256):
+        tree = self.find_tree(entry['sha256'], variant)
+        blob = None if tree else self.find_blob(entry['sha256'])
+        if (tree or blob) and self.is_fresh(url, entry):
+          logger.info('Reusing cached download', url)
+          if not tree:
+            suffix = tarstream.get_stream_mode(blob)[0]
+            tree = self.extract(blob, entry['sha256'], suffix, variant, check_extract_file)
+          return tree, entry['sha256']
+
+      headers = {}
+      def progress_wrapper(data):
+        if data['begin']:
+          headers.update(data['response'].headers)
+        if progress:
+          return progress(data)
+
+      temp = path.join(self.directory, 'tmp', key + '.' + uuid.uuid4().hex)
+      try:
+        digest = tarstream.download_and_extract(url, temp, mode,
+            progress=progress_wrapper, sha256=sha256,
+            check_extract_file=check_extract_file)
+        tree = self._commit_tree(temp, digest, variant)
+      finally:
+        if path.isdir(temp):
+          path.remove(temp, recursive=True)
+      self.write_entry(url, {'url': url, 'sha256': digest,
+          'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')})
+      return tree, digest
+
+  def link(self, tree, directory):
+    """
+    Make the extracted *tree* available at *directory*, replacing anything
+    that exists at *directory*.
+    """
+
+    if os.path.islink(directory) or path.isfile(directory):
+      os.remove(directory)
+    elif path.isdir(directory):
+      path.remove(directory, recursive=True)
+    path.makedirs(path.dirname(directory))
+    try:
+      os.symlink(tree, directory, target_is_directory=True)
+    except (OSError, NotImplementedError):
+      shutil.copytree(tree, directory, copy_function=_link_or_copy)
@@ -0,0 +1,949 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.executor`
+===========================
+
+This module implements a native executor for a :class:`build.Graph` as an
+alternative to exporting a Ninja manifest and invoking Ninja. It runs the
+commands of the targets in parallel with a thread pool, honors pools,
+records the dependencies reported by ``deps='gcc'`` and ``deps='msvc'``
+targets in its own dependency log and checks if an action is up to date
+by comparing file modification times or, if a :class:`DigestDatabase` is
+passed, the content digests of its input and output files.
+
+.. code:: python
+
+  executor = Executor(session.graph, build.get_platform_helper(), jobs=4)
+  if not executor.build(['main-1.0.0.program']):
+    logger.error('build failed')
+"""
+
+from craftr.core import build
+from craftr.core import persistent
+from craftr.core.logging import logger
+from craftr.utils import path
+from craftr.utils import shell
+from craftr.utils import sysinfo
+
+import concurrent.futures
+import hashlib
+import heapq
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+
+
+#: The name of the file in the build directory that contains the
+#: :class:`DepLog` of the native executor.
+DEPLOG_FILENAME = '.craftr_deplog'
+
+
+class BuildError(Exception):
+  """
+  Raised when the build graph can not be executed, eg. if an input file
+  is missing and no target produces it or if there is a dependency cycle.
+  """
+
+
+def expand_variables(template, variables):
+  """
+  Expands Ninja-style variable references in the *template* string. Both
+  ``$name`` and ``${name}`` are supported, ``$$`` produces a literal dollar
+  sign. Unknown variables expand to an empty string, like in Ninja.
+  """
+
+  def sub(match):
+    value = match.group(1)
+    if value == '$':
+      return '$'
+    if value.startswith('{'):
+      value = value[1:-1]
+    return variables.get(value, '')
+  return re.sub(r'\$(\$|\{[\w\-]+\}|[\w\-]+)', sub, template)
+
+
+def parse_depfile(text):
+  """
+  Parses the contents of a Makefile-style dependency file as it is produced
+  by GCC and Clang with ``-MD`` and returns the list of all prerequisites.
+  """
+
+  text = text.replace('\\\r\n', ' ').replace('\\\n', ' ')
+  deps = []
+  for line in text.splitlines():
+    in_targets = True
+    for token in _split_depfile_line(line):
+      if in_targets:
+        if token.endswith(':'):
+          in_targets = False
+        continue
+      deps.append(token)
+  return deps
+
+
+def _split_depfile_line(line):
+  tokens = []
+  current = []
+  index = 0
+  while index < len(line):
+    char = line[index]
+    if char == '\\' and index + 1 < len(line) and line[index+1] in ' #':
+      current.append(line[index+1])
+      index += 1
+    elif char == '$' and index + 1 < len(line) and line[index+1] == '$':
+      current.append('$')
+      index += 1
+    elif char.isspace():
+      if current:
+        tokens.append(''.join(current))
+        current = []
+    else:
+      current.append(char)
+    index += 1
+  if current:
+    tokens.append(''.join(current))
+  return tokens
+
+
+def hash_command(command):
+  """
+  Returns a hash of the *command* string that is stored in the :class:`DepLog`
+  to detect changed commands.
+  """
+
+  return hashlib.sha1(command.encode('utf8')).hexdigest()
+
+
+class DepLog(object):
+  """
+  A persistent record of the actions that have been executed successfully.
+  It maps the first output file of an action to a dictionary that contains
+  the ``'command'`` hash and the ``'deps'`` that were discovered from the
+  depfile or compiler output. If it could be measured, the ``'peak_rss'``
+  of the command is recorded as well, together with the ``'pool'`` of the
+  action.
+
+  :param filename: The file to load from and save the log to.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.entries = {}
+    self.dirty = False
+
+  def load(self):
+    try:
+      with open(self.filename) as fp:
+        entries = json.load(fp)
+    except (OSError, IOError, ValueError):
+      entries = {}
+    self.entries = entries if isinstance(entries, dict) else {}
+    self.dirty = False
+
+  def save(self):
+    if not self.dirty:
+      return
+    with open(self.filename, 'w') as fp:
+      json.dump(self.entries, fp)
+    self.dirty = False
+
+  def get(self, output):
+    return self.entries.get(output)
+
+  def forget(self, outputs):
+    for output in outputs:
+      if self.entries.pop(output, None) is not None:
+        self.dirty = True
+
+  def peak_rss(self, pool):
+    """
+    Returns the highest peak memory usage in bytes that has been recorded
+    for an action in the specified *pool*, or :const:`None` if no action
+    in that pool has been recorded.
+    """
+
+    values = [x['peak_rss'] for x in self.entries.values()
+              if isinstance(x, dict) and x.get('pool') == pool and x.get('peak_rss')]
+    return max(values) if values else None
+
+  def record(self, output, command_hash, deps, **extra):
+    entry = {'command': command_hash, 'deps': deps}
+    entry.update(extra)
+    self.entries[output] = entry
+    self.dirty = True
+
+
+class Action(object):
+  """
+  Represents a single build edge: One execution of the command of a
+  :class:`build.Target` for a set of input and output files. A
+  ``foreach`` target produces one action per input/output pair.
+
+  .. attribute:: target
+
+  .. attribute:: inputs
+
+  .. attribute:: outputs
+
+    The output files of the action. If the target has no output files,
+    this is empty and the action is always executed.
+
+  .. attribute:: command
+
+    The fully expanded command string.
+
+  .. attribute:: depfile
+
+    The expanded name of the depfile or :const:`None`.
+
+  .. attribute:: description
+
+  .. attribute:: dependencies
+
+    A list of the :class:`Actions<Action>` that must complete before this
+    action can be executed.
+
+  .. attribute:: dependents
+
+  .. attribute:: priority
+
+    The length of the longest chain of actions that depend on this action.
+    Actions with a higher priority are started first.
+  """
+
+  def __init__(self, target, inputs, outputs, command, depfile, description):
+    self.target = target
+    self.inputs = inputs
+    self.outputs = outputs
+    self.command = command
+    self.command_hash = hash_command(command)
+    self.depfile = depfile
+    self.description = description
+    self.dependencies = []
+    self.dependents = []
+    self.priority = 0
+
+  def __repr__(self):
+    return '<Action {!r}>'.format(self.name)
+
+  @property
+  def name(self):
+    return self.outputs[0] if self.outputs else self.target.name
+
+  @property
+  def pool(self):
+    return self.target.pool
+
+  @property
+  def implicit_deps(self):
+    return self.target.implicit_deps
+
+  @property
+  def order_only_deps(self):
+    return self.target.order_only_deps
+
+
+class ActionResult(object):
+  """
+  The result of executing an :class:`Action`.
+
+  .. attribute:: action
+
+  .. attribute:: skipped
+
+    True if the action was up to date and did not need to be executed.
+
+  .. attribute:: cached
+
+    True if the outputs of the action were restored from the action cache
+    instead of executing its command.
+
+  .. attribute:: returncode
+
+  .. attribute:: output
+
+    The combined standard output and error of the command.
+
+  .. attribute:: deps
+
+    The list of dependencies discovered by executing the action or
+    :const:`None`.
+
+  .. attribute:: digests
+
+    A dictionary that maps the input, dependency and output files of the
+    action to their content digests after it was executed, or :const:`None`
+    if the executor does not check content digests.
+
+  .. attribute:: peak_rss
+
+    The maximum resident set size of the command in bytes, or :const:`None`
+    if it was not measured.
+  """
+
+  def __init__(self, action, skipped, returncode=0, output='', deps=None):
+    self.action = action
+    self.skipped = skipped
+    self.returncode = returncode
+    self.output = output
+    self.deps = deps
+    self.digests = None
+    self.cached = False
+    self.peak_rss = None
+
+
+class Executor(object):
+  """
+  Executes the targets of a :class:`build.Graph` in parallel.
+
+  :param graph: The :class:`build.Graph` to execute.
+  :param platform: A :class:`build.PlatformHelper` that is used to compute
+    the commands of the targets.
+  :param jobs: The maximum number of commands that are executed at the same
+    time. Defaults to the number of CPUs plus two, like Ninja, respecting
+    the CPU quota of the cgroup (see :func:`sysinfo.default_jobs`).
+  :param pools: A dictionary that maps pool names to their depth, in
+    addition to the :attr:`build.Graph.pools`. The ``console`` pool is
+    always available with a depth of one.
+  :param deplog: A :class:`DepLog`. Defaults to a log in the current
+    working directory.
+  :param verbose: Print the full command of every executed action.
+  :param digests: A :class:`digest.DigestDatabase`. If specified, an action
+    is considered up to date if the contents of its files did not change
+    since it was last executed, regardless of their modification times.
+  :param cache: A :class:`cache.ActionCache` to restore the outputs of
+    actions from and to store them in after they have been executed.
+  :param remote: A :class:`remote.RemoteExecutor` that hermetic actions are
+    dispatched to. If no worker is available, they are executed locally.
+    Unless *jobs* is specified, the jobs of all workers are added to the
+    local jobs, but at most as many actions as there are local jobs are
+    executed on the local machine at the same time.
+  :param workers: A :class:`persistent.WorkerPool` that is used to execute
+    actions of targets that specify a *worker* command. The workers are
+    kept running after :meth:`build`, close the pool when it is no longer
+    needed.
+  :param tokens: A :class:`jobtokens.TokenPool`. If specified, a job token
+    is acquired before an action is executed on the local machine.
+  :param jobserver: A :class:`jobserver.Jobserver`. If specified, a token
+    is acquired from it before an action is executed on the local machine
+    and it is passed to the commands of recursive targets.
+  """
+
+  def __init__(self, graph, platform, jobs=None, pools=None, deplog=None,
+      verbose=False, digests=None, cache=None, remote=None, workers=None,
+      tokens=None, jobserver=None):
+    self.graph = graph
+    self.platform = platform
+    self.jobs = jobs or sysinfo.default_jobs()
+    self.auto_jobs = not jobs
+    self.local_jobs = threading.BoundedSemaphore(self.jobs)
+    self.extra_pools = pools or {}
+    self.deplog = deplog or DepLog(path.abs(DEPLOG_FILENAME))
+    self.verbose = verbose
+    self.digests = digests
+    self.cache = cache
+    self.remote = remote
+    self.workers = workers
+    self.tokens = tokens
+    self.jobserver = jobserver
+    self.reset()
+
+  def reset(self):
+    """
+    Discard the actions so that they are created from the graph again by
+    the next :meth:`build`. This must be called after targets, tools or
+    pools were added to or removed from the graph.
+    """
+
+    self.pools = {'console': 1}
+    self.pools.update(self.graph.pools)
+    self.pools.update(self.extra_pools)
+    self.actions = None
+    self.producers = None
+    self.variables = None
+
+  def create_actions(self):
+    """
+    Create the :class:`Actions<Action>` for all targets in the graph and
+    connect them. This is called automatically by :meth:`build`.
+
+    :raise BuildError: If a dependency cycle is detected or if a target
+      uses an unknown pool.
+    """
+
+    variables = dict(self.graph.vars)
+    for tool in self.graph.tools.values():
+      variables[tool.variable_name] = tool.get_exported_command(self.platform)
+    self.variables = variables
+
+    actions = {}
+    producers = {}
+    for target in self.graph.targets.values():
+      if target.pool and target.pool not in self.pools:
+        raise BuildError('unknown pool name: {!r} (target: {})'
+            .format(target.pool, target.name))
+      rule = target.get_rule_command(self.platform)
+      if target.foreach:
+        edges = [([i], [o]) for i, o in zip(target.inputs, target.outputs)]
+      else:
+        edges = [(target.inputs, target.outputs)]
+      actions[target.name] = []
+      for inputs, outputs in edges:
+        action = self._create_action(target, rule, inputs, outputs, variables)
+        actions[target.name].append(action)
+        for outfile in outputs:
+          producers[outfile] = action
+
+    for target_actions in actions.values():
+      for action in target_actions:
+        files = action.inputs + action.implicit_deps + action.order_only_deps
+        seen = set()
+        for filename in files:
+          producer = producers.get(filename)
+          if producer is not None and producer is not action and \
+              id(producer) not in seen:
+            seen.add(id(producer))
+            action.dependencies.append(producer)
+            producer.dependents.append(action)
+
+    self.actions = actions
+    self.producers = producers
+    self._compute_priorities()
+
+  def _create_action(self, target, rule, inputs, outputs, variables):
+    variables = dict(variables)
+    variables['in'] = ' '.join(shell.quote(x) for x in inputs)
+    variables['out'] = ' '.join(shell.quote(x) for x in outputs)
+    depfile = None
+    if target.depfile:
+      depfile = expand_variables(target.depfile, variables)
+      variables['depfile'] = shell.quote(depfile)
+    command = expand_variables(rule, variables)
+    if target.description:
+      description = expand_variables(target.description, variables)
+    else:
+      description = command
+    return Action(target, list(inputs), list(outputs), command, depfile,
+        description)
+
+  def _compute_priorities(self):
+    # Topologically sort the actions (Kahn's algorithm) to detect cycles
+    # and compute the longest chain of dependents for every action.
+    all_actions = [a for x in self.actions.values() for a in x]
+    indegree = {id(a): len(a.dependencies) for a in all_actions}
+    queue = [a for a in all_actions if not a.dependencies]
+    order = []
+    while queue:
+      action = queue.pop()
+      order.append(action)
+      for dependent in action.dependents:
+        indegree[id(dependent)] -= 1
+        if indegree[id(dependent)] == 0:
+          queue.append(dependent)
+    if len(order) != len(all_actions):
+      cycle = [a.name for a in all_actions if indegree[id(a)] > 0]
+      raise BuildError('dependency cycle: ' + ', '.join(sorted(cycle)))
+    for action in reversed(order):
+      action.priority = 1 + max((d.priority for d in action.dependents), default=0)
+
+  def collect(self, targets=None):
+    """
+    Returns a list of all actions that are required to build the specified
+    *targets* (a list of target names). If *targets* is empty or
+    :const:`None`, all targets that are not explicit are built.
+
+    :raise BuildError: If a target does not exist.
+    """
+
+    if self.actions is None:
+      self.create_actions()
+    if not targets:
+      targets = [t.name for t in self.graph.targets.values() if not t.explicit]
+
+    result = []
+    seen = set()
+    stack = []
+    for name in targets:
+      if name not in self.actions:
+        raise BuildError('unknown target: {!r}'.format(name))
+      stack.extend(self.actions[name])
+    while stack:
+      action = stack.pop()
+      if id(action) in seen:
+        continue
+      seen.add(id(action))
+      result.append(action)
+      stack.extend(action.dependencies)
+    return result
+
+  def build(self, targets=None):
+    """
+    Build the specified *targets* and all their dependencies.
+
+    :param targets: A list of target names. Builds all targets that are
+      not explicit if omitted.
+    :raise BuildError: See :meth:`create_actions` and :meth:`collect`.
+    :return: True if the build succeeded, False if an action failed.
+    """
+
+    self.deplog.load()
+    if self.digests is not None:
+      self.digests.load()
+    if self.cache is not None:
+      self.cache.load()
+    jobs = self.jobs
+    if self.remote is not None:
+      self.remote.load()
+      if self.auto_jobs:
+        self.jobs += self.remote.slots
+    actions = self.collect(targets)
+    try:
+      return self._run(actions)
+    finally:
+      self.jobs = jobs
+      if self.remote is not None:
+        self.remote.save()
+        if self.remote.executed:
+          logger.info('craftr: {} actions executed remotely'.format(self.remote.executed))
+      self.deplog.save()
+      if self.digests is not None:
+        self.digests.save()
+      if self.cache is not None:
+        self.cache.save()
+        self.cache.report()
+
+  def _run(self, actions):
+    scheduled = set(map(id, actions))
+    waiting = {}
+    ready = []
+    for action in actions:
+      count = sum(1 for d in action.dependencies if id(d) in scheduled)
+      if count:
+        waiting[id(action)] = count
+      else:
+        heapq.heappush(ready, self._heap_item(action))
+
+    total = len(actions)
+    finished = 0
+    executed = 0
+    failed = False
+    pool_usage = {}
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool_executor:
+      while ready or running:
+        deferred = []
+        while ready and len(running) < self.jobs and not failed:
+          action = heapq.heappop(ready)[-1]
+          if action.pool and pool_usage.get(action.pool, 0) >= self.pools[action.pool]:
+            deferred.append(action)
+            continue
+          if action.pool:
+            pool_usage[action.pool] = pool_usage.get(action.pool, 0) + 1
+          running[pool_executor.submit(self.execute, action)] = action
+        for action in deferred:
+          heapq.heappush(ready, self._heap_item(action))
+        if not running:
+          break
+
+        done, __ = concurrent.futures.wait(running,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          action = running.pop(future)
+          if action.pool:
+            pool_usage[action.pool] -= 1
+          result = future.result()
+          finished += 1
+          if not result.skipped:
+            executed += 1
+            self.report(result, finished, total)
+          if result.returncode != 0:
+            self.deplog.forget(action.outputs)
+            failed = True
+            continue
+          self.finish(result)
+          for dependent in action.dependents:
+            if id(dependent) not in waiting:
+              continue
+            waiting[id(dependent)] -= 1
+            if waiting[id(dependent)] == 0:
+              del waiting[id(dependent)]
+              heapq.heappush(ready, self._heap_item(dependent))
+
+    if failed:
+      logger.error('build stopped: subcommand failed.')
+      return False
+    if executed == 0:
+      logger.info('craftr: no work to do.')
+    return True
+
+  def _heap_item(self, action):
+    return (-action.priority, id(action), action)
+
+  def execute(self, action):
+    """
+    Checks if the *action* is up to date and executes it if it is not. This
+    method is called from a worker thread.
+
+    :return: An :class:`ActionResult`.
+    """
+
+    for filename in action.inputs + action.implicit_deps:
+      if filename not in self.producers and not path.exists(filename):
+        return ActionResult(action, False, 1, "'{}', needed by '{}', missing "
+            "and no known rule to make it\n".format(filename, action.name))
+
+    if not self.is_dirty(action):
+      return ActionResult(action, True)
+
+    cacheable = self.cache is not None and self.cache.is_cacheable(action)
+    if cacheable:
+      deps = self.cache.lookup(action)
+      if deps is not None:
+        result = ActionResult(action, False, 0, '', deps)
+        result.cached = True
+      else:
+        result = self.dispatch(action)
+        if result.returncode == 0:
+          self.cache.update(action, self.get_deps(action, result.deps))
+    else:
+      result = self.dispatch(action)
+    if self.digests is not None and result.returncode == 0 and action.outputs:
+      files = action.inputs + action.implicit_deps + \
+          self.get_deps(action, result.deps) + action.outputs
+      result.digests = self.digests.digest_all(files)
+    return result
+
+  def is_dirty(self, action):
+    """
+    Returns True if the *action* needs to be executed because an output
+    file is missing or older than any of its inputs and dependencies, or
+    because its command changed since it was last executed.
+
+    If the executor checks content digests and they have been recorded for
+    the action, its files are compared by their digests instead.
+    """
+
+    if not action.outputs:
+      return True
+    entry = self.deplog.get(action.outputs[0])
+    if entry is None or entry.get('command') != action.command_hash:
+      return True
+
+    if self.digests is not None and 'digests' in entry:
+      recorded = entry['digests']
+      files = action.inputs + action.implicit_deps + entry.get('deps', []) + \
+          action.outputs
+      for filename in files:
+        digest = self.digests.digest(filename)
+        if digest is None or digest != recorded.get(filename):
+          return True
+      return False
+
+    oldest = None
+    for filename in action.outputs:
+      mtime = _get_mtime(filename)
+      if mtime is None:
+        return True
+      if oldest is None or mtime < oldest:
+        oldest = mtime
+
+    for filename in action.inputs + action.implicit_deps + entry.get('deps', []):
+      mtime = _get_mtime(filename)
+      if mtime is None or mtime > oldest:
+        return True
+    return False
+
+  def dispatch(self, action):
+    """
+    Executes the *action* on a remote worker if possible, otherwise on the
+    local machine.
+    """
+
+    if self.remote is not None:
+      if self.is_remote_executable(action):
+        result = self.run_remote(action)
+        if result is not None:
+          return result
+      with self.local_jobs:
+        return self.run_local(action)
+    return self.run_local(action)
+
+  def run_local(self, action):
+    """
+    Executes the *action* on the local machine, using a persistent worker
+    if the target supports it.
+    """
+
+    tokens = []
+    try:
+      if self.tokens is not None:
+        tokens.append(self.tokens.acquire())
+      if self.jobserver is not None:
+        tokens.append(self.jobserver.acquire())
+      return self._run_local(action)
+    finally:
+      for token in tokens:
+        token.release()
+
+  def _run_local(self, action):
+    target = action.target
+    if self.workers is not None and target.worker and len(target.commands) == 1 \
+        and not target.recursive and not target.cwd and not target.environ \
+        and action.pool != 'console':
+      try:
+        arguments = self.get_worker_arguments(action)
+        for filename in action.outputs:
+          path.makedirs(path.dirname(filename))
+        returncode, output = self.workers.run(target.worker, arguments)
+      except (ValueError, persistent.WorkerError) as exc:
+        logger.debug('craftr: persistent worker failed ({}), running "{}" '
+            'directly'.format(exc, action.name))
+      else:
+        return self.get_result(action, returncode, output)
+    return self.run_command(action)
+
+  def get_worker_arguments(self, action):
+    """
+    Returns the arguments of the command of the *action* without the
+    program, which is the first element of the target's command (a program
+    name or a :class:`build.Tool`).
+    """
+
+    program = action.target.commands[0][0]
+    if isinstance(program, build.Tool):
+      count = len(shell.split(self.variables[program.variable_name]))
+    else:
+      count = 1
+    return shell.split(action.command)[count:]
+
+  def is_remote_executable(self, action):
+    """
+    Returns True if the *action* can be executed on a remote worker. This
+    is only the case for hermetic targets that run a single command without
+    a custom working directory or environment. If the target reports its
+    dependencies, they must have been recorded in a previous build.
+    """
+
+    target = action.target
+    if not target.hermetic or target.recursive or target.cwd or target.environ:
+      return False
+    if action.pool == 'console' or not action.outputs:
+      return False
+    if target.deps == 'msvc':
+      return False
+    if target.deps and self.deplog.get(action.outputs[0]) is None:
+      return False
+    return True
+
+  def run_remote(self, action):
+    """
+    Executes the command of the *action* on a remote worker.
+
+    Only the inputs and the dependencies that were recorded in the previous
+    build are shipped to the worker, thus a compile can fail remotely
+    because of a header that the source includes since then. Failed
+    actions are therefore executed again locally, which also reports the
+    real error if there is one.
+
+    :return: An :class:`ActionResult` or :const:`None` if no worker is
+      available or the command failed on the worker.
+    """
+
+    files = action.inputs + action.implicit_deps + self.get_deps(action)
+    text_outputs = [action.depfile] if action.depfile else []
+    response = self.remote.run(action, files, text_outputs)
+    if response is None:
+      return None
+    if response[0] != 0:
+      logger.debug('craftr: "{}" failed on a worker with exit code {}, running '
+          'it locally'.format(action.name, response[0]))
+      return None
+    return self.get_result(action, *response)
+
+  def run_command(self, action):
+    """
+    Executes the command of the *action* and returns an :class:`ActionResult`.
+    """
+
+    console = (action.pool == 'console')
+    for filename in action.outputs:
+      path.makedirs(path.dirname(filename))
+    if os.name == 'nt':
+      cmd = action.command
+    else:
+      cmd = ['/bin/sh', '-c', action.command]
+
+    kwargs = {}
+    if action.target.recursive and self.jobserver is not None:
+      kwargs['env'] = self.jobserver.get_environ()
+      kwargs['pass_fds'] = self.jobserver.fds
+
+    try:
+      if console:
+        popen = subprocess.Popen(cmd, **kwargs)
+      else:
+        popen = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+      if hasattr(os, 'wait4'):
+        # Wait for the process ourselves to get its resource usage.
+        output = popen.stdout.read() if popen.stdout else None
+        if popen.stdout:
+          popen.stdout.close()
+        peak_rss, popen.returncode = _wait_process(popen.pid)
+      else:
+        peak_rss = None
+        output = popen.communicate()[0]
+    except OSError as exc:
+      return ActionResult(action, False, 127, str(exc) + '\n')
+    output = output.decode(sys.getdefaultencoding(), 'replace') if output else ''
+    result = self.get_result(action, popen.returncode, output)
+    result.peak_rss = peak_rss
+    return result
+
+  def get_result(self, action, returncode, output):
+    """
+    Creates the :class:`ActionResult` for an executed *action* and reads
+    the dependencies that it reported.
+    """
+
+    deps = None
+    if returncode == 0:
+      deps, output = self.discover_deps(action, output)
+    return ActionResult(action, False, returncode, output, deps)
+
+  def discover_deps(self, action, output):
+    """
+    Reads the dependencies of the *action* after it was executed
+    successfully, either from its depfile or, for ``deps='msvc'``, from
+    the *output* of the command.
+
+    :return: A tuple of the list of dependencies (or :const:`None`) and
+      the *output* with ``/showIncludes`` lines removed.
+    """
+
+    target = action.target
+    deps = None
+    if target.deps == 'msvc':
+      prefix = target.msvc_deps_prefix or 'Note: including file:'
+      lines = []
+      deps = []
+      for line in output.splitlines(True):
+        if line.startswith(prefix):
+          deps.append(path.norm(line[len(prefix):].strip()))
+        else:
+          lines.append(line)
+      output = ''.join(lines)
+    elif action.depfile:
+      try:
+        with open(action.depfile) as fp:
+          deps = [path.norm(x) for x in parse_depfile(fp.read())]
+      except (OSError, IOError):
+        deps = None
+      else:
+        if target.deps == 'gcc':
+          # Like Ninja, we keep the dependencies in our own log.
+          path.remove(action.depfile, silent=True)
+    return deps, output
+
+  def get_deps(self, action, deps=None):
+    """
+    Returns *deps* or, if it is :const:`None`, the dependencies of the
+    *action* that were recorded the last time it was executed.
+    """
+
+    if deps is None:
+      entry = self.deplog.get(action.outputs[0]) if action.outputs else None
+      deps = entry.get('deps', []) if entry else []
+    return deps
+
+  def finish(self, result):
+    """
+    Called in the main thread for every action that succeeded or was
+    up to date.
+    """
+
+    if result.skipped or not result.action.outputs:
+      return
+    action = result.action
+    deps = self.get_deps(action, result.deps)
+    extra = {}
+    if result.digests is not None:
+      extra['digests'] = result.digests
+    peak_rss = result.peak_rss
+    if not peak_rss:
+      # Keep the measurement of a previous build, eg. if the outputs were
+      # restored from the cache or the action was executed remotely.
+      entry = self.deplog.get(action.outputs[0])
+      peak_rss = entry.get('peak_rss') if entry else None
+    if peak_rss:
+      extra['peak_rss'] = peak_rss
+      extra['pool'] = action.pool
+    for filename in action.outputs:
+      self.deplog.record(filename, action.command_hash, deps, **extra)
+
+  def report(self, result, finished, total):
+    """
+    Print the status of an executed action.
+    """
+
+    action = result.action
+    text = action.command if self.verbose else action.description
+    if result.cached:
+      text += ' (cached)'
+    logger.info('[{}/{}] {}'.format(finished, total, text))
+    if result.returncode != 0:
+      logger.error('FAILED: {}'.format(' '.join(action.outputs) or action.name))
+      logger.error(action.command)
+    if result.output:
+      sys.stdout.write(result.output)
+      if not result.output.endswith('\n'):
+        sys.stdout.write('\n')
+      sys.stdout.flush()
+
+
+def _wait_process(pid):
+  """
+  Waits for the child process with the specified *pid* to terminate.
+
+  :return: A tuple of the peak resident set size of the process in bytes
+    and its return code (negative if it was terminated by a signal).
+  """
+
+  while True:
+    try:
+      __, status, rusage = os.wait4(pid, 0)
+      break
+    except InterruptedError:
+      continue
+  if os.WIFSIGNALED(status):
+    returncode = -os.WTERMSIG(status)
+  else:
+    returncode = os.WEXITSTATUS(status)
+  # ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+  peak_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+  return peak_rss, returncode
+
+
+def _get_mtime(filename):
+  try:
+    return os.stat(filename).st_mtime_ns
+  except OSError:
+    return None
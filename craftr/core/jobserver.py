@@ -0,0 +1,213 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.jobserver`
+============================
+
+An implementation of the GNU make jobserver protocol, so that nested
+builds (eg. ``make`` or ``cmake --build`` invoked by a target with
+``recursive=True``) share the job budget of the Craftr build instead of
+running serially or oversubscribing the machine.
+
+The jobserver is a pipe that contains one byte for every job that may be
+started in addition to the one job that every participant may always run
+(the implicit token). The file descriptors of the pipe are passed to the
+nested builds with the ``MAKEFLAGS`` environment variable. If Craftr itself
+is invoked by ``make``, :meth:`Jobserver.from_environ` joins the jobserver
+of the parent instead.
+"""
+
+import os
+import re
+import select
+import threading
+
+#: The number of seconds to wait for a token in the pipe before checking
+#: if the implicit token was released in the meantime.
+POLL_INTERVAL = 0.05
+
+
+class Token(object):
+  """
+  A job token that was acquired from a :class:`Jobserver`. It must be
+  released with :meth:`release` or by using it as a context manager.
+  """
+
+  def __init__(self, jobserver, byte):
+    self.jobserver = jobserver
+    self.byte = byte
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.release()
+
+  def release(self):
+    if self.jobserver is not None:
+      self.jobserver._release(self.byte)
+      self.jobserver = None
+
+
+class Jobserver(object):
+  """
+  A GNU make jobserver. If no file descriptors are specified, a new
+  jobserver with *jobs* tokens is created, otherwise the jobserver that
+  the file descriptors refer to is joined.
+
+  :param jobs: The total number of jobs, including the implicit token.
+  :param fds: A tuple of the read and write file descriptors of an
+    existing jobserver.
+  :param makeflags: The ``MAKEFLAGS`` of the existing jobserver that will
+    be passed on to nested builds.
+  :param implicit: False if this process does not own the implicit token,
+    eg. because it only starts Ninja, whose commands take their tokens
+    from the pipe (see :mod:`craftr.core.jobwrapper`). A new jobserver
+    then puts all *jobs* tokens into the pipe.
+  :raise RuntimeError: If the platform does not support the jobserver.
+
+  .. attribute:: jobs
+
+    The number of jobs of the jobserver, or :const:`None` if it was joined
+    and the number is unknown.
+  """
+
+  def __init__(self, jobs=None, fds=None, makeflags=None, implicit=True):
+    if os.name == 'nt':
+      raise RuntimeError('the make jobserver is not supported on this platform')
+    self.jobs = jobs
+    self._implicit = implicit
+    self._lent = False
+    self._lock = threading.Lock()
+    self._read_lock = threading.Lock()
+    if fds is None:
+      if not jobs or jobs < 1:
+        raise ValueError('invalid number of jobs: {!r}'.format(jobs))
+      self.read_fd, self.write_fd = os.pipe()
+      self.owner = True
+      os.write(self.write_fd, b'+' * (jobs - 1 if implicit else jobs))
+      self.makeflags = ' -j{0} --jobserver-fds={1},{2} --jobserver-auth={1},{2}'.format(
+          jobs, self.read_fd, self.write_fd)
+    else:
+      self.read_fd, self.write_fd = fds
+      self.owner = False
+      self.makeflags = makeflags
+
+  @classmethod
+  def from_environ(cls, environ=None):
+    """
+    Join the jobserver of a parent ``make`` process that is specified in
+    the ``MAKEFLAGS`` of the *environ* (defaults to :data:`os.environ`).
+
+    :return: A :class:`Jobserver` or :const:`None` if there is no jobserver
+      or its file descriptors were not inherited.
+    """
+
+    if os.name == 'nt':
+      return None
+    makeflags = (environ if environ is not None else os.environ).get('MAKEFLAGS', '')
+    match = re.search(r'--jobserver-(?:auth|fds)=(\d+),(\d+)', makeflags)
+    if not match:
+      return None
+    fds = (int(match.group(1)), int(match.group(2)))
+    try:
+      for fd in fds:
+        os.fstat(fd)
+    except OSError:
+      return None
+    return cls(fds=fds, makeflags=makeflags)
+
+  @property
+  def fds(self):
+    return (self.read_fd, self.write_fd)
+
+  def get_environ(self, environ=None):
+    """
+    Returns a copy of the *environ* (defaults to :data:`os.environ`) with
+    the ``MAKEFLAGS`` that pass this jobserver to nested builds.
+    """
+
+    environ = dict(os.environ if environ is None else environ)
+    environ['MAKEFLAGS'] = self.makeflags
+    return environ
+
+  def acquire(self):
+    """
+    Acquire a job token, waiting until one is available. The implicit
+    token is used first, if this process owns it.
+
+    :return: A :class:`Token`.
+    """
+
+    while True:
+      with self._lock:
+        if self._implicit:
+          self._implicit = False
+          return Token(self, None)
+      # Only one thread reads from the pipe at a time. We don't block in
+      # the read so that we notice when the implicit token is released.
+      if not self._read_lock.acquire(timeout=POLL_INTERVAL):
+        continue
+      try:
+        if not select.select([self.read_fd], [], [], POLL_INTERVAL)[0]:
+          continue
+        try:
+          byte = os.read(self.read_fd, 1)
+        except InterruptedError:
+          continue
+        if not byte:
+          raise RuntimeError('jobserver pipe was closed')
+        return Token(self, byte)
+      finally:
+        self._read_lock.release()
+
+  def lend_implicit(self):
+    """
+    Put the implicit token of this process into the pipe of a joined
+    jobserver, for a process that does not run jobs itself but only
+    starts Ninja, whose commands take their tokens from the pipe (see
+    :mod:`craftr.core.jobwrapper`). :meth:`close` takes the token back.
+    A new jobserver created with *implicit* set to False already contains
+    this token.
+    """
+
+    if not self.owner and not self._lent:
+      os.write(self.write_fd, b'+')
+      self._lent = True
+
+  def _release(self, byte):
+    if byte is None:
+      with self._lock:
+        self._implicit = True
+    else:
+      os.write(self.write_fd, byte)
+
+  def close(self):
+    """
+    Close the pipe of the jobserver if it was created by this object.
+    A token lent with :meth:`lend_implicit` is taken back from the pipe of
+    a joined jobserver first, waiting until one is available.
+    """
+
+    if self._lent:
+      self._lent = False
+      with self._lock:
+        self._implicit = False
+      self.acquire()
+    if self.owner and self.read_fd is not None:
+      os.close(self.read_fd)
+      os.close(self.write_fd)
+      self.read_fd = self.write_fd = None
@@ -0,0 +1,221 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.jobtokens`
+============================
+
+A host-wide limit for the number of jobs that all Craftr builds on a
+machine execute at the same time. The :class:`TokenPool` consists of a
+fixed number of slot files in a shared directory. A job token is the
+exclusive :func:`fcntl.flock` lock of one of these files, thus tokens are
+released automatically by the operating system if a build is killed.
+
+.. code:: python
+
+  pool = TokenPool('/tmp/craftr-jobtokens', 8)
+  with pool.acquire():
+    subprocess.call(command)
+
+Since other users can write to the shared directory, it must be owned by
+the current user or root and have the sticky bit set, the slot files are
+opened without following symbolic links and only files that the pool
+created itself are made accessible to other users.
+"""
+
+import errno
+import os
+import random
+import stat
+import tempfile
+import time
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+#: The default directory of the slot files, shared by all users.
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'craftr-jobtokens')
+
+#: The flags to open existing slot files with. Without ``O_NONBLOCK``,
+#: opening a FIFO that was planted in place of a slot would block.
+_OPEN_FLAGS = os.O_RDWR | getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_NONBLOCK', 0)
+
+#: The maximum number of seconds to wait before trying to acquire a token
+#: again if all slots are in use.
+POLL_INTERVAL = 0.1
+
+
+class Token(object):
+  """
+  A job token that was acquired from a :class:`TokenPool`. It must be
+  released with :meth:`release` or by using it as a context manager.
+
+  .. attribute:: slot
+
+    The index of the slot that this token locks.
+  """
+
+  def __init__(self, fd, slot):
+    self.fd = fd
+    self.slot = slot
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.release()
+
+  def release(self):
+    if self.fd is not None:
+      fcntl.flock(self.fd, fcntl.LOCK_UN)
+      os.close(self.fd)
+      self.fd = None
+
+
+def get_user_directory():
+  """
+  Returns the directory of a pool that is private to the current user,
+  for when the shared directory can not be used safely.
+  """
+
+  base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+  return os.path.join(base, 'craftr-jobtokens-{}'.format(os.getuid()))
+
+
+def check_directory(directory):
+  """
+  Check that the slot files in *directory* can not be replaced by other
+  users: it must be a real directory that is owned by the current user or
+  root, and if other users can write to it, it must have the sticky bit
+  set.
+
+  :raise PermissionError: If the directory is not safe to use.
+  :raise OSError: If the directory does not exist.
+  """
+
+  st = os.lstat(directory)
+  if not stat.S_ISDIR(st.st_mode):
+    raise PermissionError('"{}" is not a directory'.format(directory))
+  if st.st_uid not in (0, os.getuid()):
+    raise PermissionError('"{}" is not owned by the current user or root'.format(directory))
+  mode = stat.S_IMODE(st.st_mode)
+  if mode & (stat.S_IWGRP | stat.S_IWOTH) and not mode & stat.S_ISVTX:
+    raise PermissionError('"{}" is writable by other users but does not have '
+        'the sticky bit set (mode {:04o})'.format(directory, mode))
+
+
+class TokenPool(object):
+  """
+  A pool of *slots* job tokens that is shared by all processes using the
+  same *directory*.
+
+  :param directory: The directory that contains the slot files. If it
+    does not exist, it is created with mode 1777 if *shared* is True,
+    otherwise with mode 0700. It is checked with :func:`check_directory`.
+  :param slots: The number of jobs that may run at the same time on the
+    machine.
+  :param shared: True if the slot files should be usable by all users.
+  :raise RuntimeError: If the platform does not support :mod:`fcntl`.
+  :raise PermissionError: If the *directory* is not safe to use.
+  """
+
+  def __init__(self, directory, slots, shared=True):
+    if fcntl is None:
+      raise RuntimeError('host-wide job tokens are not supported on this platform')
+    if slots < 1:
+      raise ValueError('invalid number of job token slots: {!r}'.format(slots))
+    self.directory = directory
+    self.slots = slots
+    self.shared = shared
+    mode = 0o1777 if shared else 0o700
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    try:
+      os.mkdir(directory, mode)
+    except FileExistsError:
+      pass
+    else:
+      os.chmod(directory, mode)  # not restricted by the umask
+    check_directory(directory)
+
+  def _open_slot(self, slot):
+    filename = os.path.join(self.directory, 'slot-{}.lock'.format(slot))
+    mode = 0o666 if self.shared else 0o600
+    try:
+      try:
+        fd = os.open(filename, _OPEN_FLAGS | os.O_CREAT | os.O_EXCL, mode)
+        created = True
+      except FileExistsError:
+        fd = os.open(filename, _OPEN_FLAGS)
+        created = False
+    except OSError as exc:
+      if exc.errno == errno.ELOOP:
+        raise PermissionError('"{}" is a symbolic link'.format(filename))
+      raise
+    try:
+      if not stat.S_ISREG(os.fstat(fd).st_mode):
+        raise PermissionError('"{}" is not a regular file'.format(filename))
+      if created:
+        os.fchmod(fd, mode)  # not restricted by the umask
+    except BaseException:
+      os.close(fd)
+      raise
+    return fd
+
+  def try_acquire(self):
+    """
+    Acquire a token if a slot is free.
+
+    :return: A :class:`Token` or :const:`None` if all slots are in use.
+    """
+
+    # Start at a random slot so concurrent builds don't all compete for
+    # the first slots.
+    offset = random.randrange(self.slots)
+    for index in range(self.slots):
+      slot = (offset + index) % self.slots
+      try:
+        fd = self._open_slot(slot)
+      except (PermissionError, FileNotFoundError):
+        # Slots that another user made unusable are skipped. A slot file
+        # that was removed after the exclusive create failed is tried
+        # again the next time.
+        continue
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        os.close(fd)
+        continue
+      except BaseException:
+        os.close(fd)
+        raise
+      return Token(fd, slot)
+    return None
+
+  def acquire(self):
+    """
+    Acquire a token, waiting until a slot is free.
+
+    :return: A :class:`Token`.
+    """
+
+    delay = 0.005
+    while True:
+      token = self.try_acquire()
+      if token is not None:
+        return token
+      time.sleep(delay)
+      delay = min(delay * 2, POLL_INTERVAL)
@@ -0,0 +1,171 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.jobwrapper`
+=============================
+
+Ninja can not take job tokens by itself, thus the commands in a Ninja
+manifest are wrapped with this module when they need to share a job
+budget:
+
+.. code:: sh
+
+  python -m craftr.core.jobwrapper [--recursive] -- command args...
+
+If the ``CRAFTR_JOBTOKENS`` environment variable is set (see
+:func:`get_environ`), a host-wide job token is taken from the
+:class:`~craftr.core.jobtokens.TokenPool` before the command is started.
+If the ``CRAFTR_JOBSERVER`` environment variable contains the file
+descriptors of a GNU make jobserver, a token is taken from it as well.
+The tokens are returned when the command exits. Only commands with
+``--recursive`` receive the jobserver in their ``MAKEFLAGS``, the token of
+the wrapper is the implicit token of the nested build. Without these
+variables, the command is executed directly.
+
+This module must only import modules that are cheap to import, since it
+is started for every command.
+"""
+
+from craftr.core.jobserver import Jobserver
+from craftr.core.jobtokens import TokenPool
+
+import os
+import signal
+import sys
+
+#: The environment variable that contains the file descriptors of the
+#: jobserver of the build.
+JOBSERVER_VAR = 'CRAFTR_JOBSERVER'
+
+#: The environment variable that contains the ``MAKEFLAGS`` for the
+#: commands of recursive targets.
+MAKEFLAGS_VAR = 'CRAFTR_MAKEFLAGS'
+
+#: The environment variable that contains the number of slots and the
+#: directory of the host-wide :class:`TokenPool`.
+JOBTOKENS_VAR = 'CRAFTR_JOBTOKENS'
+
+
+def get_command(recursive=False):
+  """
+  Returns the arguments that are prepended to a command to wrap it.
+  """
+
+  result = [sys.executable, '-m', 'craftr.core.jobwrapper']
+  if recursive:
+    result.append('--recursive')
+  return result + ['--']
+
+
+def get_environ(jobserver, tokens=None, environ=None):
+  """
+  Returns a copy of the *environ* (defaults to :data:`os.environ`) for a
+  Ninja process whose commands are wrapped with this module. If a
+  *jobserver* is passed, the ``MAKEFLAGS`` are removed, so that only
+  recursive targets receive it.
+
+  :param jobserver: A :class:`Jobserver` or :const:`None`.
+  :param tokens: A :class:`TokenPool` or :const:`None`.
+  """
+
+  environ = dict(os.environ if environ is None else environ)
+  if jobserver is not None:
+    environ.pop('MAKEFLAGS', None)
+    environ.pop('MFLAGS', None)
+    environ[JOBSERVER_VAR] = '{},{}'.format(*jobserver.fds)
+    environ[MAKEFLAGS_VAR] = jobserver.makeflags
+  if tokens is not None:
+    environ[JOBTOKENS_VAR] = '{}:{}'.format(tokens.slots, tokens.directory)
+  return environ
+
+
+def _run(args, environ):
+  pid = os.fork()
+  if pid == 0:
+    try:
+      os.execvpe(args[0], args, environ)
+    except OSError as exc:
+      sys.stderr.write('{}: {}\n'.format(args[0], exc.strerror))
+    os._exit(127)
+
+  # The command receives the signals of the terminal by itself.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  while True:
+    try:
+      __, status = os.waitpid(pid, 0)
+      break
+    except InterruptedError:
+      pass
+  if os.WIFSIGNALED(status):
+    return 128 + os.WTERMSIG(status)
+  return os.WEXITSTATUS(status)
+
+
+def main(argv=None):
+  args = list(sys.argv[1:] if argv is None else argv)
+  recursive = False
+  if args and args[0] == '--recursive':
+    recursive = True
+    args.pop(0)
+  if args and args[0] == '--':
+    args.pop(0)
+  if not args:
+    sys.stderr.write('usage: python -m craftr.core.jobwrapper [--recursive] -- command...\n')
+    return 2
+
+  environ = dict(os.environ)
+  fds = environ.pop(JOBSERVER_VAR, None)
+  makeflags = environ.pop(MAKEFLAGS_VAR, None)
+  pool = environ.pop(JOBTOKENS_VAR, None)
+  jobserver = None
+  if pool:
+    slots, __, directory = pool.partition(':')
+    try:
+      pool = TokenPool(directory, int(slots))
+    except (ValueError, RuntimeError):
+      sys.stderr.write('craftr: invalid {}: {!r}\n'.format(JOBTOKENS_VAR, pool))
+      return 2
+    except OSError as exc:
+      sys.stderr.write('craftr: can not use job tokens: {}\n'.format(exc))
+      return 2
+  if fds:
+    try:
+      jobserver = Jobserver(fds=tuple(map(int, fds.split(','))),
+          makeflags=makeflags, implicit=False)
+    except ValueError:
+      sys.stderr.write('craftr: invalid {}: {!r}\n'.format(JOBSERVER_VAR, fds))
+      return 2
+    if recursive:
+      environ['MAKEFLAGS'] = makeflags
+
+  if jobserver is None and not pool:
+    os.execvpe(args[0], args, environ)
+
+  # The same order as in the native executor, the host-wide token first.
+  tokens = []
+  try:
+    if pool:
+      tokens.append(pool.acquire())
+    if jobserver is not None:
+      tokens.append(jobserver.acquire())
+    return _run(args, environ)
+  finally:
+    for token in tokens:
+      token.release()
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -20,6 +20,7 @@ import abc
 import contextlib
 import itertools
 import sys
+import threading
 import time
 import werkzeug
 
@@ -55,6 +56,16 @@ class BaseLogger(object, metaclass=abc.ABCMeta):
     finally:
       self.add_indent(-1)
 
+  @contextlib.contextmanager
+  def task(self, label):
+    """
+    Mark the output of the current thread as belonging to the task with the
+    specified *label* while the context is active. This is used when
+    multiple tasks run concurrently in threads (see :meth:`progress_begin`).
+    """
+
+    yield
+
   @abc.abstractmethod
   def log(self, level, *object, sep=' ', end='\n', indent=0):
     pass
@@ -93,58 +104,112 @@ class DefaultLogger(BaseLogger):
     self._stream = stream or sys.stdout
     self._level = level
     self._indent_seq = indent_seq
-    self._indent = 0
-    self._progress = None
+    self._local = threading.local()
+    self._lock = threading.RLock()
+    self._progress = {}  # maps thread idents to progress information
     self._line_alive = False
 
+  @property
+  def _indent(self):
+    return getattr(self._local, 'indent', 0)
+
+  @property
+  def _label(self):
+    return getattr(self._local, 'label', None)
+
   def log(self, level, *objects, sep=' ', end='\n', indent=0):
     if level < self._level:
       return
-    if self._progress:
-      tty.clear_line()
-    prefix = '' if self._line_alive else self._indent_seq * (self._indent + indent)
-    prefix += tty.compile(self.level_colors[level])
-    content = sep.join(map(str, objects))
-    for line in content.split('\n'):
-      print(prefix + line + tty.reset, end=end, file=self._stream)
-    self._line_alive = ('\n' not in end)
-    if self._progress and 'progress' in self._progress:
-      self.progress_update(self._progress['progress'], self._progress['info_text'], _force=True)
+    with self._lock:
+      if self._progress:
+        tty.clear_line()
+      prefix = '' if self._line_alive else self._indent_seq * (self._indent + indent)
+      if self._label and not self._line_alive:
+        prefix = '[{}] '.format(self._label) + prefix
+      prefix += tty.compile(self.level_colors[level])
+      content = sep.join(map(str, objects))
+      for line in content.split('\n'):
+        print(prefix + line + tty.reset, end=end, file=self._stream)
+      self._line_alive = ('\n' not in end)
+      if any('progress' in x for x in self._progress.values()):
+        self._render_progress()
 
   def add_indent(self, levels):
-    self._indent += levels
+    self._local.indent = self._indent + levels
+
+  @contextlib.contextmanager
+  def task(self, label):
+    old_label, old_indent = self._label, self._indent
+    self._local.label = label
+    self._local.indent = 0
+    try:
+      yield
+    finally:
+      if threading.get_ident() in self._progress:
+        self.progress_end()
+      self._local.label = old_label
+      self._local.indent = old_indent
 
   def progress_begin(self, description=None, spinning=False):
-    self._progress = {'description': description, 'spinning': spinning,
-      'index': 0, 'last': 0}
+    with self._lock:
+      self._progress[threading.get_ident()] = {'description': description,
+        'spinning': spinning, 'index': 0, 'last': 0, 'label': self._label}
     if description:
       self.info(description)
 
   def progress_update(self, progress, info_text='', *, _force=False):
-    if not self._progress:
-      return
-    info_text = str(info_text)
-    self._progress['progress'] = progress
-    self._progress['info_text'] = info_text
-    ctime = time.time()
-    if not _force and ctime - self._progress['last'] < 0.25:
-      return
+    with self._lock:
+      state = self._progress.get(threading.get_ident())
+      if not state:
+        return
+      state['progress'] = progress
+      state['info_text'] = str(info_text)
+      ctime = time.time()
+      if not _force and ctime - state['last'] < 0.25:
+        return
+      state['index'] += 1
+      state['last'] = ctime
+      self._render_progress()
+
+  def _format_bar(self, state, width):
+    if state['spinning']:
+      sign = ('~--', '-~-', '--~')[state['index'] % 3]
+      return ''.join(itertools.islice(itertools.cycle(sign), width))
+    intprogress = int(min([1.0, max([0.0, float(state['progress'] or 0.0)])]) * width)
+    return '#' * intprogress + ' ' * (width - intprogress)
+
+  def _render_progress(self):
+    # A single task is displayed with a wide bar. Concurrent tasks (eg.
+    # loaders that download sources in threads) share the line, each with
+    # a shorter bar and its label.
+    states = [x for x in self._progress.values() if 'progress' in x]
     tty.clear_line()
-    width = 30
-    if self._progress['spinning']:
-      sign = ('~--', '-~-', '--~')[self._progress['index'] % 3]
-      bar = ''.join(itertools.islice(itertools.cycle(sign), width))
+    if not states:
+      return
+    if len(states) == 1:
+      state = states[0]
+      prefix = self._indent_seq * self._indent
+      if state['label']:
+        prefix = '[{}] '.format(state['label'])
+      line = '{}|{}| {}'.format(prefix, self._format_bar(state, 30),
+          state['info_text'])
     else:
-      intprogress = int(min([1.0, max([0.0, float(progress)])]) * width)
-      bar = '#' * intprogress + ' ' * (width - intprogress)
-    indent = self._indent_seq * self._indent
-    print('{}|{}| {}'.format(indent, bar, info_text), end='', file=self._stream)
-    self._progress['index'] += 1
-    self._progress['last'] = ctime
+      states.sort(key=lambda x: x['label'] or '')
+      line = '  '.join('{} |{}| {}'.format(x['label'] or '?',
+          self._format_bar(x, 10), x['info_text']) for x in states)
+      try:
+        width = tty.terminal_size()[0]
+      except (OSError, ValueError):
+        width = 80
+      line = line[:max(width - 1, 0)]
+    print(line, end='', file=self._stream)
 
   def progress_end(self):
-    tty.clear_line()
-    self._progress = None
+    with self._lock:
+      self._progress.pop(threading.get_ident(), None)
+      tty.clear_line()
+      if self._progress:
+        self._render_progress()
 
   def set_level(self, level):
     self._level = level
@@ -51,23 +51,35 @@ Example manifest:
   }
 """
 
+from craftr.core import digest
+from craftr.core import dlcache
+from craftr.core import vendor
 from craftr.core.logging import logger
 from craftr.utils import httputils
 from craftr.utils import path
 from craftr.utils import pyutils
+from craftr.utils import shell
+from craftr.utils import tarstream
+from craftr.utils import zipextract
 from nr.types.recordclass import recordclass
 from nr.types.version import Version, VersionCriteria
 
 import abc
-import fnmatch
+import hashlib
 import io
 import json
 import jsonschema
 import nr.misc.archive
+import os
 import re
 import string
+import urllib.parse
 import urllib.request
 
+#: The number of seconds after which a mirror of a :class:`UrlLoader` is
+#: considered unavailable if it did not respond.
+MIRROR_TIMEOUT = 10
+
 
 def validate_package_name(name):
   """
@@ -432,13 +444,33 @@ class LoaderContext(object):
   .. attribute:: options
 
   .. attribute:: installdir
+
+  .. attribute:: host_latency
+
+    A dictionary that maps host names to the number of seconds that they
+    took to respond to a request in previous runs. It is stored in the
+    cache of the session.
+
+  .. attribute:: download_cache
+
+    A :class:`craftr.core.dlcache.DownloadCache` that downloaded archives
+    and their extracted trees are shared in, or :const:`None`.
+
+  .. attribute:: vendor_bundle
+
+    A :class:`craftr.core.vendor.VendorBundle` that loaders should take
+    their sources from instead of the network, or :const:`None`.
   """
 
-  def __init__(self, directory, manifest, options, installdir):
+  def __init__(self, directory, manifest, options, installdir, host_latency=None,
+      download_cache=None, vendor_bundle=None):
     self.directory = directory
     self.manifest = manifest
     self.options = options
     self.installdir = installdir
+    self.host_latency = {} if host_latency is None else host_latency
+    self.download_cache = download_cache
+    self.vendor_bundle = vendor_bundle
 
   def expand_variables(self, value):
     templ = string.Template(value)
@@ -459,8 +491,16 @@ class BaseLoader(object, metaclass=abc.ABCMeta):
   are defined in the :class:`Manifest` until one loader succeeds. This happens
   in the same step in which dependencies are satisfied. In the execute step,
   the loader will be initialized from cache.
+
+  .. attribute:: vendor_key
+
+    A string that identifies the sources that the loader loaded into its
+    ``directory`` in a vendor bundle (see :mod:`craftr.core.vendor`), or
+    :const:`None` if the loader has nothing to vendor.
   """
 
+  vendor_key = None
+
   def __init__(self, name):
     self.name = name
 
@@ -503,8 +543,14 @@ class UrlLoader(BaseLoader):
       ]
     }
 
+  An optional ``sha256`` can be specified to verify downloaded and local
+  archives. It may contain variables as well, so that it can be specified
+  together with a version option.
+
   .. attribute:: urls
 
+  .. attribute:: sha256
+
   .. attribute:: directory
 
     If the UrlLoader successfully loaded the source archives or detected the
@@ -512,11 +558,13 @@ class UrlLoader(BaseLoader):
     where the sources are located.
   """
 
-  def __init__(self, name, urls, unpack_exclude=()):
+  def __init__(self, name, urls, unpack_exclude=(), sha256=None):
     super().__init__(name)
     self.urls = urls
     self.directory = None
     self.unpack_exclude = unpack_exclude
+    self.sha256 = sha256
+    self._unpack_exclude_re = zipextract.compile_patterns(unpack_exclude)
 
   def load(self, context, cache):
     if cache is not None and path.isdir(cache.get('directory', '')):
@@ -524,6 +572,7 @@ class UrlLoader(BaseLoader):
       url_template = context.expand_variables(cache.get('url_template', ''))
       if url_template == cache.get('url'):
         self.directory = cache['directory']
+        self.vendor_key = self._get_vendor_key(cache.get('url'))
         logger.info('Reusing cached directory: {}'.format(
             path.rel(self.directory, nopar=True)))
         return cache
@@ -532,73 +581,184 @@ class UrlLoader(BaseLoader):
 
     directory = None
     archive = None
-    delete_after_extract = True
+    url = None
+    sha256 = context.expand_variables(self.sha256) if self.sha256 else None
+
+    # Local files and directories are checked first, the remaining URLs
+    # are raced against each other.
+    templates = {}
     for url_template in self.urls:
       url = context.expand_variables(url_template)
       if not url: continue
-      if url.startswith('file://'):
-        name = url[7:]
-        if path.isdir(name):
-          logger.info('Using directory', url)
-          directory = name
-          break
-        elif path.isfile(name):
-          logger.info('Using archive', url)
-          archive = name
-          delete_after_extract = False
-          break
-        error = None
+      if not url.startswith('file://'):
+        templates.setdefault(url, url_template)
+        continue
+      name = url[7:]
+      if path.isdir(name):
+        logger.info('Using directory', url)
+        directory = name
+        break
+      elif path.isfile(name):
+        if sha256 and digest.hash_file(name, 'sha256') != sha256.lower():
+          logger.info('SHA256 mismatch for archive', url)
+          continue
+        logger.info('Using archive', url)
+        archive = name
+        break
+
+    # Sources in the vendor bundle don't need network access.
+    vendor_bundle = context.vendor_bundle
+    if not directory and not archive and vendor_bundle and templates:
+      key, entry = vendor_bundle.find(list(templates))
+      if key:
+        url, url_template = key, templates[key]
+        directory = path.join(context.installdir, entry['name'])
+        logger.info('Extracting {} from "{}"'.format(url, vendor_bundle.filename))
+        try:
+          vendor_bundle.extract(key, directory)
+        except vendor.VendorError as exc:
+          raise LoaderError(self, str(exc))
       else:
-        error = None
+        logger.info('Not in the vendor bundle, using the network')
+
+    # Downloads are shared between build directories through the download
+    # cache, if it is enabled.
+    download_cache = context.download_cache
+    variant = self._get_unpack_variant()
+    archive_digest = None
+    tree = None
+    if not directory and not archive and download_cache and sha256 and templates:
+      # Archives with a known hash don't need to contact the mirrors.
+      url, url_template = next(iter(templates.items()))
+      tree = download_cache.find_tree(sha256.lower(), variant)
+      archive = download_cache.find_blob(sha256.lower())
+      if tree or archive:
+        archive_digest = sha256.lower()
+        logger.info('Reusing cached download', url)
+    if not directory and not archive and not tree:
+      for url in self._race_mirrors(context, list(templates)):
+        url_template = templates[url]
+        # Tar archives are extracted while they are downloaded.
+        filename = path.basename(urllib.parse.urlsplit(url).path)
+        suffix, mode = tarstream.get_stream_mode(filename)
+        progress = lambda d: self._download_progress(url, context, d,
+            check_exists = download_cache is None and mode is None)
+        reused = False
         try:
-          progress = lambda d: self._download_progress(url, context, d)
-          archive, reused = httputils.download_file(
-            url, directory = context.get_temporary_directory(),
-            on_exists='skip', progress=progress)
-        except (httputils.URLError, httputils.HTTPError) as exc:
-          error = exc
+          if download_cache and mode:
+            tree, archive_digest = download_cache.fetch_tree(url, mode, sha256,
+                variant, self._check_extract_file, progress)
+          elif mode:
+            directory = self._stream_archive(context, url, filename, suffix,
+                mode, sha256, progress)
+          elif download_cache:
+            archive, archive_digest = download_cache.fetch(url, sha256, progress)
+          else:
+            archive, reused = httputils.download_file(
+              url, directory = context.get_temporary_directory(),
+              on_exists='skip', progress=progress, sha256=sha256)
+        except (httputils.URLError, httputils.HTTPError,
+            httputils.ChecksumError, tarstream.ExtractError) as exc:
+          logger.info('Error reading', url, ':', exc)
         except self.DownloadAlreadyExists as exc:
           directory = exc.directory
           logger.info('Reusing existing directory', directory)
+          break
         else:
           if reused:
             logger.info('Reusing cached download', path.basename(archive))
           break
 
-      if error:
-        logger.info('Error reading', url, ':', error)
-
-    if directory or archive:
+    if directory or archive or tree:
       logger.debug('URL applies: {}'.format(url))
 
-    if not directory and archive:
-      suffix, directory = self._get_archive_unpack_info(context, archive)
-      logger.info('Unpacking "{}" to "{}" ...'.format(
-          path.rel(archive, nopar=True), path.rel(directory, nopar=True)))
-      nr.misc.archive.extract(archive, directory, suffix=suffix,
-          unpack_single_dir=True, check_extract_file=self._check_extract_file,
-          progress_callback=self._extract_progress)
+    if not directory and (archive or tree):
+      if archive:
+        suffix, directory = self._get_archive_unpack_info(context, archive)
+      else:
+        filename = path.basename(urllib.parse.urlsplit(url).path)
+        suffix = tarstream.get_stream_mode(filename)[0]
+        directory = self._get_unpack_directory(context, filename, suffix)
+      if archive_digest:
+        if not tree:
+          tree = download_cache.extract(archive, archive_digest, suffix, variant,
+              check_extract_file=self._check_extract_file,
+              progress_callback=self._extract_progress)
+        logger.info('Linking "{}" to "{}"'.format(tree, path.rel(directory, nopar=True)))
+        download_cache.link(tree, directory)
+      else:
+        if os.path.islink(directory):
+          os.remove(directory)  # don't extract into a shared tree
+        logger.info('Unpacking "{}" to "{}" ...'.format(
+            path.rel(archive, nopar=True), path.rel(directory, nopar=True)))
+        if suffix == '.zip':
+          extracted, skipped = zipextract.extract(archive, directory,
+              unpack_single_dir=True, check_extract_file=self._check_extract_file,
+              progress_callback=self._extract_progress)
+          logger.debug('{} files extracted, {} up to date'.format(extracted, skipped))
+        else:
+          nr.misc.archive.extract(archive, directory, suffix=suffix,
+              unpack_single_dir=True, check_extract_file=self._check_extract_file,
+              progress_callback=self._extract_progress)
     elif not directory:
       raise LoaderError(self, 'no URL matched')
 
     self.directory = directory
-    with open(path.join(self.directory, '.craftr_downloadurl'), 'w') as fp:
-      fp.write(url)
+    self.vendor_key = self._get_vendor_key(url)
+    if not archive_digest:
+      # The shared trees of the download cache are never modified.
+      with open(path.join(self.directory, '.craftr_downloadurl'), 'w') as fp:
+        fp.write(url)
     return {'directory': directory, 'url_template': url_template, 'url': url}
 
-  def _download_progress(self, url, context, data):
+  def _get_vendor_key(self, url):
+    # Local directories and archives are not vendored.
+    if not url or url.startswith('file://'):
+      return None
+    return url
+
+  def _race_mirrors(self, context, urls):
+    """
+    Yields the *urls* in the order in which their servers respond, starting
+    with the hosts that had the lowest latency in previous runs (see
+    :func:`httputils.race_urls`). The latencies are remembered in the
+    :attr:`LoaderContext.host_latency`.
+    """
+
+    if len(urls) < 2:
+      for url in urls:
+        yield url
+      return
+
+    latency = context.host_latency
+    host = lambda url: urllib.parse.urlsplit(url).netloc
+    order = sorted(range(len(urls)), key=lambda i: (
+        host(urls[i]) not in latency, latency.get(host(urls[i]), 0), i))
+    for url, elapsed, error in httputils.race_urls([urls[i] for i in order],
+        timeout=MIRROR_TIMEOUT):
+      if error is not None:
+        elapsed = MIRROR_TIMEOUT  # sort unavailable hosts last next time
+      previous = latency.get(host(url))
+      latency[host(url)] = elapsed if previous is None else (previous + elapsed) / 2
+      if error is not None:
+        logger.info('Error reading', url, ':', error)
+      else:
+        logger.debug('{} responded in {:.0f} ms'.format(url, elapsed * 1000))
+        yield url
+
+  def _download_progress(self, url, context, data, check_exists=True):
     spinning = data['size'] is None
-    if data['downloaded'] == 0:
+    if data['begin'] and check_exists:
       # If what we're trying to download already exists, we don't have
       # to redownload it.
       suffix, directory = self._get_archive_unpack_info(context, data['filename'])
-      urlfile = path.join(directory, '.craftr_downloadurl')
-      if path.isfile(urlfile):
-        with open(urlfile) as fp:
-          if fp.read().strip() == url:
-            raise self.DownloadAlreadyExists(directory)
+      self._check_download_exists(directory, url)
 
-      logger.progress_begin('Downloading {}'.format(url), spinning)
+    if data['begin']:
+      if data['resumed']:
+        logger.progress_begin('Resuming download of {}'.format(url), spinning)
+      else:
+        logger.progress_begin('Downloading {}'.format(url), spinning)
     if spinning:
       # TODO: Bytes to human readable
       logger.progress_update(None, data['downloaded'])
@@ -608,19 +768,54 @@ class UrlLoader(BaseLoader):
     if data['completed']:
       logger.progress_end()
 
+  def _stream_archive(self, context, url, filename, suffix, mode, sha256, progress):
+    """
+    Download the tar archive at *url* and extract it to the install
+    directory at the same time.
+
+    :raise DownloadAlreadyExists: If the archive was already extracted.
+    :return: The directory that the archive was extracted to.
+    """
+
+    directory = self._get_unpack_directory(context, filename, suffix)
+    self._check_download_exists(directory, url)
+    if os.path.islink(directory):
+      os.remove(directory)  # don't extract into a shared tree
+    else:
+      path.remove(directory, recursive=True, silent=True)
+    logger.debug('Extracting {} while downloading to "{}"'.format(
+        url, path.rel(directory, nopar=True)))
+    tarstream.download_and_extract(url, directory, mode, progress=progress,
+        sha256=sha256, check_extract_file=self._check_extract_file)
+    return directory
+
+  def _check_download_exists(self, directory, url):
+    urlfile = path.join(directory, '.craftr_downloadurl')
+    if path.isfile(urlfile):
+      with open(urlfile) as fp:
+        if fp.read().strip() == url:
+          raise self.DownloadAlreadyExists(directory)
+
   def _get_archive_unpack_info(self, context, archive):
     suffix = nr.misc.archive.get_opener(archive)[0]
-    filename = path.basename(archive)[:-len(suffix)]
-    directory = path.join(context.installdir, filename)
+    directory = self._get_unpack_directory(context, path.basename(archive), suffix)
     return suffix, directory
 
-  def _check_extract_file(self, arcname):
+  def _get_unpack_directory(self, context, filename, suffix):
+    return path.join(context.installdir, filename[:-len(suffix)])
+
+  def _get_unpack_variant(self):
+    # Distinguishes the trees in the download cache that are extracted
+    # from the same archive with different exclude patterns.
     if not self.unpack_exclude:
+      return ''
+    data = '\n'.join(self.unpack_exclude).encode('utf8')
+    return hashlib.sha1(data).hexdigest()[:8]
+
+  def _check_extract_file(self, arcname):
+    if self._unpack_exclude_re is None:
       return True
-    for pattern in self.unpack_exclude:
-      if fnmatch.fnmatch(arcname, pattern):
-        return False
-    return True
+    return not self._unpack_exclude_re.match(arcname)
 
   def _extract_progress(self, index, count, filename):
     if index == -1:
@@ -641,6 +836,173 @@ class UrlLoader(BaseLoader):
       self.directory = directory
 
 
+class GitLoader(BaseLoader):
+  """
+  This loader checks out a *ref* (a branch, tag or commit) of a Git
+  repository into the install directory of the module. Like for the
+  :class:`UrlLoader`, the *url* and *ref* can contain option variables.
+
+  Only the last *depth* commits of the ref are fetched. The objects are
+  stored in a bare repository in the download cache that is shared by all
+  build directories (in the install directory if the cache is disabled),
+  so that a new ref only fetches the objects that are missing. The source
+  directory is a ``git worktree`` of the bare repository. If *sparse* is
+  a list of directories, only these are checked out and the contents of
+  other files are not fetched if the server supports it.
+
+  .. code:: json
+
+    {
+      "name": "source",
+      "type": "git",
+      "url": "https://github.com/LuaDist/libjpeg.git",
+      "ref": "$version"
+    }
+
+  .. attribute:: url
+
+  .. attribute:: ref
+
+  .. attribute:: depth
+
+  .. attribute:: sparse
+
+  .. attribute:: directory
+
+    The directory of the checkout after the loader loaded successfully.
+
+  .. attribute:: commit
+
+    The SHA1 of the commit that is checked out, :const:`None` if the
+    sources were taken from a vendor bundle.
+  """
+
+  def __init__(self, name, url, ref='HEAD', depth=1, sparse=()):
+    super().__init__(name)
+    self.url = url
+    self.ref = ref
+    self.depth = depth
+    self.sparse = list(sparse)
+    self.directory = None
+    self.commit = None
+
+  def load(self, context, cache):
+    url = context.expand_variables(self.url)
+    ref = context.expand_variables(self.ref)
+    if cache is not None and path.isdir(cache.get('directory', '')):
+      if [cache.get('url'), cache.get('ref'), cache.get('sparse')] == [url, ref, self.sparse]:
+        self.directory = cache['directory']
+        self.commit = cache['commit']
+        self.vendor_key = '{}#{}'.format(url, ref)
+        logger.info('Reusing cached checkout: {}'.format(
+            path.rel(self.directory, nopar=True)))
+        return cache
+      else:
+        logger.info('Cached ref is outdated:', cache.get('ref'))
+
+    self.vendor_key = '{}#{}'.format(url, ref)
+    vendor_bundle = context.vendor_bundle
+    if vendor_bundle and self.vendor_key in vendor_bundle.sources:
+      # The vendored sources are not a Git checkout.
+      directory = path.join(context.installdir, vendor_bundle.sources[self.vendor_key]['name'])
+      logger.info('Extracting {} from "{}"'.format(self.vendor_key, vendor_bundle.filename))
+      try:
+        vendor_bundle.extract(self.vendor_key, directory)
+      except vendor.VendorError as exc:
+        raise LoaderError(self, str(exc))
+      self.directory = directory
+      self.commit = None
+      return {'directory': directory, 'url': url, 'ref': ref,
+          'sparse': self.sparse, 'commit': None}
+
+    if not shell.test_program('git'):
+      raise LoaderError(self, 'git is not installed')
+
+    if context.download_cache:
+      git_dir = context.download_cache.get_git_dir(url)
+    else:
+      git_dir = path.join(context.installdir, '.craftr_git')
+    directory = path.join(context.installdir, self._get_repository_name(url))
+    try:
+      with dlcache.lock_file(git_dir + '.lock'):
+        commit = self._fetch(git_dir, url, ref)
+        self._checkout(git_dir, directory, commit)
+    except shell.CalledProcessError as exc:
+      raise LoaderError(self, exc.stderr.strip() or str(exc))
+
+    self.directory = directory
+    self.commit = commit
+    return {'directory': directory, 'url': url, 'ref': ref,
+        'sparse': self.sparse, 'commit': commit}
+
+  def _git(self, *args):
+    # Warnings on stderr must not end up in the output, eg. in a SHA1.
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    return shell.pipe(['git'] + list(args), check=True, env=env, merge=False).stdout.strip()
+
+  def _fetch(self, git_dir, url, ref):
+    """
+    Fetch the *ref* from *url* into the bare repository *git_dir*.
+
+    :return: The SHA1 of the commit.
+    """
+
+    if not path.isdir(git_dir):
+      self._git('init', '--bare', '--quiet', git_dir)
+      self._git('-C', git_dir, 'remote', 'add', 'origin', url)
+    if re.match('^[0-9a-fA-F]{40}$', ref):
+      # A commit that was fetched before doesn't have to be fetched again.
+      try:
+        return self._git('-C', git_dir, 'rev-parse', '--verify', '--quiet', ref + '^{commit}')
+      except shell.CalledProcessError:
+        pass
+    logger.info('Fetching {} from {}'.format(ref, url))
+    args = ['-C', git_dir, 'fetch', '--quiet', '--no-tags']
+    if self.depth:
+      args.append('--depth={}'.format(self.depth))
+    if self.sparse:
+      args.append('--filter=blob:none')
+    self._git(*(args + ['origin', ref]))
+    return self._git('-C', git_dir, 'rev-parse', 'FETCH_HEAD^{commit}')
+
+  def _checkout(self, git_dir, directory, commit):
+    """
+    Check out the *commit* into *directory*, reusing an existing worktree
+    of *git_dir* so that only the files that changed are written.
+    """
+
+    self._git('-C', git_dir, 'worktree', 'prune')
+    reuse = False
+    if path.isfile(path.join(directory, '.git')):
+      try:
+        common_dir = self._git('-C', directory, 'rev-parse', '--git-common-dir')
+      except shell.CalledProcessError:
+        pass
+      else:
+        reuse = path.norm(common_dir, directory) == path.norm(git_dir)
+
+    if not reuse:
+      if os.path.islink(directory):
+        os.remove(directory)
+      else:
+        path.remove(directory, recursive=True, silent=True)
+      path.makedirs(path.dirname(directory))
+      self._git('-C', git_dir, 'worktree', 'add', '--quiet', '--detach',
+          '--no-checkout', directory, commit)
+
+    if self.sparse:
+      self._git('-C', directory, 'sparse-checkout', 'set', '--cone', *self.sparse)
+    elif reuse:
+      self._git('-C', directory, 'sparse-checkout', 'disable')
+    self._git('-C', directory, 'checkout', '--quiet', '--force', '--detach', commit)
+
+  def _get_repository_name(self, url):
+    name = url.rstrip('/').replace('\\', '/').split('/')[-1].split(':')[-1]
+    if name.endswith('.git'):
+      name = name[:-4]
+    return name or 'repository'
+
+
 class _aliases:
   """
   This class serves as a namespace in order to be able to specify the
@@ -653,3 +1015,4 @@ class _aliases:
   string = StringOption
 
   url = UrlLoader
+  git = GitLoader
@@ -0,0 +1,217 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.persistent`
+=============================
+
+Persistent worker processes for tools that are slow to start. A target that
+specifies a *worker* command declares that the program can be started once
+and then process many actions. The native executor keeps a
+:class:`WorkerPool` of such processes and sends them the arguments of every
+action instead of starting the program of the target again.
+
+The protocol consists of one JSON object per line. The executor writes a
+request to the standard input of the worker:
+
+.. code:: json
+
+  {"id": 1, "arguments": ["src/main.pyx", "-o", "build/main.c"], "cwd": "/build"}
+
+and the worker answers with exactly one line on its standard output:
+
+.. code:: json
+
+  {"id": 1, "exit_code": 0, "output": "warning: ..."}
+
+The *arguments* are the arguments of the target's command without the
+program. Worker scripts that are written in Python can use :func:`serve`
+to implement the protocol.
+"""
+
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import traceback
+
+
+class WorkerError(Exception):
+  """
+  Raised if a worker process died or did not respond according to the
+  protocol.
+  """
+
+
+class WorkerProcess(object):
+  """
+  A running worker process.
+
+  :param command: The command to start the worker with.
+  """
+
+  def __init__(self, command):
+    self.command = command
+    self.next_id = 1
+    self.popen = subprocess.Popen(command, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True, bufsize=1)
+
+  def request(self, arguments, cwd=None):
+    """
+    Send the *arguments* of an action to the worker and wait for the
+    response.
+
+    :raise WorkerError: If the worker died or sent an invalid response.
+    :return: A tuple of the exit code and the output of the action.
+    """
+
+    request_id = self.next_id
+    self.next_id += 1
+    request = {'id': request_id, 'arguments': arguments, 'cwd': cwd or os.getcwd()}
+    try:
+      self.popen.stdin.write(json.dumps(request) + '\n')
+      self.popen.stdin.flush()
+      line = self.popen.stdout.readline()
+    except (OSError, ValueError) as exc:
+      raise WorkerError(exc)
+    if not line:
+      raise WorkerError('worker exited with code {}'.format(self.popen.poll()))
+    try:
+      response = json.loads(line)
+      if response['id'] != request_id:
+        raise ValueError('unexpected response id')
+      return int(response['exit_code']), response.get('output', '')
+    except (ValueError, KeyError, TypeError) as exc:
+      raise WorkerError('invalid response: {}'.format(exc))
+
+  def close(self):
+    try:
+      self.popen.stdin.close()
+    except OSError:
+      pass
+    try:
+      self.popen.wait(5)
+    except subprocess.TimeoutExpired:
+      self.popen.kill()
+      self.popen.wait()
+    self.popen.stdout.close()
+
+
+class WorkerPool(object):
+  """
+  Keeps idle :class:`WorkerProcess` objects for every worker command so
+  they can be reused by subsequent actions.
+
+  .. attribute:: started
+
+    The number of worker processes that have been started.
+
+  .. attribute:: requests
+
+    The number of requests that have been processed by the workers.
+  """
+
+  def __init__(self):
+    self.started = 0
+    self.requests = 0
+    self._idle = {}
+    self._lock = threading.Lock()
+
+  def run(self, command, arguments, cwd=None):
+    """
+    Execute an action with the *arguments* on an idle worker for *command*
+    or a new worker if none is available.
+
+    :raise WorkerError: If the worker could not be started or failed.
+    :return: A tuple of the exit code and the output of the action.
+    """
+
+    key = tuple(command)
+    with self._lock:
+      idle = self._idle.get(key)
+      worker = idle.pop() if idle else None
+    if worker is None:
+      try:
+        worker = WorkerProcess(list(command))
+      except OSError as exc:
+        raise WorkerError(exc)
+      with self._lock:
+        self.started += 1
+    try:
+      result = worker.request(arguments, cwd)
+    except WorkerError:
+      worker.close()
+      raise
+    with self._lock:
+      self._idle.setdefault(key, []).append(worker)
+      self.requests += 1
+    return result
+
+  def close(self):
+    """
+    Terminate all idle workers.
+    """
+
+    with self._lock:
+      workers = [w for x in self._idle.values() for w in x]
+      self._idle = {}
+    for worker in workers:
+      worker.close()
+
+
+def serve(handler, stdin=None, stdout=None):
+  """
+  Implements the worker side of the protocol. Reads requests from *stdin*
+  and calls *handler* with the list of arguments for every request. Output
+  that the handler writes to :data:`sys.stdout` or :data:`sys.stderr` is
+  captured and sent back in the response.
+
+  :param handler: A function that accepts a list of arguments and returns
+    an exit code. :class:`SystemExit` exceptions are converted to an exit
+    code, other exceptions produce exit code 1.
+  """
+
+  stdin = stdin or sys.stdin
+  stdout = stdout or sys.stdout
+  for line in stdin:
+    if not line.strip():
+      continue
+    request = json.loads(line)
+    buffer = io.StringIO()
+    old_cwd = os.getcwd()
+    # contextlib.redirect_stderr() is not available in Python 3.4.
+    old_streams = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = buffer
+    try:
+      os.chdir(request.get('cwd') or old_cwd)
+      exit_code = handler(request['arguments']) or 0
+    except SystemExit as exc:
+      if isinstance(exc.code, int) or exc.code is None:
+        exit_code = exc.code or 0
+      else:
+        print(exc.code)
+        exit_code = 1
+    except Exception:
+      traceback.print_exc()
+      exit_code = 1
+    finally:
+      sys.stdout, sys.stderr = old_streams
+      os.chdir(old_cwd)
+    response = {'id': request['id'], 'exit_code': exit_code, 'output': buffer.getvalue()}
+    stdout.write(json.dumps(response) + '\n')
+    stdout.flush()
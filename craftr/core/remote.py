@@ -0,0 +1,517 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.remote`
+=========================
+
+Distributed execution of hermetic actions. A :class:`WorkerServer` (started
+with ``craftr worker``) accepts actions over TCP, executes them in a sandbox
+directory and sends the output files back. The native executor uses a
+:class:`RemoteExecutor` to dispatch actions to the least loaded worker and
+falls back to local execution if no worker is available.
+
+An action is *hermetic* if its command only reads its inputs, implicit
+dependencies and discovered dependencies, and only writes its outputs and
+depfile. These files are shipped to the worker if they are located in one
+of the *root* directories of the coordinator; paths in the command are
+rewritten accordingly. Files outside of the roots, like the compiler and
+system headers, must be available on the worker at the same location.
+
+Messages consist of a 4-byte big-endian length, a JSON header of that
+length and the binary blobs that are listed by size in the ``'blobs'``
+key of the header.
+
+.. warning::
+
+  Workers execute arbitrary commands that they receive. Only run them on
+  trusted networks.
+"""
+
+from craftr.core.cache import ContentStore
+from craftr.core.digest import DigestDatabase, DIGESTS_FILENAME
+from craftr.core.logging import logger
+from craftr.utils import path
+from craftr.utils import sysinfo
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+#: The default port of ``craftr worker``.
+DEFAULT_PORT = 8766
+
+#: The placeholder for the sandbox directory on the worker.
+SANDBOX = '@CRAFTR_SANDBOX@'
+
+#: The number of seconds a worker is not used after a connection error.
+RETRY_INTERVAL = 30
+
+_length = struct.Struct('>I')
+
+
+class ProtocolError(Exception):
+  pass
+
+
+def send_message(sock, header, blobs=()):
+  """
+  Send a message with the JSON *header* and a list of binary *blobs*.
+  """
+
+  header = dict(header, blobs=[len(x) for x in blobs])
+  data = json.dumps(header).encode('utf8')
+  sock.sendall(_length.pack(len(data)) + data)
+  for blob in blobs:
+    sock.sendall(blob)
+
+
+def recv_message(sock):
+  """
+  Receive a message. Returns a tuple of the header and the list of blobs
+  or :const:`None` if the connection was closed.
+  """
+
+  data = _recv_exactly(sock, _length.size)
+  if data is None:
+    return None
+  header = _recv_exactly(sock, _length.unpack(data)[0])
+  if header is None:
+    raise ProtocolError('connection closed while receiving header')
+  header = json.loads(header.decode('utf8'))
+  blobs = []
+  for size in header.pop('blobs', []):
+    blob = _recv_exactly(sock, size)
+    if blob is None:
+      raise ProtocolError('connection closed while receiving blob')
+    blobs.append(blob)
+  return header, blobs
+
+
+def _recv_exactly(sock, size):
+  chunks = []
+  while size > 0:
+    data = sock.recv(min(size, 1 << 20))
+    if not data:
+      if chunks:
+        raise ProtocolError('connection closed unexpectedly')
+      return None
+    chunks.append(data)
+    size -= len(data)
+  return b''.join(chunks)
+
+
+def parse_address(address, default_port=DEFAULT_PORT):
+  """
+  Parses a ``host[:port]`` string into a tuple.
+  """
+
+  host, sep, port = address.rpartition(':')
+  if not sep:
+    return address, default_port
+  return host, int(port)
+
+
+class Worker(object):
+  """
+  Executes actions that are received from a coordinator.
+
+  :param directory: The directory for the content store and sandboxes.
+  :param jobs: The number of actions that are executed at the same time.
+  """
+
+  def __init__(self, directory, jobs=None):
+    self.directory = directory
+    self.jobs = jobs or sysinfo.cpu_count()
+    self.store = ContentStore(path.join(directory, 'cas'))
+    self.sandbox_dir = path.join(directory, 'sandbox')
+    self.running = 0
+    self._slots = threading.BoundedSemaphore(self.jobs)
+    self._lock = threading.Lock()
+
+  def handle(self, header, blobs):
+    """
+    Handle a request and return a tuple of the response header and blobs.
+    """
+
+    kind = header.get('type')
+    if kind == 'status':
+      return {'jobs': self.jobs, 'running': self.running}, []
+    elif kind == 'run':
+      return self.run(header, blobs)
+    return {'error': 'unknown request type: {!r}'.format(kind)}, []
+
+  def run(self, header, blobs):
+    """
+    Runs an action. If any of the input files are neither in the content
+    store nor attached to the request, the response lists the ``'missing'``
+    digests and the action is not executed.
+    """
+
+    for digest, blob in zip(header.get('attached', []), blobs):
+      if hashlib.sha1(blob).hexdigest() != digest:
+        return {'error': 'digest mismatch for attached file'}, []
+      self._put_blob(digest, blob)
+    missing = sorted(set(d for __, d in header['files'] if not self.store.has(d)))
+    if missing:
+      return {'missing': missing}, []
+
+    with self._slots:
+      with self._lock:
+        self.running += 1
+      try:
+        return self._execute(header)
+      finally:
+        with self._lock:
+          self.running -= 1
+
+  def _put_blob(self, digest, blob):
+    path.makedirs(self.directory)
+    fd, temp = tempfile.mkstemp(dir=self.directory)
+    with os.fdopen(fd, 'wb') as fp:
+      fp.write(blob)
+    self.store.put(temp, digest, move=True)
+
+  def _execute(self, header):
+    path.makedirs(self.sandbox_dir)
+    sandbox = tempfile.mkdtemp(dir=self.sandbox_dir)
+    try:
+      for name, digest in header['files']:
+        if not self.store.restore(digest, _sandbox_path(sandbox, name), hardlink=True):
+          return {'missing': [digest]}, []
+      for name in header['outputs']:
+        path.makedirs(path.dirname(_sandbox_path(sandbox, name)))
+      cwd = _sandbox_path(sandbox, header['cwd'])
+      path.makedirs(cwd)
+
+      command = header['command'].replace(SANDBOX, sandbox)
+      if os.name == 'nt':
+        cmd = command
+      else:
+        cmd = ['/bin/sh', '-c', command]
+      try:
+        popen = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = popen.communicate()[0]
+        returncode = popen.returncode
+      except OSError as exc:
+        output, returncode = str(exc).encode('utf8'), 127
+      output = output.decode(sys.getdefaultencoding(), 'replace')
+
+      outputs = []
+      blobs = []
+      if returncode == 0:
+        for name in header['outputs']:
+          filename = _sandbox_path(sandbox, name)
+          if not path.isfile(filename):
+            continue
+          with open(filename, 'rb') as fp:
+            data = fp.read()
+          if name in header.get('text_outputs', []):
+            data = data.replace(sandbox.encode('utf8'), SANDBOX.encode('utf8'))
+          outputs.append(name)
+          blobs.append(data)
+      response = {'returncode': returncode, 'outputs': outputs,
+          'output': output.replace(sandbox, SANDBOX)}
+      return response, blobs
+    finally:
+      shutil.rmtree(sandbox, ignore_errors=True)
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+
+  def handle(self):
+    worker = self.server.worker
+    while True:
+      try:
+        message = recv_message(self.request)
+      except (ProtocolError, ValueError, OSError) as exc:
+        logger.warn('craftr worker: {}: {}'.format(self.client_address[0], exc))
+        return
+      if message is None:
+        return
+      try:
+        response, blobs = worker.handle(*message)
+      except (OSError, KeyError, TypeError, ValueError) as exc:
+        response, blobs = {'error': str(exc)}, []
+      try:
+        send_message(self.request, response, blobs)
+      except OSError:
+        return
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+  """
+  A TCP server that passes requests to a :class:`Worker`.
+  """
+
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, address, worker):
+    self.worker = worker
+    super().__init__(address, _RequestHandler)
+
+
+class WorkerConnection(object):
+  """
+  Represents a worker from the perspective of the coordinator. Sockets to
+  the worker are kept open and reused for subsequent requests.
+
+  .. attribute:: jobs
+
+    The number of actions that the worker executes at the same time or 0
+    if the worker is not available.
+
+  .. attribute:: running
+
+    The number of actions that are currently dispatched to the worker.
+  """
+
+  def __init__(self, address, timeout=None):
+    self.address = address
+    self.timeout = timeout
+    self.jobs = 0
+    self.running = 0
+    self.failed_at = None
+    self._sockets = []
+    self._lock = threading.Lock()
+
+  def __str__(self):
+    return '{}:{}'.format(*self.address)
+
+  def request(self, header, blobs=()):
+    """
+    Send a request to the worker and return the response.
+
+    :raise OSError: If the connection failed.
+    :raise ProtocolError: If the connection was closed unexpectedly.
+    """
+
+    with self._lock:
+      sock = self._sockets.pop() if self._sockets else None
+    if sock is None:
+      sock = socket.create_connection(self.address, self.timeout)
+    try:
+      send_message(sock, header, blobs)
+      message = recv_message(sock)
+      if message is None:
+        raise ProtocolError('connection closed by worker')
+    except BaseException:
+      sock.close()
+      raise
+    with self._lock:
+      self._sockets.append(sock)
+    if 'error' in message[0]:
+      raise ProtocolError('worker {}: {}'.format(self, message[0]['error']))
+    return message
+
+  def close(self):
+    with self._lock:
+      sockets, self._sockets = self._sockets, []
+    for sock in sockets:
+      sock.close()
+
+
+class RemoteExecutor(object):
+  """
+  Dispatches actions to workers.
+
+  :param addresses: A list of ``(host, port)`` tuples.
+  :param roots: A list of directories that contain the files which are
+    shipped to the workers. Defaults to the current working directory.
+  :param digests: A :class:`DigestDatabase` for computing file digests.
+  :param timeout: The socket timeout in seconds.
+  """
+
+  def __init__(self, addresses, roots=None, digests=None, timeout=None):
+    self.workers = [WorkerConnection(x, timeout) for x in addresses]
+    self.roots = []
+    for root in (roots or [os.getcwd()]):
+      root = path.norm(root)
+      if not any(root == x or root.startswith(x + os.sep) for x in self.roots):
+        self.roots.append(root)
+    self.roots.sort(key=len, reverse=True)
+    self.digests = digests or DigestDatabase(path.abs(DIGESTS_FILENAME))
+    self.executed = 0
+    self._roots_regex = re.compile('|'.join(
+        '(' + re.escape(x) + r')(?=[/\\\s\'":]|$)' for x in self.roots))
+    self._lock = threading.Lock()
+
+  @property
+  def slots(self):
+    """
+    The total number of jobs of all available workers.
+    """
+
+    return sum(w.jobs for w in self.workers)
+
+  def load(self):
+    self.digests.load()
+    for worker in self.workers:
+      self._connect(worker)
+
+  def save(self):
+    self.digests.save()
+
+  def close(self):
+    for worker in self.workers:
+      worker.close()
+
+  def _connect(self, worker):
+    try:
+      worker.jobs = worker.request({'type': 'status'})[0]['jobs']
+      worker.failed_at = None
+    except (OSError, ProtocolError, KeyError) as exc:
+      logger.warn('craftr: worker {} is not available: {}'.format(worker, exc))
+      worker.jobs = 0
+      worker.failed_at = time.time()
+
+  def rewrite(self, text):
+    """
+    Replace the root directories in *text* with their location in the
+    sandbox of the worker.
+    """
+
+    def sub(match):
+      return self.sandbox_path(match.group(0))
+    return self._roots_regex.sub(sub, text)
+
+  def sandbox_path(self, filename):
+    """
+    Returns the name of *filename* relative to the sandbox or :const:`None`
+    if it is not inside one of the roots.
+    """
+
+    for index, root in enumerate(self.roots):
+      if filename == root or filename.startswith(root + os.sep):
+        return SANDBOX + '/r{}'.format(index) + filename[len(root):].replace(os.sep, '/')
+    return None
+
+  def local_path(self, name):
+    match = re.match(re.escape(SANDBOX) + r'/r(\d+)', name)
+    if not match:
+      return name
+    return self.roots[int(match.group(1))] + name[match.end():].replace('/', os.sep)
+
+  def _acquire(self):
+    with self._lock:
+      now = time.time()
+      for worker in self.workers:
+        if worker.failed_at and now - worker.failed_at > RETRY_INTERVAL:
+          worker.failed_at = None
+          threading.Thread(target=self._connect, args=(worker,), daemon=True).start()
+      available = [w for w in self.workers if w.running < w.jobs and not w.failed_at]
+      if not available:
+        return None
+      worker = min(available, key=lambda w: float(w.running) / w.jobs)
+      worker.running += 1
+      return worker
+
+  def _release(self, worker, failed=False):
+    with self._lock:
+      worker.running -= 1
+      if failed:
+        worker.jobs = 0
+        worker.failed_at = time.time()
+
+  def run(self, action, files, text_outputs=()):
+    """
+    Execute the *action* on a worker.
+
+    :param files: The input files that are read by the action.
+    :param text_outputs: Output files in which the sandbox directory is
+      replaced with the local directory (eg. depfiles).
+    :return: A tuple of the return code and the output of the command or
+      :const:`None` if no worker is available.
+    """
+
+    header = {
+      'type': 'run',
+      'command': self.rewrite(action.command),
+      'cwd': self.sandbox_path(path.norm(os.getcwd())),
+      'files': [],
+      'outputs': [],
+      'text_outputs': []
+    }
+    if header['cwd'] is None:
+      return None
+    filenames = {}
+    for filename in files:
+      name = self.sandbox_path(filename)
+      if name is None or name in filenames:
+        continue
+      digest = self.digests.digest(filename)
+      if digest is None:
+        return None
+      filenames[name] = filename
+      header['files'].append([name, digest])
+    for filename in list(action.outputs) + list(text_outputs):
+      name = self.sandbox_path(filename)
+      if name is None:
+        return None
+      header['outputs'].append(name)
+      if filename in text_outputs:
+        header['text_outputs'].append(name)
+
+    worker = self._acquire()
+    if worker is None:
+      return None
+    try:
+      response, blobs = worker.request(header)
+      if 'missing' in response:
+        missing = set(response['missing'])
+        attached = [[n, d] for n, d in header['files'] if d in missing]
+        blobs = []
+        for name, digest in attached:
+          with open(filenames[name], 'rb') as fp:
+            blobs.append(fp.read())
+        header['attached'] = [d for __, d in attached]
+        response, blobs = worker.request(header, blobs)
+        if 'missing' in response:
+          raise ProtocolError('worker {} did not accept files'.format(worker))
+    except (OSError, ProtocolError) as exc:
+      logger.warn('craftr: worker {} failed: {}'.format(worker, exc))
+      self._release(worker, failed=True)
+      return None
+    self._release(worker)
+
+    for name, data in zip(response['outputs'], blobs):
+      filename = self.local_path(name)
+      if name in header['text_outputs']:
+        data = self.rewrite_back(data.decode('utf8')).encode('utf8')
+      path.makedirs(path.dirname(filename))
+      with open(filename, 'wb') as fp:
+        fp.write(data)
+    with self._lock:
+      self.executed += 1
+    return response['returncode'], self.rewrite_back(response['output'])
+
+  def rewrite_back(self, text):
+    return re.sub(re.escape(SANDBOX) + r'/r\d+', lambda m: self.local_path(m.group(0)), text)
+
+
+def _sandbox_path(sandbox, name):
+  return path.join(sandbox, *name.replace(SANDBOX, '').strip('/').split('/'))
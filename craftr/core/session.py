@@ -22,20 +22,26 @@ process of Craftr modules and contains all the important root datastructures
 for the meta build process (such as a :class:`craftr.core.build.Graph`).
 """
 
-from craftr.core import build, manifest
+from craftr.core import build, dlcache, manifest
 from craftr.core.logging import logger
 from craftr.core.manifest import Manifest, LoaderContext
 from craftr.utils import argspec, path
 from nr.types.version import Version, VersionCriteria
 
+import concurrent.futures
 import json
 import os
 import tempfile
+import threading
 import types
 import werkzeug
 
 MANIFEST_FILENAME = 'manifest.json'
 
+#: The default number of threads that initialize the loaders of modules
+#: concurrently (see :func:`init_loaders`).
+DEFAULT_LOADER_JOBS = 4
+
 
 class ModuleNotFound(Exception):
 
@@ -128,6 +134,11 @@ class Session(object):
 
     A dictionary of options that are passed down to Craftr modules.
 
+  .. attribute:: vendor_bundle
+
+    A :class:`craftr.core.vendor.VendorBundle` that loaders take their
+    sources from instead of the network, or :const:`None`.
+
   .. attributes:: cache
 
     A JSON object that will be loaded from the current workspace's cache
@@ -137,7 +148,8 @@ class Session(object):
     occur.
 
     Currently the cache is mainly used for loaders. The information is saved
-    in the ``'loaders'`` key.
+    in the ``'loaders'`` key. The ``'host_latency'`` key contains the
+    response times of the mirrors of :class:`manifest.UrlLoader`.
 
     .. code:: json
 
@@ -147,6 +159,9 @@ class Session(object):
             "name": "source",
             "data": {"directory": "..."}
           }
+        },
+        "host_latency": {
+          "example.org": 0.12
         }
       }
   """
@@ -166,8 +181,10 @@ class Session(object):
     self.modulestack = []
     self.modules = {}
     self.options = {}
-    self.cache = {'loaders': {}}
+    self.cache = {'loaders': {}, 'host_latency': {}}
+    self.vendor_bundle = None
     self._tempdir = None
+    self._tempdir_lock = threading.Lock()
     self._manifest_cache = {}  # maps manifest_filename: manifest
     self._refresh_cache = True
 
@@ -203,6 +220,7 @@ class Session(object):
           .format(type(cache).__name__))
     self.cache = cache
     self.cache.setdefault('loaders', {})
+    self.cache.setdefault('host_latency', {})
 
   def write_cache(self, fp):
     json.dump(self.cache, fp, indent='\t')
@@ -219,10 +237,34 @@ class Session(object):
 
     if Session.current is not self:
       raise RuntimeError('session not in context')
-    if not self._tempdir:
-      self._tempdir = path.join(self.builddir, '.temp')
-      logger.debug('created temporary directory:', self._tempdir)
-    return self._tempdir
+    with self._tempdir_lock:
+      if not self._tempdir:
+        self._tempdir = path.join(self.builddir, '.temp')
+        logger.debug('created temporary directory:', self._tempdir)
+      return self._tempdir
+
+  def executed_modules(self):
+    """
+    Returns a list of all modules in the session that have been executed.
+    """
+
+    return [m for versions in self.modules.values()
+            for m in versions.values() if m.executed]
+
+  def get_download_cache(self):
+    """
+    Returns the machine-wide :class:`dlcache.DownloadCache` that loaders
+    share downloaded archives and extracted trees with, or :const:`None` if
+    the ``craftr.download_cache`` option is disabled. The cache directory
+    can be changed with the ``craftr.download_cache.dir`` option.
+    """
+
+    enabled = manifest.BoolOption('craftr.download_cache', True)(
+        self.options.get('craftr.download_cache', ''))
+    if not enabled:
+      return None
+    directory = self.options.get('craftr.download_cache.dir') or path.user_cache_dir('dl')
+    return dlcache.DownloadCache(directory)
 
   def parse_manifest(self, filename):
     """
@@ -280,6 +322,24 @@ class Session(object):
           logger.warn('invalid manifest found:', filename)
           logger.warn(exc, indent=1)
 
+  def reload_manifest(self, module):
+    """
+    Parse the manifest of the *module* again and replace the module in the
+    session with a new :class:`Module` object for the new manifest. The new
+    module has not been executed.
+
+    :raise Manifest.Invalid: If the manifest is invalid.
+    :return: The new :class:`Module` object.
+    """
+
+    filename = path.norm(path.join(module.directory, MANIFEST_FILENAME))
+    self._manifest_cache.pop(filename, None)
+    versions = self.modules.get(module.manifest.name, {})
+    current = versions.get(module.manifest.version)
+    if current is not None and current.directory == module.directory:
+      del versions[module.manifest.version]
+    return self.parse_manifest(filename)
+
   def find_module(self, name, version):
     """
     Finds a module in the :attr:`path` matching the specified *name* and
@@ -364,6 +424,17 @@ class Module(object):
 
     The loader that was specified in the manifest and initialized with
     :meth:`init_loader`.
+
+  .. attribute:: loader_error
+
+    The exception that occurred when the loaders of the module were
+    initialized by :func:`init_loaders`. It is raised by :meth:`init_loader`
+    when the module is executed.
+
+  .. attribute:: target_name_counters
+
+    A dictionary that maps name hints to the next index that is used by
+    :func:`craftr.targetbuilder.gtn` to generate anonymous target names.
   """
 
   NotFound = ModuleNotFound
@@ -377,6 +448,8 @@ class Module(object):
     self.executed = False
     self.options = None
     self.loader = None
+    self.loader_error = None
+    self.target_name_counters = {}
 
   def __repr__(self):
     return '<craftr.core.session.Module "{}-{}">'.format(self.manifest.name,
@@ -418,31 +491,45 @@ class Module(object):
         self.options = None
         raise InvalidOption(self, errors)
 
-  def init_loader(self, recursive=False, _break_recursion=None):
+  def init_loader(self, recursive=False):
     """
     Check all available loaders as defined in the :attr:`manifest` until the
     first loads successfully.
 
     :param recursive: Initialize the loaders of all dependencies as well.
+      The loaders of all modules are initialized concurrently with
+      :func:`init_loaders`. Errors of the dependencies are raised when
+      they are executed.
     :raise RuntimeError: If there is no current session context.
     :raise LoaderInitializationError: If none of the loaders matched.
     """
 
     if not session:
       raise RuntimeError('no current session')
-    if not self.manifest.loaders:
-      return
-    if _break_recursion is self:
-      return
 
     if recursive:
-      for name, version in self.manifest.dependencies.items():
-        module = session.find_module(name, version)
-        module.init_loader(True, _break_recursion=self)
+      init_loaders(self.get_dependencies(recursive=True) + [self])
 
+    if not self.manifest.loaders:
+      return
     self.init_options()
     if self.loader is not None:
       return
+    if self.loader_error is not None:
+      raise self.loader_error
+
+    self.loader, data = self._run_loaders()
+    session.cache['loaders'][self.ident] = {'name': self.loader.name, 'data': data}
+
+  def _run_loaders(self):
+    """
+    Check the loaders of the module in order until the first loads
+    successfully. Does not modify the module or the session, thus it can
+    be called from a thread.
+
+    :raise LoaderInitializationError: If none of the loaders matched.
+    :return: A tuple of the loader and the data to cache.
+    """
 
     logger.info('running loaders for {}'.format(self.ident))
     with logger.indent():
@@ -450,7 +537,9 @@ class Module(object):
       installdir = path.join(session.builddir, self.ident, 'src')
       cache = session.cache['loaders'].get(self.ident)
       context = LoaderContext(self.directory, self.manifest, self.options,
-          installdir = installdir)
+          installdir = installdir, host_latency = session.cache['host_latency'],
+          download_cache = session.get_download_cache(),
+          vendor_bundle = session.vendor_bundle)
       context.get_temporary_directory = session.get_temporary_directory
 
       # Check all loaders in-order.
@@ -466,12 +555,44 @@ class Module(object):
           except manifest.LoaderError as exc:
             errors.append(exc)
           else:
-            self.loader = loader
-            session.cache['loaders'][self.ident] = {
-                'name': loader.name, 'data': new_data}
-            break
-      else:
-        raise LoaderInitializationError(self, errors)
+            return loader, new_data
+      raise LoaderInitializationError(self, errors)
+
+  def get_dependencies(self, recursive=False):
+    """
+    Returns a list of the modules that this module depends on. Dependencies
+    that can not be found are skipped, they are reported when the module
+    attempts to load them.
+
+    :param recursive: Include the dependencies of the dependencies.
+    """
+
+    result = []
+    seen = set([id(self)])
+    stack = [self]
+    while stack:
+      for name, version in stack.pop().manifest.dependencies.items():
+        try:
+          module = session.find_module(name, version)
+        except ModuleNotFound:
+          continue
+        if id(module) not in seen:
+          seen.add(id(module))
+          result.append(module)
+          if recursive:
+            stack.append(module)
+    return result
+
+  def reset(self):
+    """
+    Reset the module so that it can be executed again with :meth:`run`.
+    The targets that the module created must be removed from the graph
+    separately.
+    """
+
+    self.namespace = types.ModuleType(self.manifest.name)
+    self.executed = False
+    self.target_name_counters = {}
 
   def run(self):
     """
@@ -490,7 +611,9 @@ class Module(object):
 
     self.executed = True
     self.init_options()
-    self.init_loader()
+    # The first module that is executed initializes the loaders of all
+    # modules that it depends on.
+    self.init_loader(recursive=not session.modulestack)
 
     script_fn = path.norm(path.join(self.directory, self.manifest.main))
     with open(script_fn) as fp:
@@ -516,5 +639,58 @@ class Module(object):
       assert session.modulestack.pop() is self
 
 
+def init_loaders(modules, jobs=None):
+  """
+  Initialize the loaders of the *modules* concurrently in a pool of up to
+  *jobs* threads (defaults to the ``craftr.loader_jobs`` option). The
+  loaders of a single module are still checked in order, and the results
+  are written to the loader cache of the session in the order of the
+  *modules*.
+
+  Errors are not raised by this function but stored in the
+  :attr:`Module.loader_error` of the module, as a module that is declared
+  as a dependency is not necessarily loaded (eg. ``lang.cxx.msvc``).
+
+  :raise RuntimeError: If there is no current session context.
+  :raise ValueError: If the ``craftr.loader_jobs`` option is invalid.
+  """
+
+  if not session:
+    raise RuntimeError('no current session')
+  if jobs is None:
+    jobs = session.options.get('craftr.loader_jobs', DEFAULT_LOADER_JOBS)
+    try:
+      jobs = int(jobs)
+    except ValueError:
+      raise ValueError('invalid craftr.loader_jobs: {!r}'.format(jobs))
+
+  pending = []
+  for module in modules:
+    if not module.manifest.loaders or module.loader or module.loader_error:
+      continue
+    try:
+      module.init_options()
+    except InvalidOption:
+      continue  # reported when the module is executed
+    pending.append(module)
+  if len(pending) < 2 or jobs < 2:
+    return  # initialized when the modules are executed
+
+  def run(module):
+    with logger.task(module.ident):
+      return module._run_loaders()
+
+  with concurrent.futures.ThreadPoolExecutor(min(jobs, len(pending))) as pool:
+    futures = [pool.submit(run, module) for module in pending]
+    for module, future in zip(pending, futures):
+      try:
+        module.loader, data = future.result()
+      except Exception as exc:
+        module.loader_error = exc
+      else:
+        session.cache['loaders'][module.ident] = {
+            'name': module.loader.name, 'data': data}
+
+
 #: Proxy object that points to the current :class:`Session` object.
 session = werkzeug.LocalProxy(lambda: Session.current)
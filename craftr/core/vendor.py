@@ -0,0 +1,238 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.vendor`
+=========================
+
+Vendor bundles contain the sources that the loaders of a dependency tree
+fetched, so that a project can be exported without network access (see
+``craftr vendor`` and ``craftr export --vendor``).
+
+A bundle is an uncompressed tar archive. Its first member is the index
+``craftr-vendor.json``, which maps the *key* of every source (eg. the URL
+that it was downloaded from) to the offset and size of a member that
+contains the source directory as another uncompressed tar archive, and to
+its SHA256. Since the index records the offsets, a source is read from the
+bundle without scanning the members before it.
+
+.. code:: json
+
+  {
+    "version": 1,
+    "sources": {
+      "https://example.org/libfoo-1.0.tar.gz": {
+        "module": "lib.foo-1.0.0",
+        "name": "libfoo-1.0",
+        "member": "sources/0f343b0931126a20.tar",
+        "offset": 2048,
+        "size": 163840,
+        "sha256": "0f343b0931126a20f133d67c2b018a3b...",
+        "files": 112
+      }
+    }
+  }
+"""
+
+from craftr.core.logging import logger
+from craftr.utils import path
+from craftr.utils import tarstream
+
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+
+#: The name of the index member of a bundle.
+INDEX_NAME = 'craftr-vendor.json'
+
+#: The version of the bundle format.
+VERSION = 1
+
+_BLOCKSIZE = tarfile.BLOCKSIZE
+
+
+class VendorError(Exception):
+  """
+  Raised if a bundle is invalid or a source in the bundle is corrupt.
+  """
+
+
+def _padded(size):
+  return (size + _BLOCKSIZE - 1) // _BLOCKSIZE * _BLOCKSIZE
+
+
+def _exclude_file(tarinfo):
+  # Files that are specific to the checkout in the build directory.
+  name = tarinfo.name.rpartition('/')[2]
+  if name in ('.craftr_downloadurl', '.git'):
+    return None
+  return tarinfo
+
+
+class _SliceReader(object):
+  # Reads *size* bytes from the current position of *fp* and hashes them.
+
+  def __init__(self, fp, size):
+    self.fp = fp
+    self.remaining = size
+    self.hasher = hashlib.sha256()
+
+  def read(self, count=-1):
+    if count < 0 or count > self.remaining:
+      count = self.remaining
+    data = self.fp.read(count)
+    self.remaining -= len(data)
+    self.hasher.update(data)
+    return data
+
+
+def write_bundle(filename, sources):
+  """
+  Write a vendor bundle.
+
+  :param filename: The name of the bundle file to create.
+  :param sources: A list of tuples that contain the key, the name of the
+    module, the name of the source directory (eg. ``libfoo-1.0``) and the
+    directory of every source.
+  :return: The index of the bundle.
+  """
+
+  with tempfile.TemporaryDirectory() as tempdir:
+    # Pack every source into a tar archive of its own first, we need to
+    # know their sizes to compute the offsets in the index.
+    members = []
+    index = {'version': VERSION, 'sources': {}}
+    for key, module, name, directory in sources:
+      temp = path.join(tempdir, str(len(members)) + '.tar')
+      with tarfile.open(temp, 'w', format=tarfile.PAX_FORMAT) as tar:
+        tar.add(os.path.realpath(directory), arcname='.', filter=_exclude_file)
+        count = sum(1 for x in tar.getmembers() if not x.isdir())
+      with open(temp, 'rb') as fp:
+        digest = hashlib.sha256()
+        for data in iter(lambda: fp.read(1 << 20), b''):
+          digest.update(data)
+      digest = digest.hexdigest()
+      entry = {'module': module, 'name': name, 'member': 'sources/{}.tar'.format(digest[:16]),
+          'size': os.path.getsize(temp), 'sha256': digest, 'files': count}
+      index['sources'][key] = entry
+      members.append((entry, temp))
+
+    # The index is the first member. Its size depends on the offsets,
+    # thus it is padded with spaces to a fixed size until it fits.
+    index_size = _BLOCKSIZE
+    while True:
+      offset = _BLOCKSIZE + _padded(index_size)
+      for entry, temp in members:
+        entry['offset'] = offset + _BLOCKSIZE
+        offset += _BLOCKSIZE + _padded(entry['size'])
+      data = json.dumps(index, indent=2, sort_keys=True).encode('utf8')
+      if len(data) <= index_size:
+        data += b' ' * (index_size - len(data))
+        break
+      index_size = _padded(len(data))
+
+    with tarfile.open(filename, 'w', format=tarfile.USTAR_FORMAT) as tar:
+      info = tarfile.TarInfo(INDEX_NAME)
+      info.size = len(data)
+      tar.addfile(info, io.BytesIO(data))
+      for entry, temp in members:
+        if tar.offset + _BLOCKSIZE != entry['offset']:
+          raise RuntimeError('unexpected offset of {}'.format(entry['member']))
+        info = tarfile.TarInfo(entry['member'])
+        info.size = entry['size']
+        with open(temp, 'rb') as fp:
+          tar.addfile(info, fp)
+  return index
+
+
+class VendorBundle(object):
+  """
+  Reads the sources from a vendor bundle that was created with
+  :func:`write_bundle`.
+
+  :param filename: The name of the bundle file.
+  :raise VendorError: If the file is not a vendor bundle.
+  :raise OSError: If the file can not be read.
+
+  .. attribute:: sources
+
+    The ``sources`` dictionary of the index.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    with open(filename, 'rb') as fp:
+      try:
+        info = tarfile.TarInfo.frombuf(fp.read(_BLOCKSIZE), 'utf8', 'surrogateescape')
+      except tarfile.HeaderError as exc:
+        raise VendorError('{}: not a vendor bundle ({})'.format(filename, exc))
+      if info.name != INDEX_NAME:
+        raise VendorError('{}: not a vendor bundle'.format(filename))
+      try:
+        index = json.loads(fp.read(info.size).decode('utf8'))
+      except ValueError as exc:
+        raise VendorError('{}: invalid index ({})'.format(filename, exc))
+    if index.get('version') != VERSION:
+      raise VendorError('{}: unsupported version {!r}'.format(filename, index.get('version')))
+    self.sources = index['sources']
+
+  def find(self, keys):
+    """
+    Returns the key and the entry of the first of *keys* that is in the
+    bundle, or ``(None, None)``.
+    """
+
+    for key in keys:
+      if key in self.sources:
+        return key, self.sources[key]
+    return None, None
+
+  def extract(self, key, directory):
+    """
+    Extract the source with the *key* to *directory*. An existing directory
+    is replaced. The files that the loader excluded when it unpacked the
+    source are not in the bundle.
+
+    :raise KeyError: If the *key* is not in the bundle.
+    :raise VendorError: If the source in the bundle is corrupt.
+    """
+
+    entry = self.sources[key]
+    if os.path.islink(directory):
+      os.remove(directory)
+    else:
+      path.remove(directory, recursive=True, silent=True)
+    success = False
+    try:
+      with open(self.filename, 'rb') as fp:
+        fp.seek(entry['offset'])
+        reader = _SliceReader(fp, entry['size'])
+        try:
+          tarstream.extract_stream(reader, directory, 'r|')
+        except tarstream.ExtractError as exc:
+          raise VendorError('{}: {}'.format(key, exc))
+        while reader.read(1 << 20):
+          pass
+      if reader.hasher.hexdigest() != entry['sha256']:
+        raise VendorError('{}: SHA256 mismatch in {}'.format(key, self.filename))
+      success = True
+    finally:
+      if not success:
+        path.remove(directory, recursive=True, silent=True)
+    logger.debug('extracted {} files of {} from {}'.format(
+        entry['files'], key, self.filename))
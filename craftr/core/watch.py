@@ -0,0 +1,343 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`craftr.core.watch`
+========================
+
+Support for ``craftr watch``, which keeps the build graph in memory and
+rebuilds when files change. :func:`create_watcher` returns an
+:class:`InotifyWatcher` on Linux and a :class:`PollingWatcher` everywhere
+else. The :class:`LiveSession` re-executes the modules whose Craftrfile or
+manifest changed and determines the targets that are affected by changed
+source files.
+"""
+
+from craftr.core.logging import logger
+from craftr.core.session import MANIFEST_FILENAME, ModuleNotFound
+from craftr.utils import path
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+#: The number of seconds to wait for further changes after a change was
+#: detected, as editors often write files in multiple steps.
+SETTLE_TIME = 0.1
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher(object):
+  """
+  Watches files with the Linux inotify API. The directories of the files
+  are watched rather than the files themselves, so that files which are
+  replaced by editors (written to a temporary file and renamed) are
+  detected as well.
+
+  :raise OSError: If inotify is not available.
+  """
+
+  MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+      IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+  def __init__(self):
+    if not sys.platform.startswith('linux'):
+      raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+    self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+        use_errno=True)
+    self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      code = ctypes.get_errno()
+      raise OSError(code, os.strerror(code))
+    self.files = set()
+    self.directories = {}  # maps watch descriptors to directories
+
+  def watch(self, filenames):
+    """
+    Set the files that are watched.
+    """
+
+    self.files = set(filenames)
+    watched = set(self.directories.values())
+    for directory in set(map(path.dirname, self.files)) - watched:
+      wd = self._libc.inotify_add_watch(self.fd,
+          os.fsencode(directory), self.MASK)
+      if wd >= 0:
+        self.directories[wd] = directory
+      else:
+        logger.debug('craftr: can not watch "{}": {}'.format(
+            directory, os.strerror(ctypes.get_errno())))
+
+  def _read_events(self, timeout):
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return set()
+    try:
+      data = os.read(self.fd, 65536)
+    except BlockingIOError:
+      return set()
+    changed = set()
+    offset = 0
+    while offset < len(data):
+      wd, mask, __, length = _EVENT_HEADER.unpack_from(data, offset)
+      offset += _EVENT_HEADER.size
+      name = data[offset:offset + length].rstrip(b'\0')
+      offset += length
+      if mask & IN_Q_OVERFLOW:
+        return set(self.files)
+      directory = self.directories.get(wd)
+      if directory is not None and name:
+        filename = path.join(directory, os.fsdecode(name))
+        if filename in self.files:
+          changed.add(filename)
+    return changed
+
+  def wait(self):
+    """
+    Wait until at least one of the watched files changed.
+
+    :return: A set of the changed filenames.
+    """
+
+    changed = set()
+    while not changed:
+      changed = self._read_events(None)
+    while True:
+      more = self._read_events(SETTLE_TIME)
+      if not more:
+        return changed
+      changed |= more
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+
+class PollingWatcher(object):
+  """
+  Watches files by periodically comparing their modification times.
+
+  :param interval: The number of seconds between two checks.
+  """
+
+  def __init__(self, interval=0.5):
+    self.interval = interval
+    self.files = {}
+
+  @staticmethod
+  def _stat(filename):
+    try:
+      st = os.stat(filename)
+    except OSError:
+      return None
+    return (st.st_mtime, st.st_size)
+
+  def watch(self, filenames):
+    """
+    Set the files that are watched.
+    """
+
+    old = self.files
+    self.files = {}
+    for filename in filenames:
+      self.files[filename] = old[filename] if filename in old else self._stat(filename)
+
+  def _poll(self):
+    changed = set()
+    for filename, value in self.files.items():
+      new_value = self._stat(filename)
+      if new_value != value:
+        self.files[filename] = new_value
+        changed.add(filename)
+    return changed
+
+  def wait(self):
+    """
+    Wait until at least one of the watched files changed.
+
+    :return: A set of the changed filenames.
+    """
+
+    changed = set()
+    while not changed:
+      time.sleep(self.interval)
+      changed = self._poll()
+    while True:
+      time.sleep(SETTLE_TIME)
+      more = self._poll()
+      if not more:
+        return changed
+      changed |= more
+
+  def close(self):
+    pass
+
+
+def create_watcher(polling=False):
+  """
+  Returns an :class:`InotifyWatcher` if it is available and *polling* is
+  not set, otherwise a :class:`PollingWatcher`.
+  """
+
+  if not polling:
+    try:
+      return InotifyWatcher()
+    except (OSError, AttributeError) as exc:
+      logger.debug('craftr: inotify not available ({}), polling files'.format(exc))
+  return PollingWatcher()
+
+
+class LiveSession(object):
+  """
+  Keeps the build graph of a :class:`Session` up to date with the files of
+  the executed modules.
+
+  :param session: The :class:`Session`.
+  :param module: The main :class:`Module`. It must have been executed.
+  """
+
+  def __init__(self, session, module):
+    self.session = session
+    self.module = module
+
+  def executed_modules(self):
+    """
+    Returns a list of all modules in the session that have been executed.
+    """
+
+    return self.session.executed_modules()
+
+  def module_files(self):
+    """
+    Returns a dictionary that maps the manifest and main script filenames
+    of the executed modules to the :class:`Module` objects.
+    """
+
+    result = {}
+    for module in self.executed_modules():
+      result[path.join(module.directory, MANIFEST_FILENAME)] = module
+      result[path.join(module.directory, module.manifest.main)] = module
+    return result
+
+  def source_files(self, deplog=None):
+    """
+    Returns a set of the files that targets in the graph read but that are
+    not produced by another target. If a :class:`executor.DepLog` is
+    specified, the recorded dependencies are included.
+    """
+
+    graph = self.session.graph
+    result = set()
+    for target in graph.targets.values():
+      result.update(target.inputs)
+      result.update(target.implicit_deps)
+    if deplog is not None:
+      for entry in deplog.entries.values():
+        if isinstance(entry, dict):
+          result.update(entry.get('deps', ()))
+    return set(x for x in result if x not in graph.outfiles)
+
+  def affected_targets(self, changed, deplog=None):
+    """
+    Returns a set of the names of the targets that read one of the
+    *changed* files, directly or through the outputs of other targets.
+    """
+
+    graph = self.session.graph
+    readers = {}
+    for target in graph.targets.values():
+      for filename in target.inputs + target.implicit_deps:
+        readers.setdefault(filename, []).append(target)
+    if deplog is not None:
+      for outfile, entry in deplog.entries.items():
+        target = graph.outfiles.get(outfile)
+        if target is not None and isinstance(entry, dict):
+          for filename in entry.get('deps', ()):
+            readers.setdefault(filename, []).append(target)
+
+    result = set()
+    stack = list(changed)
+    while stack:
+      for target in readers.get(stack.pop(), ()):
+        if target.name not in result:
+          result.add(target.name)
+          stack.extend(target.outputs)
+    return result
+
+  def reload(self, modules, manifests=()):
+    """
+    Re-execute the specified *modules* and all modules that depend on
+    them. The targets and tools that these modules created are removed
+    from the graph first. The manifests of the *manifests* modules are
+    parsed again.
+
+    :raise Manifest.Invalid: If a manifest is invalid.
+    :raise Exception: Any exception raised while executing the modules.
+    """
+
+    executed = self.executed_modules()
+    dependents = {}
+    for module in executed:
+      for name, version in module.manifest.dependencies.items():
+        try:
+          dependency = self.session.find_module(name, version)
+        except ModuleNotFound:
+          continue
+        dependents.setdefault(id(dependency), []).append(module)
+
+    affected = {}
+    stack = list(modules)
+    while stack:
+      module = stack.pop()
+      if id(module) not in affected:
+        affected[id(module)] = module
+        stack.extend(dependents.get(id(module), ()))
+
+    graph = self.session.graph
+    prefixes = tuple(m.ident + '.' for m in affected.values())
+    for name in [x for x in graph.targets if x.startswith(prefixes)]:
+      graph.remove_target(name)
+    for name in [x for x in graph.tools if x.startswith(prefixes)]:
+      graph.remove_tool(name)
+
+    for module in affected.values():
+      if module in manifests:
+        new_module = self.session.reload_manifest(module)
+        if module is self.module:
+          self.module = new_module
+      else:
+        module.reset()
+
+    logger.info('craftr: re-executing {}'.format(
+        ', '.join(sorted(m.ident for m in affected.values()))))
+    if not self.module.executed:
+      self.module.run()
@@ -108,8 +108,8 @@ def relocate_files(files, outdir, suffix, replace_suffix=True, parent=None):
   if parent is None:
     parent = session.module.project_dir
   result = []
-  for filename in files:
-    filename = path.join(outdir, path.rel(filename, parent))
+  for filename in path.rel_list(files, parent):
+    filename = path.join(outdir, filename)
     filename = path.addsuffix(filename, suffix, replace=replace_suffix)
     result.append(filename)
   return result
@@ -249,6 +249,18 @@ def gentool(commands, preamble=None, environ=None, name=None):
   return tool
 
 
+def genpool(name, depth):
+  """
+  Add a pool with the specified *name* and *depth* to the build graph and
+  return the *name*, to be passed as the *pool* of targets. If the pool
+  already exists, its depth is not changed.
+  """
+
+  if name not in session.graph.pools:
+    session.graph.add_pool(name, depth)
+  return name
+
+
 def gentarget(commands, inputs=(), outputs=(), *args, **kwargs):
   """
   Create a :class:`~_build.Target` object. The name of the target will be
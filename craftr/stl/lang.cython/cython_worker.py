@@ -0,0 +1,53 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Persistent worker for the Cython compiler. It accepts the same arguments
+as the ``cython`` command via the :mod:`craftr.core.persistent` protocol.
+"""
+
+from craftr.core import persistent
+from Cython.Compiler import Errors, Options
+from Cython.Compiler.CmdLine import parse_command_line
+from Cython.Compiler.Main import compile as cython_compile
+
+import copy
+
+# The command-line parser modifies global options, eg. for --embed. We
+# restore them before every compilation.
+_default_options = {k: copy.copy(v) for k, v in vars(Options).items()
+    if not k.startswith('__') and not callable(v) and not hasattr(v, '__file__')}
+
+
+def reset_options():
+  for key, value in _default_options.items():
+    setattr(Options, key, copy.copy(value))
+  if hasattr(Errors, 'init_thread'):
+    Errors.init_thread()
+
+
+def compile(arguments):
+  reset_options()
+  options, sources = parse_command_line(arguments)
+  try:
+    result = cython_compile(sources, options)
+  except (EnvironmentError, Errors.PyrexError) as exc:
+    print(exc)
+    return 1
+  return 1 if result.num_errors > 0 else 0
+
+
+if __name__ == '__main__':
+  persistent.serve(compile)
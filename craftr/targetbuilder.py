@@ -23,11 +23,12 @@ Provides the :class:`TargetBuilder` and :class:`Framework` classes.
 from craftr.core import build
 from craftr.core.logging import logger
 from craftr.core.session import session
-from craftr.utils import argspec, pyutils
+from craftr.utils import argspec
 from nr.py.bytecode import get_assigned_name
 
 import collections
 import sys
+import weakref
 
 
 def get_full_name(target_name, module=None):
@@ -47,6 +48,36 @@ def get_full_name(target_name, module=None):
   return '{}.{}'.format(module.ident, target_name)
 
 
+#: Maps a code object to a dictionary that maps instruction offsets to the
+#: result of :func:`get_assigned_name`, which is either the name or the
+#: arguments of the :class:`ValueError` that was raised. The entries are
+#: dropped with the code object, eg. when a module is executed again.
+_assigned_name_cache = weakref.WeakKeyDictionary()
+
+
+def _get_assigned_name(frame):
+  """
+  Memoized version of :func:`get_assigned_name`. The result only depends
+  on the bytecode of the *frame* and its current instruction offset.
+  """
+
+  try:
+    offsets = _assigned_name_cache[frame.f_code]
+  except KeyError:
+    offsets = _assigned_name_cache[frame.f_code] = {}
+  try:
+    name, error = offsets[frame.f_lasti]
+  except KeyError:
+    try:
+      name, error = get_assigned_name(frame), None
+    except ValueError as exc:
+      name, error = None, exc.args
+    offsets[frame.f_lasti] = (name, error)
+  if error is not None:
+    raise ValueError(*error)
+  return name
+
+
 def gtn(target_name=None, name_hint=NotImplemented):
   """
   This function is mandatory in combination with the :class:`TargetBuilder`
@@ -90,7 +121,7 @@ def gtn(target_name=None, name_hint=NotImplemented):
 
   if target_name is None:
     try:
-      target_name = get_assigned_name(sys._getframe(2))
+      target_name = _get_assigned_name(sys._getframe(2))
     except ValueError:
       if name_hint is NotImplemented:
         raise
@@ -104,13 +135,16 @@ def gtn(target_name=None, name_hint=NotImplemented):
     if name_hint is None:
       return None
 
-    index = 0
+    # Continue counting from the last index generated for this hint in
+    # the module. Names may still be taken by explicitly named targets.
+    index = module.target_name_counters.get(name_hint, 0)
     while True:
       target_name = '{}_{:0>4}'.format(name_hint, index)
       full_name = get_full_name(target_name, module)
+      index += 1
       if full_name not in session.graph.targets:
         break
-      index += 1
+    module.target_name_counters[name_hint] = index
 
   if full_name is None:
     full_name = get_full_name(target_name, module)
@@ -142,20 +176,13 @@ class TargetBuilder(object):
 
   def __init__(self, name, option_kwargs=None, frameworks=(), inputs=(),
       outputs=(), implicit_deps=(), order_only_deps=()):
-    argspec.validate('name', name, {'type': str})
-    argspec.validate('option_kwargs', option_kwargs,
-        {'type': [None, dict, Framework]})
-    argspec.validate('frameworks', frameworks,
-        {'type': [list, tuple], 'items': {'type': Framework}})
-    argspec.validate('inputs', inputs,
-        {'type': [list, tuple, build.Target],
-          'items': {'type': [str, build.Target]}})
-    argspec.validate('outputs', outputs,
-        {'type': [list, tuple], 'items': {'type': str}})
-    argspec.validate('implicit_deps', implicit_deps,
-        {'type': [list, tuple], 'items': {'type': str}})
-    argspec.validate('order_only_deps', order_only_deps,
-        {'type': [list, tuple], 'items': {'type': str}})
+    _check_name('name', name)
+    _check_option_kwargs('option_kwargs', option_kwargs)
+    _check_frameworks('frameworks', frameworks)
+    _check_inputs('inputs', inputs)
+    _check_files('outputs', outputs)
+    _check_files('implicit_deps', implicit_deps)
+    _check_files('order_only_deps', order_only_deps)
 
     self.frameworks = list(frameworks)
     if isinstance(inputs, build.Target):
@@ -165,9 +192,13 @@ class TargetBuilder(object):
     # and append the frameworks.
     if inputs is not None:
       self.inputs = []
+      seen = set(map(id, self.frameworks))
       for input_ in (inputs or ()):
         if isinstance(input_, build.Target):
-          pyutils.unique_extend(self.frameworks, input_.frameworks)
+          for fw in expand_frameworks(input_.frameworks):
+            if id(fw) not in seen:
+              seen.add(id(fw))
+              self.frameworks.append(fw)
           self.inputs += input_.outputs
         else:
           self.inputs.append(input_)
@@ -180,8 +211,8 @@ class TargetBuilder(object):
     self.name = name
     self.option_kwargs = Framework(name, **option_kwargs)
     self.option_kwargs_defaults = Framework(name + "_defaults")
-    self.options_merge = OptionMerge(self.option_kwargs,
-        self.option_kwargs_defaults, *self.frameworks)
+    self.options_merge = OptionMerge(*self.frameworks,
+        local=(self.option_kwargs, self.option_kwargs_defaults))
     assert self.option_kwargs in self.options_merge.frameworks
     self.outputs = list(outputs)
     self.implicit_deps = list(implicit_deps)
@@ -248,15 +279,118 @@ class Framework(dict):
   """
   A framework is simply a dictionary with a name to identify it. Frameworks
   are used to represent build options.
+
+  .. attribute:: version
+
+    Incremented whenever this framework is modified. Data that is derived
+    from frameworks, like the index of an :class:`OptionMerge`, remembers
+    the versions of the frameworks it was computed from.
+
+  .. attribute:: generation
+
+    A class-level counter that is incremented whenever any Framework is
+    modified. As long as it did not change, the versions of the frameworks
+    don't need to be compared.
   """
 
+  generation = 0
+
   def __init__(self, __name, **kwargs):
     super().__init__(**kwargs)
     self.name = __name
+    self.version = 0
 
   def __repr__(self):
     return '<Framework "{}": {}>'.format(self.name, super().__repr__())
 
+  def _modified(self):
+    self.version += 1
+    Framework.generation += 1
+
+  def __setitem__(self, key, value):
+    self._modified()
+    super().__setitem__(key, value)
+
+  def __delitem__(self, key):
+    self._modified()
+    super().__delitem__(key)
+
+  def clear(self):
+    self._modified()
+    super().clear()
+
+  def pop(self, *args):
+    self._modified()
+    return super().pop(*args)
+
+  def popitem(self):
+    self._modified()
+    return super().popitem()
+
+  def setdefault(self, key, default=None):
+    self._modified()
+    return super().setdefault(key, default)
+
+  def update(self, *args, **kwargs):
+    self._modified()
+    super().update(*args, **kwargs)
+
+
+#: Maps a tuple of framework IDs to a tuple of the frameworks (to keep the
+#: IDs valid), the result of :func:`expand_frameworks` and the IDs in the
+#: ``'frameworks'`` key of every framework in the result.
+_closure_cache = {}
+_closure_cache_size = 1024
+
+
+def _get_edges(frameworks):
+  return tuple(tuple(map(id, fw.get('frameworks', ()))) for fw in frameworks)
+
+
+def expand_frameworks(frameworks):
+  """
+  Returns a tuple of the *frameworks* and all frameworks listed in their
+  ``'frameworks'`` key, recursively. Every framework is only included once
+  (compared by identity) and the order is that of a depth-first traversal.
+  The result is memoized until the ``'frameworks'`` key of one of the
+  frameworks is assigned or its list is modified.
+
+  :raise TypeError: If a non-:class:`Framework` object is encountered.
+  """
+
+  frameworks = tuple(frameworks)
+  key = tuple(map(id, frameworks))
+  entry = _closure_cache.get(key)
+  if entry is not None and entry[2] == _get_edges(entry[1]):
+    return entry[1]
+
+  seen = set()
+  result = []
+  def update(fw):
+    if not isinstance(fw, Framework):
+      raise TypeError('expected Framework, got {}'.format(type(fw).__name__))
+    if id(fw) in seen:
+      return
+    seen.add(id(fw))
+    result.append(fw)
+    [update(x) for x in fw.get('frameworks', ())]
+  [update(x) for x in frameworks]
+
+  result = tuple(result)
+  if len(_closure_cache) >= _closure_cache_size:
+    _closure_cache.clear()
+  _closure_cache[key] = (frameworks, result, _get_edges(result))
+  return result
+
+
+_check_name = argspec.compile({'type': str})
+_check_option_kwargs = argspec.compile({'type': [None, dict, Framework]})
+_check_frameworks = argspec.compile(
+    {'type': [list, tuple], 'items': {'type': Framework}})
+_check_inputs = argspec.compile(
+    {'type': [list, tuple, build.Target], 'items': {'type': [str, build.Target]}})
+_check_files = argspec.compile({'type': [list, tuple], 'items': {'type': str}})
+
 
 class OptionMerge(object):
   """
@@ -264,29 +398,58 @@ class OptionMerge(object):
   in the first dictionaries passed to the constructor take precedence over the
   last.
 
+  Lookups are served from an :class:`_OptionIndex` that maps every key to
+  its first value and to the list values that :meth:`get_list` concatenates.
+  The index is shared by all OptionMerge objects with the same frameworks
+  and is rebuilt only when one of them was modified. The *local* frameworks
+  are not part of the index, they are looked up directly, thus modifying
+  them does not invalidate the index.
+
   :param frameworks: One or more :class:`Framework` objects. Note that
     the constructor will expand and flatten the ``'frameworks'`` list.
+  :param local: A sequence of :class:`Framework` objects that are only
+    used by this OptionMerge, like the options of a :class:`TargetBuilder`.
+    They take precedence over the *frameworks*.
   """
 
-  def __init__(self, *frameworks):
+  def __init__(self, *frameworks, local=()):
+    local = tuple(local)
     self.frameworks = []
-    [self.append(x) for x in frameworks]
+    self._ids = set()
+    self._local = ()
+    self._shared = []
+    self._index = None
+    if not any('frameworks' in fw for fw in local):
+      # Otherwise the local frameworks would not be the first frameworks
+      # in the expanded list and can not be looked up before the index.
+      self._local = expand_frameworks(local)
+      self._add(self._local, local=True)
+      local = ()
+    self._add(expand_frameworks(local + frameworks))
 
   def __getitem__(self, key):
-    for options in self.frameworks:
-      try:
-        return options[key]
-      except KeyError:
-        pass  # intentional
-    raise KeyError(key)
+    for fw in self._local:
+      if key in fw:
+        return fw[key]
+    return self._get_index().first[key]
+
+  def _add(self, frameworks, local=False):
+    for fw in frameworks:
+      if id(fw) not in self._ids:
+        self._ids.add(id(fw))
+        self.frameworks.append(fw)
+        if not local:
+          self._shared.append(fw)
+          self._index = None
+
+  def _get_index(self):
+    index = self._index
+    if index is None or not index.is_current():
+      index = self._index = _get_option_index(self._shared)
+    return index
 
   def append(self, framework):
-    def update(fw):
-      if not isinstance(framework, Framework):
-        raise TypeError('expected Framework, got {}'.format(type(fw).__name__))
-      pyutils.unique_append(self.frameworks, fw, id_compare=True)
-      [update(x) for x in fw.get('frameworks', [])]
-    update(framework)
+    self._add(expand_frameworks([framework]))
 
   def get(self, key, default=None):
     try:
@@ -303,12 +466,85 @@ class OptionMerge(object):
     """
 
     result = []
-    for option in self.frameworks:
-      value = option.get(key)
-      if value is None:
-        continue
-      if not isinstance(value, collections.Sequence):
-        raise ValueError('found "{}" for key "{}" which is a non-sequence'
-            .format(tpye(value).__name__, key))
-      result += value
+    for fw in self._local:
+      value = fw.get(key)
+      if value is not None:
+        result += _check_sequence(key, value)
+    result += self._get_index().get_list(key)
+    return result
+
+
+def _check_sequence(key, value):
+  if not isinstance(value, collections.Sequence):
+    raise ValueError('found "{}" for key "{}" which is a non-sequence'
+        .format(type(value).__name__, key))
+  return value
+
+
+#: Maps a tuple of framework IDs to the :class:`_OptionIndex` of these
+#: frameworks. The index keeps the frameworks alive, thus the IDs stay valid.
+_index_cache = {}
+_index_cache_size = 1024
+
+
+def _get_option_index(frameworks):
+  key = tuple(map(id, frameworks))
+  index = _index_cache.get(key)
+  if index is None or not index.is_current():
+    index = _OptionIndex(frameworks)
+    if len(_index_cache) >= _index_cache_size:
+      _index_cache.clear()
+    _index_cache[key] = index
+  return index
+
+
+class _OptionIndex(object):
+  """
+  The flattened view of a list of frameworks used by :class:`OptionMerge`.
+
+  .. attribute:: first
+
+    Maps every key to the value of the first framework that contains it.
+
+  .. attribute:: lists
+
+    Maps every key to the list of non-None values in framework order.
+  """
+
+  def __init__(self, frameworks):
+    self.frameworks = tuple(frameworks)
+    self.versions = tuple(fw.version for fw in self.frameworks)
+    self.generation = Framework.generation
+    self.first = {}
+    self.lists = {}
+    for fw in reversed(self.frameworks):
+      self.first.update(fw)
+    for fw in self.frameworks:
+      for key, value in fw.items():
+        if value is not None:
+          self.lists.setdefault(key, []).append(value)
+
+  def is_current(self):
+    """
+    Returns :const:`True` if none of the frameworks was modified since the
+    index was built.
+    """
+
+    if self.generation != Framework.generation:
+      for fw, version in zip(self.frameworks, self.versions):
+        if fw.version != version:
+          return False
+      self.generation = Framework.generation
+    return True
+
+  def get_list(self, key):
+    """
+    Returns the concatenation of the list values for *key*. It is not
+    memoized since the values can be modified in place (eg. with
+    ``fw['defines'].append(...)``) without invalidating the index.
+    """
+
+    result = []
+    for value in self.lists.get(key, ()):
+      result += _check_sequence(key, value)
     return result
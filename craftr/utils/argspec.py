@@ -16,9 +16,105 @@
 
 import collections
 
+
 def tn(value):
   return type(value).__name__
 
+
+class _Failure(Exception):
+  """
+  Raised by the inner checker functions generated by :func:`compile`. The
+  argument name is only formatted when the failure reaches the outermost
+  validator, so succeeding validations never build name strings.
+  """
+
+  def __init__(self, exc_type, message, *format_args):
+    super().__init__(message)
+    self.exc_type = exc_type
+    self.message = message
+    self.format_args = format_args
+    self.indices = []
+
+  def format_name(self, name):
+    return name + ''.join('[{}]'.format(x) for x in reversed(self.indices))
+
+  def to_exception(self, name):
+    return self.exc_type(self.message.format(
+        self.format_name(name), *self.format_args))
+
+
+def _normalize(value):
+  if value is None:
+    return ()
+  if isinstance(value, (list, tuple)):
+    return tuple(value)
+  return (value,)
+
+
+def _compile(schema):
+  types = tuple(type(None) if x is None else x for x in _normalize(schema.get('type')))
+  bool_validators = _normalize(schema.get('bool_validators'))
+  validators = _normalize(schema.get('validators'))
+  allow_empty = schema.get('allowEmpty', True)
+  items = _compile(schema['items']) if 'items' in schema else None
+  check_sequence = items is not None or not allow_empty
+  Sequence = collections.Sequence
+
+  def check(value):
+    if types and not isinstance(value, types):
+      raise _Failure(TypeError, "argument '{}' expected one of {} but got {}",
+        '{'+','.join(x.__name__ for x in types)+'}', tn(value))
+    if check_sequence and isinstance(value, Sequence):
+      if items is not None:
+        index = 0
+        try:
+          for index, item in enumerate(value):
+            items(item)
+        except _Failure as exc:
+          exc.indices.append(index)
+          raise
+      if not allow_empty and not value:
+        raise _Failure(ValueError, "argument '{}' can not be empty")
+    for validator in bool_validators:
+      if not validator(value):
+        raise _Failure(TypeError, "argument '{}' is not {}", validator.__name__)
+    for validator in validators:
+      validator(value)
+
+  return check
+
+
+def compile(schema):
+  """
+  Compiles the *schema* into a validator function that can be called with
+  the arguments ``(name, value)``. The schema is read once and is not
+  modified. Use this function to create module-level validators for
+  functions that are called very often.
+
+  .. code:: python
+
+    _check_files = argspec.compile({'type': [list, tuple], 'items': {'type': str}})
+
+    def foo(inputs):
+      _check_files('inputs', inputs)
+
+  See :func:`validate` for the supported schema keys.
+
+  :return: A function that raises :class:`TypeError` or :class:`ValueError`
+    if the value passed to it does not match the *schema*.
+  """
+
+  check = _compile(schema)
+
+  def validator(name, value):
+    try:
+      check(value)
+    except _Failure as exc:
+      raise exc.to_exception(name) from None
+
+  return validator
+
+
 def validate(name, value, schema):
   """
   A helper function to validate function parameters type and value.
@@ -34,35 +130,8 @@ def validate(name, value, schema):
     not be applied to iterables.
   - ``allowEmpty``: If specified, must be True or False. If True, allows
     *value* to be an empty sequence, otherwise not.
+
+  Prefer :func:`compile` for validations that are performed repeatedly.
   """
 
-  schema.setdefault('type', [])
-  schema.setdefault('bool_validators', [])
-  schema.setdefault('validators', [])
-
-  if isinstance(schema['type'], list):
-    schema['type'] = tuple(schema['type'])
-  elif not isinstance(schema['type'], tuple):
-    schema['type'] = (schema['type'],)
-  schema['type'] = tuple(type(None) if x is None else x for x in schema['type'])
-
-  if schema['type'] and not isinstance(value, schema['type']):
-    raise TypeError("argument '{}' expected one of {} but got {}".format(
-      name, '{'+','.join(x.__name__ for x in schema['type'])+'}', tn(value)))
-  if isinstance(value, collections.Sequence):
-    if 'items' in schema:
-      for index, item in enumerate(value):
-        validate('{}[{}]'.format(name, index), item, schema['items'])
-    if not schema.get('allowEmpty', True) and not value:
-      raise ValueError("argument '{}' can not be empty".format(name))
-
-  if not isinstance(schema['bool_validators'], (list, tuple)):
-    schema['bool_validators'] = [schema['bool_validators']]
-  for validator in schema['bool_validators']:
-    if not validator(value):
-      raise TypeError("argument '{}' is not {}".format(name, validator.__name__))
-
-  if not isinstance(schema['validators'], (list, tuple)):
-    schema['validators'] = [schema['validators']]
-  for validator in schema['validators']:
-    validator(value)
+  compile(schema)(name, value)
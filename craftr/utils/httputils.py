@@ -14,11 +14,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from craftr.core.logging import logger
 from craftr.utils import argspec
 from craftr.utils import path
 from urllib.error import URLError, HTTPError
 
 import cgi
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import queue
+import threading
+import time
+import urllib.parse
 import urllib.request
 
 
@@ -28,8 +38,41 @@ class UserInterrupt(Exception):
   """
 
 
+class ChecksumError(Exception):
+  """
+  Raised by :func:`download_file` if the SHA256 hash of a downloaded file
+  does not match the expected hash.
+  """
+
+  def __init__(self, url, expected, actual):
+    self.url = url
+    self.expected = expected
+    self.actual = actual
+
+  def __str__(self):
+    return 'SHA256 mismatch for {}: expected {}, got {}'.format(
+        self.url, self.expected, self.actual)
+
+
+class _RangeIgnored(Exception):
+  # Raised when the server answers a range request with the full file,
+  # eg. because the file changed since the download was started.
+  pass
+
+
+#: The minimum and maximum number of bytes that are read at once if the
+#: chunk size is adapted to the speed of the connection.
+MIN_CHUNKSIZE = 16 * 1024
+MAX_CHUNKSIZE = 1024 * 1024
+
+#: The minimum number of bytes that are downloaded per connection when a
+#: file is downloaded with multiple range requests in parallel.
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+
 def download_file(url, filename=None, file=None, directory=None,
-    on_exists='rename', progress=None, chunksize=4096, urlopen_kwargs=None):
+    on_exists='rename', progress=None, chunksize=None, urlopen_kwargs=None,
+    sha256=None, connections=4):
   """
   Download a file from a URL to one of the following destinations:
 
@@ -42,23 +85,38 @@ def download_file(url, filename=None, file=None, directory=None,
   Additional parameters for the *directory* parameter:
 
   :param on_exists: The operation to perform when the file already exists.
-    Available modes are ``rename``, ``overwrite`` and ``skip``.
+    Available modes are ``rename``, ``overwrite`` and ``skip``. An existing
+    file is not skipped if it does not match the *sha256*.
 
   Additional parameters:
 
   :param progress: A callable that accepts a single parameter that is a
     dictionary with information about the progress of the download. The
-    dictionary provides the keys ``size``,  ``downloaded`` and ``response``.
-    If the callable returns :const:`False` (specifically the value False), the
-    download will be aborted and a :class:`UserInterrupt` will be raised.
+    dictionary provides the keys ``size``,  ``downloaded``, ``resumed``,
+    ``begin``, ``completed`` and ``response``. ``begin`` is True only for
+    the first call. If the callable returns :const:`False` (specifically
+    the value False), the download will be aborted and a
+    :class:`UserInterrupt` will be raised.
+  :param chunksize: The number of bytes to read at once. If :const:`None`,
+    the chunk size is adapted to the speed of the connection.
   :param urlopen_kwargs: A dictionary with additional keyword arguments
     for :func:`urllib.request.urlopen`.
+  :param sha256: The expected SHA256 hash of the file as hex string.
+  :param connections: The maximum number of parallel range requests for
+    large files if the server supports them.
+
+  When downloading to a file, the data is written to a ``.part`` file
+  first. If the server supports range requests and identifies the file
+  with an ``ETag`` or ``Last-Modified`` header, the ``.part`` file is kept
+  when the download fails and a later download of the same URL resumes it.
 
   Raise and return:
 
   :raise HTTPError: Can be raised by :func:`urllib.request.urlopen`.
   :raise URLError: Can be raised by :func:`urllib.request.urlopen`.
   :raise UserInterrupt: If the *progress* returned :const:`False`.
+  :raise ChecksumError: If the file does not match the *sha256*. The file
+    is deleted, unless the destination is a file-like object.
   :return: If the download mode is *directory*, the name of the downloaded
     file will be returned and False if the file was newly downloaded, True
     if the download was skipped because the file already existed.
@@ -70,68 +128,376 @@ def download_file(url, filename=None, file=None, directory=None,
   if sum(map(bool, [filename, file, directory])) != 1:
     raise ValueError('exactly one of filename, file or directory must be specifed')
 
-  response = urllib.request.urlopen(url, **(urlopen_kwargs or {}))
+  if sha256:
+    sha256 = sha256.lower()
+  urlopen_kwargs = urlopen_kwargs or {}
+  response = urllib.request.urlopen(url, **urlopen_kwargs)
+  try:
+    if directory:
+      try:
+        filename = parse_content_disposition(
+          response.headers.get('Content-Disposition', ''))
+      except ValueError:
+        filename = url.split('/')[-1]
+      filename = path.join(directory, filename)
+      path.makedirs(directory)
+
+      if path.exists(filename) and sha256 and on_exists == 'skip' \
+          and _hash_file(filename) != sha256:
+        on_exists = 'overwrite'
+      if path.exists(filename):
+        if on_exists == 'skip':
+          return filename, True
+        elif on_exists == 'rename':
+          index = 0
+          while True:
+            new_filename = filename + '_{:0>4}'.format(index)
+            if not path.exists(new_filename):
+              filename = new_filename
+              break
+            index += 1
+        elif on_exists != 'overwrite':
+          raise RuntimeError
+
+    if file:
+      downloaded = _download_stream(url, response, file, progress, chunksize, sha256)
+    else:
+      try:
+        downloaded = _PartialDownload(url, response, filename, urlopen_kwargs,
+            chunksize, connections).run(progress, sha256)
+      except _RangeIgnored:
+        # The file changed on the server, start over.
+        response.close()
+        response = urllib.request.urlopen(url, **urlopen_kwargs)
+        downloaded = _PartialDownload(url, response, filename, urlopen_kwargs,
+            chunksize, connections, restart=True).run(progress, sha256)
+  finally:
+    response.close()
 
   if directory:
-    try:
-      filename = parse_content_disposition(
-        response.headers.get('Content-Disposition', ''))
-    except ValueError:
-      filename = url.split('/')[-1]
-    filename = path.join(directory, filename)
-    path.makedirs(directory)
-
-    if path.exists(filename):
-      if on_exists == 'skip':
-        return filename, True
-      elif on_exists == 'rename':
-        index = 0
-        while True:
-          new_filename = filename + '_{:0>4}'.format(index)
-          if not path.exists(new_filename):
-            filename = new_filename
-            break
-          index += 1
-      elif on_exists != 'overwrite':
-        raise RuntimeError
+    return filename, False
+  return downloaded
+
 
+def _get_size(response):
   try:
-    size = int(response.headers.get('Content-Length', ''))
+    return int(response.headers.get('Content-Length', ''))
   except ValueError:
-    size = None
+    return None
 
-  progress_info = {'response': response, 'size': size, 'downloaded': 0,
-    'completed': False, 'filename': filename}
-  if progress and progress(progress_info) is False:
-    raise UserInterrupt
 
-  def copy_to_file(fp):
+def _iter_chunks(response, chunksize=None, limit=None):
+  """
+  Read the *response* in chunks of *chunksize* bytes, or adapt the chunk
+  size to the speed of the connection if *chunksize* is :const:`None`.
+  Reads at most *limit* bytes if specified.
+  """
+
+  adaptive = chunksize is None
+  if adaptive:
+    chunksize = MIN_CHUNKSIZE * 4
+  while limit is None or limit > 0:
+    count = chunksize if limit is None else min(chunksize, limit)
+    tstart = time.perf_counter()
+    data = response.read(count)
+    if not data:
+      break
+    if limit is not None:
+      limit -= len(data)
+    if adaptive:
+      elapsed = time.perf_counter() - tstart
+      if elapsed < 0.05 and len(data) == chunksize:
+        chunksize = min(chunksize * 2, MAX_CHUNKSIZE)
+      elif elapsed > 0.5:
+        chunksize = max(chunksize // 2, MIN_CHUNKSIZE)
+    yield data
+
+
+def _hash_file(filename, blocksize=1 << 20):
+  hasher = hashlib.sha256()
+  with open(filename, 'rb') as fp:
     while True:
-      data = response.read(chunksize)
+      data = fp.read(blocksize)
       if not data:
         break
-      progress_info['downloaded'] += len(data)
-      fp.write(data)
+      hasher.update(data)
+  return hasher.hexdigest()
+
+
+def _download_stream(url, response, file, progress, chunksize, sha256):
+  hasher = hashlib.sha256() if sha256 else None
+  progress_info = {'response': response, 'size': _get_size(response),
+    'downloaded': 0, 'resumed': 0, 'begin': True, 'completed': False,
+    'filename': None}
+  if progress and progress(progress_info) is False:
+    raise UserInterrupt
+  progress_info['begin'] = False
+  for data in _iter_chunks(response, chunksize):
+    progress_info['downloaded'] += len(data)
+    file.write(data)
+    if hasher:
+      hasher.update(data)
+    if progress and progress(progress_info) is False:
+      raise UserInterrupt
+  size = progress_info['size']
+  if size is not None and progress_info['downloaded'] != size:
+    raise URLError('incomplete download of {} ({} of {} bytes)'.format(
+        url, progress_info['downloaded'], size))
+  if hasher and hasher.hexdigest() != sha256:
+    raise ChecksumError(url, sha256, hasher.hexdigest())
+  progress_info['completed'] = True
+  if progress and progress(progress_info) is False:
+    raise UserInterrupt
+  return progress_info['downloaded']
+
+
+class _PartialDownload(object):
+  """
+  Downloads a URL into a ``.part`` file next to *filename*, in segments
+  with parallel range requests if the server supports them. The progress
+  of every segment is stored in a ``.part.json`` file so that the download
+  can be resumed.
+  """
+
+  def __init__(self, url, response, filename, urlopen_kwargs, chunksize,
+      connections, restart=False):
+    self.url = url
+    self.response = response
+    self.filename = filename
+    self.partfile = filename + '.part'
+    self.infofile = filename + '.part.json'
+    self.urlopen_kwargs = urlopen_kwargs
+    self.chunksize = chunksize
+    self.size = _get_size(response)
+    self.validator = response.headers.get('ETag')
+    if not self.validator or self.validator.startswith('W/'):
+      # Weak ETags can not be used with If-Range.
+      self.validator = response.headers.get('Last-Modified')
+    self.ranges = response.headers.get('Accept-Ranges', '').lower() == 'bytes' \
+        and self.size is not None
+    self.resumable = self.ranges and bool(self.validator)
+    self.lock = threading.Lock()
+    self.cancelled = threading.Event()
+    self.connections = connections
+    self.segments = None if restart else self._load_segments()
+
+  def _load_segments(self):
+    if not self.resumable:
+      return None
+    try:
+      with open(self.infofile) as fp:
+        info = json.load(fp)
+      if info['url'] != self.url or info['size'] != self.size \
+          or info['validator'] != self.validator \
+          or os.path.getsize(self.partfile) != self.size:
+        return None
+      return [list(x) for x in info['segments']]
+    except (OSError, ValueError, KeyError, TypeError):
+      return None
+
+  def _create_segments(self):
+    connections = self.connections
+    if self.ranges and connections > 1 and self.size >= 2 * MIN_SEGMENT_SIZE:
+      count = min(connections, self.size // MIN_SEGMENT_SIZE)
+    else:
+      count = 1
+    if self.size is None:
+      segments = [[0, None, 0]]
+    else:
+      bounds = [self.size * i // count for i in range(count + 1)]
+      segments = [[bounds[i], bounds[i + 1], bounds[i]] for i in range(count)]
+    with open(self.partfile, 'wb') as fp:
+      if self.size is not None:
+        fp.truncate(self.size)
+    return segments
+
+  def _save_segments(self):
+    if not self.resumable or self.segments is None:
+      return
+    with self.lock:
+      info = {'url': self.url, 'size': self.size, 'validator': self.validator,
+          'segments': [list(x) for x in self.segments]}
+    with open(self.infofile + '.tmp', 'w') as fp:
+      json.dump(info, fp)
+    os.replace(self.infofile + '.tmp', self.infofile)
+
+  def _remove(self):
+    for filename in (self.partfile, self.infofile):
+      path.remove(filename, silent=True)
+
+  def _fetch(self, segment, response):
+    start, end, pos = segment
+    if response is None:
+      headers = {'Range': 'bytes={}-{}'.format(pos, end - 1)}
+      if self.validator:
+        headers['If-Range'] = self.validator
+      request = urllib.request.Request(self.url, headers=headers)
+      response = urllib.request.urlopen(request, **self.urlopen_kwargs)
+      if response.status != 206:
+        response.close()
+        raise _RangeIgnored
+    try:
+      limit = None if end is None else end - pos
+      with open(self.partfile, 'r+b', buffering=0) as fp:
+        fp.seek(pos)
+        for data in _iter_chunks(response, self.chunksize, limit):
+          if self.cancelled.is_set():
+            return
+          fp.write(data)
+          with self.lock:
+            segment[2] += len(data)
+            self.downloaded += len(data)
+    finally:
+      response.close()
+
+  def run(self, progress, sha256):
+    """
+    Download the file and rename the ``.part`` file to the target filename.
+
+    :return: The number of bytes of the file.
+    """
+
+    resumed = sum(pos - start for start, end, pos in self.segments or ())
+    self.downloaded = resumed
+    progress_info = {'response': self.response, 'size': self.size,
+      'downloaded': resumed, 'resumed': resumed, 'begin': True,
+      'completed': False, 'filename': self.filename}
+    if resumed:
+      logger.debug('resuming download of {} at {} bytes'.format(self.url, resumed))
+
+    success = False
+    try:
       if progress and progress(progress_info) is False:
         raise UserInterrupt
+      progress_info['begin'] = False
+      if self.segments is None:
+        self.segments = self._create_segments()
+        self._save_segments()
+
+      # The response of the initial request is used for the first segment
+      # unless it is resumed.
+      pending = [x for x in self.segments if x[1] is None or x[2] < x[1]]
+      jobs = []
+      for segment in pending:
+        fresh = segment[0] == 0 and segment[2] == 0
+        jobs.append((segment, self.response if fresh else None))
+
+      with concurrent.futures.ThreadPoolExecutor(max(1, len(jobs))) as pool:
+        futures = [pool.submit(self._fetch, *job) for job in jobs]
+        last_save = time.time()
+        try:
+          while True:
+            done, not_done = concurrent.futures.wait(futures, timeout=0.1,
+                return_when=concurrent.futures.FIRST_EXCEPTION)
+            for future in done:
+              future.result()  # raise the exception of a failed segment
+            if progress_info['downloaded'] != self.downloaded:
+              progress_info['downloaded'] = self.downloaded
+              if progress and progress(progress_info) is False:
+                raise UserInterrupt
+            if not not_done:
+              break
+            if time.time() - last_save > 1.0:
+              self._save_segments()
+              last_save = time.time()
+        except BaseException:
+          self.cancelled.set()
+          raise
+
+      if self.size is not None and self.downloaded != self.size:
+        raise URLError('incomplete download of {} ({} of {} bytes)'.format(
+            self.url, self.downloaded, self.size))
+      if sha256:
+        actual = _hash_file(self.partfile)
+        if actual != sha256:
+          self._remove()
+          raise ChecksumError(self.url, sha256, actual)
+      os.replace(self.partfile, self.filename)
+      path.remove(self.infofile, silent=True)
+      success = True
+    finally:
+      if not success and self.segments is not None:
+        if self.resumable and path.isfile(self.partfile):
+          self._save_segments()
+        else:
+          # Delete the file if it could not be downloaded successfully.
+          self._remove()
+
     progress_info['completed'] = True
+    progress_info['downloaded'] = self.downloaded
     if progress and progress(progress_info) is False:
       raise UserInterrupt
+    return self.downloaded
 
-  if filename:
-    try:
-      with open(filename, 'wb') as fp:
-        copy_to_file(fp)
-    except BaseException:
-      # Delete the file if it could not be downloaded successfully.
-      path.remove(filename, silent=True)
+
+def probe_url(url, timeout=10, urlopen_kwargs=None):
+  """
+  Check if *url* is available with a ``HEAD`` request. If the server does
+  not support ``HEAD``, the first byte is requested with ``GET`` instead.
+
+  :raise HTTPError: Can be raised by :func:`urllib.request.urlopen`.
+  :raise URLError: Can be raised by :func:`urllib.request.urlopen`.
+  """
+
+  kwargs = dict(urlopen_kwargs or {})
+  kwargs['timeout'] = timeout
+  try:
+    request = urllib.request.Request(url, method='HEAD')
+    urllib.request.urlopen(request, **kwargs).close()
+  except HTTPError as exc:
+    if exc.code not in (405, 501):
       raise
-  elif file:
-    copy_to_file(file)
+    request = urllib.request.Request(url, headers={'Range': 'bytes=0-0'})
+    response = urllib.request.urlopen(request, **kwargs)
+    try:
+      response.read(1)
+    finally:
+      response.close()
 
-  if directory:
-    return filename, False
-  return progress_info['downloaded']
+
+def race_urls(urls, timeout=10, stagger=0.1, urlopen_kwargs=None):
+  """
+  Probe the *urls* concurrently with :func:`probe_url` and yield a tuple
+  of ``(url, latency, error)`` for every URL in the order in which the
+  probes complete. *latency* is the number of seconds the probe took and
+  *error* is :const:`None` if the URL is available, otherwise the exception.
+
+  The probes are started in the order of *urls*, each *stagger* seconds
+  after the previous one, and only while no URL responded successfully.
+  Thus if the first URL is fast, the others are not contacted unless the
+  consumer asks for more URLs. The probes run in daemon threads and are
+  not waited for if the generator is closed.
+  """
+
+  results = queue.Queue()
+  pending = list(urls)
+  running = [0]
+
+  def probe(url):
+    tstart = time.perf_counter()
+    try:
+      probe_url(url, timeout, urlopen_kwargs)
+    except (URLError, HTTPError, http.client.HTTPException, OSError, ValueError) as exc:
+      results.put((url, time.perf_counter() - tstart, exc))
+    else:
+      results.put((url, time.perf_counter() - tstart, None))
+
+  def start_next():
+    thread = threading.Thread(target=probe, args=(pending.pop(0),))
+    thread.daemon = True
+    thread.start()
+    running[0] += 1
+
+  while pending or running[0]:
+    if not running[0]:
+      start_next()
+    try:
+      result = results.get(timeout=stagger if pending else None)
+    except queue.Empty:
+      start_next()
+      continue
+    running[0] -= 1
+    yield result
 
 
 def parse_content_disposition(value):
@@ -145,3 +511,88 @@ def parse_content_disposition(value):
   if 'filename' not in param:
     raise ValueError('no filename parmaeter')
   return param['filename']
+
+
+class ConnectionPool(object):
+  """
+  Keeps persistent HTTP(S) connections to be reused for multiple requests.
+  Every thread has its own connection per host, thus the pool can be used
+  from multiple threads at the same time. Note that the body of a response
+  must be read completely before the next request is sent from the same
+  thread to the same host.
+
+  .. code:: python
+
+    pool = ConnectionPool()
+    response = pool.request('GET', 'http://localhost:8080/ac/' + key)
+    data = response.read()
+
+  :param timeout: The timeout for connections in seconds.
+  """
+
+  def __init__(self, timeout=30):
+    self.timeout = timeout
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._connections = []
+
+  def get_connection(self, scheme, netloc, fresh=False):
+    """
+    Returns the connection of the current thread to *netloc*. If *fresh*
+    is True, a new connection is created.
+    """
+
+    connections = self._local.__dict__.setdefault('connections', {})
+    conn = connections.get((scheme, netloc))
+    if conn is not None and fresh:
+      conn.close()
+      conn = None
+    if conn is None:
+      if scheme == 'https':
+        conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+      elif scheme == 'http':
+        conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+      else:
+        raise ValueError('unsupported URL scheme: {!r}'.format(scheme))
+      connections[(scheme, netloc)] = conn
+      with self._lock:
+        self._connections.append(conn)
+    return conn
+
+  def request(self, method, url, body=None, headers=None):
+    """
+    Send a request and return the :class:`http.client.HTTPResponse`. If a
+    reused connection was closed by the server in the meantime, the request
+    is sent again on a new connection.
+
+    :param body: :const:`None`, a bytes object or a seekable file object.
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    selector = parts.path or '/'
+    if parts.query:
+      selector += '?' + parts.query
+    headers = dict(headers or {})
+    offset = body.tell() if hasattr(body, 'seek') else None
+
+    for attempt in range(2):
+      conn = self.get_connection(parts.scheme, parts.netloc, fresh=attempt > 0)
+      try:
+        conn.request(method, selector, body, headers)
+        return conn.getresponse()
+      except (http.client.HTTPException, OSError):
+        conn.close()
+        if attempt > 0 or (body is not None and offset is None and not isinstance(body, bytes)):
+          raise
+        if offset is not None:
+          body.seek(offset)
+
+  def close(self):
+    """
+    Close all connections of all threads.
+    """
+
+    with self._lock:
+      connections, self._connections = self._connections, []
+    for conn in connections:
+      conn.close()
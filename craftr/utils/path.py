@@ -21,14 +21,19 @@ from os.path import join, split, dirname, basename, expanduser
 
 import ctypes
 import errno
+import functools
 import glob2
 import os
 import shutil
+import sys
 import tempfile as _tempfile
 
 curdir_sep = curdir + sep
 pardir_sep = pardir + sep
 
+#: The maximum number of entries in the cache of :func:`norm`.
+NORM_CACHE_SIZE = 1 << 16
+
 def rel(path, parent=None, nopar=False):
   """
   Like :func:`os.path.relpath`, but the *nopar* parameter can be set to return
@@ -47,16 +52,59 @@ def rel(path, parent=None, nopar=False):
       return abs(path)
     return res
 
+def rel_list(paths, parent=None, nopar=False):
+  """
+  Like calling :func:`rel` for every item in *paths* with the same *parent*,
+  but the *parent* is only normalized once and paths that are inside of the
+  *parent* directory are computed with a simple prefix comparison instead
+  of splitting both paths every time.
+
+  :return: A list of the relative paths.
+  """
+
+  return list(map(_RelativeTo(parent, nopar), paths))
+
 def norm(path, parent=None):
   """
   Normalizes the specified *path*. This turns it into an absolute path and
   removes all superfluous path elements. Similar to :func:`os.path.normpath`,
   but accepts a *parent* argument which is considered when *path* is relative.
+
+  Results are kept in a bounded LRU cache and interned, thus normalizing
+  the same path repeatedly is cheap and yields the same string object.
+  """
+
+  if not parent and not isabs(path):
+    parent = getcwd()
+  return _norm(path, parent or None)
+
+@functools.lru_cache(maxsize=NORM_CACHE_SIZE)
+def _norm(path, parent):
+  if parent is not None and not isabs(path):
+    path = join(parent, path)
+  return sys.intern(canonical(path))
+
+class _RelativeTo(object):
+  """
+  Callable that implements :func:`rel` for a fixed *parent* directory. The
+  parent is normalized once and used as a prefix to compute the relative
+  path of sub-paths. Everything else falls back to :func:`rel`.
   """
 
-  if not isabs(path):
-    path = join(parent or getcwd(), path)
-  return canonical(path)
+  def __init__(self, parent, nopar):
+    self.parent = norm(parent or getcwd())
+    self.nopar = nopar
+    prefix = self.parent
+    if not prefix.endswith(sep):
+      prefix += sep
+    self.prefix = os.path.normcase(prefix)
+    self.prefix_len = len(prefix)
+
+  def __call__(self, path):
+    path = norm(path)
+    if os.path.normcase(path).startswith(self.prefix):
+      return path[self.prefix_len:]
+    return rel(path, self.parent, self.nopar)
 
 def canonical(path):
   """
@@ -256,10 +304,22 @@ def transition(filename, oldbase, newbase):
     build/obj/main.c
   """
 
-  rel_file = rel(filename, oldbase, nopar=True)
-  if isabs(rel_file):
-    raise ValueError("filename must be a sub-path of oldbase", filename, oldbase)
-  return join(newbase, rel_file)
+  return transition_list([filename], oldbase, newbase)[0]
+
+def transition_list(filenames, oldbase, newbase):
+  """
+  Like :func:`transition`, but for a list of *filenames*. The *oldbase* is
+  only normalized once.
+  """
+
+  relative_to = _RelativeTo(oldbase, nopar=True)
+  result = []
+  for filename in filenames:
+    rel_file = relative_to(filename)
+    if isabs(rel_file):
+      raise ValueError("filename must be a sub-path of oldbase", filename, oldbase)
+    result.append(join(newbase, rel_file))
+  return result
 
 def common(paths):
   """
@@ -293,7 +353,7 @@ def common(paths):
   if len(parts) == 1:
     path = dirname(sep.join(parts[0]))
     if not has_abs:
-      path = rel(path)
+      path = _RelativeTo(None, False)(path)
     return path
 
   common = parts[0]
@@ -314,9 +374,22 @@ def common(paths):
 
   common = sep.join(common)
   if not has_abs:
-    common = rel(common)
+    common = _RelativeTo(None, False)(common)
   return common
 
+def user_cache_dir(*parts):
+  """
+  Returns the directory for machine-wide Craftr caches of the current user,
+  joined with *parts*. This is ``$XDG_CACHE_HOME/craftr`` (defaulting to
+  ``~/.cache/craftr``) and ``%LOCALAPPDATA%\\craftr\\cache`` on Windows.
+  """
+
+  if os.name == 'nt' and os.getenv('LOCALAPPDATA'):
+    base = join(os.getenv('LOCALAPPDATA'), 'craftr', 'cache')
+  else:
+    base = join(os.getenv('XDG_CACHE_HOME') or expanduser('~/.cache'), 'craftr')
+  return join(base, *parts)
+
 def easy_listdir(directory):
   """
   A friendly version of :func:`os.listdir` that does not error if the
@@ -14,6 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from craftr.core.logging import logger
+from craftr.utils import shell
+
 import contextlib
 import sys
 
@@ -69,6 +72,12 @@ def import_(fqn):
 
 
 def unique_append(lst, item, id_compare=False):
+  """
+  Appends *item* to *lst* if it is not already contained in the list. Note
+  that this requires a linear scan of *lst*, use :func:`unique_extend` when
+  appending multiple items.
+  """
+
   if id_compare:
     for x in lst:
       if x is item:
@@ -79,16 +88,55 @@ def unique_append(lst, item, id_compare=False):
   lst.append(item)
 
 
-def unique_extend(lst, iterable, id_compare=False):
+def unique_iter(iterable, id_compare=False, exclude=()):
+  """
+  Yields every item of *iterable* that has not been yielded before and that
+  is not in *exclude*, preserving the order of the items. Items are tracked
+  in a hash set, unhashable items fall back to a linear search among the
+  other unhashable items.
+
+  :param id_compare: Compare items by identity instead of equality.
+  :param exclude: An iterable of items that are considered already seen.
+  """
+
+  seen = set()
+  unhashable = []
+
+  def add(item):
+    key = id(item) if id_compare else item
+    try:
+      if key in seen:
+        return False
+      seen.add(key)
+    except TypeError:
+      if item in unhashable:
+        return False
+      unhashable.append(item)
+    return True
+
+  for item in exclude:
+    add(item)
   for item in iterable:
-    unique_append(lst, item, id_compare)
+    if add(item):
+      yield item
+
+
+def unique_extend(lst, iterable, id_compare=False):
+  """
+  Appends all items from *iterable* to *lst* that are not already contained
+  in it. Runs in linear time for hashable items (or with *id_compare*).
+  """
+
+  lst.extend(list(unique_iter(iterable, id_compare, exclude=lst)))
 
 
 def unique_list(iterable, id_compare=False):
-  result = []
-  for item in iterable:
-    unique_append(result, item)
-  return result
+  """
+  Returns a list of the items in *iterable* without duplicates, in the order
+  of their first occurence.
+  """
+
+  return list(unique_iter(iterable, id_compare))
 
 
 def strip_flags(command, flags):
@@ -104,16 +152,17 @@ def strip_flags(command, flags):
   # Remove the specified flags and keep every flag that could not
   # be removed from the command.
   flags = set(flags)
-  for flag in list(flags):
-    count = 0
-    while True:
-      try:
-        command.remove(flag)
-      except ValueError:
-        break
-      count += 1
-    if count != 0:
-      flags.remove(flag)
+  if not flags:
+    return command
+  removed = set()
+  result = []
+  for arg in command:
+    if arg in flags:
+      removed.add(arg)
+    else:
+      result.append(arg)
+  command[:] = result
+  flags -= removed
   if flags:
     fmt = ' '.join(shell.quote(x) for x in flags)
     logger.warn("flags not removed: " + fmt)
@@ -249,7 +249,8 @@ class CompletedProcess(object):
 
 
 def run(cmd, *, stdin=None, input=None, stdout=None, stderr=None, shell=False,
-    timeout=None, check=False, cwd=None, encoding=sys.getdefaultencoding()):
+    timeout=None, check=False, cwd=None, encoding=sys.getdefaultencoding(),
+    env=None, pass_fds=()):
   """
   Run the process with the specified *cmd*. If *cmd* is a list of
   commands and *shell* is True, the list will be automatically converted
@@ -286,7 +287,8 @@ def run(cmd, *, stdin=None, input=None, stdout=None, stderr=None, shell=False,
 
   try:
     popen = subprocess.Popen(
-      cmd, stdin=stdin, stdout=stdout, stderr=stderr, shell=shell, cwd=cwd)
+      cmd, stdin=stdin, stdout=stdout, stderr=stderr, shell=shell, cwd=cwd,
+      env=env, pass_fds=pass_fds)
     stdout, stderr = popen.communicate(input, timeout)
   except subprocess.TimeoutExpired as exc:
     # TimeoutExpired.stderr available only since Python3.5
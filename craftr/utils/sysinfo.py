@@ -0,0 +1,181 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Detect the resources that are available to the current process. Inside
+a container, the number of CPUs and the memory reported by the system are
+those of the host, thus the limits of the cgroup (v1 and v2) are taken
+into account as well.
+"""
+
+import math
+import os
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+#: Cgroup v1 reports this (or a bigger) value if the memory is not limited.
+_V1_UNLIMITED = 1 << 62
+
+
+def _cgroup_paths():
+  """
+  Returns a dictionary that maps the cgroup controllers of the current
+  process to their path in the cgroup hierarchy. The controllers of the
+  unified (v2) hierarchy are stored with the key ``''``.
+  """
+
+  result = {}
+  try:
+    with open('/proc/self/cgroup') as fp:
+      for line in fp:
+        parts = line.rstrip('\n').split(':', 2)
+        if len(parts) != 3:
+          continue
+        for controller in parts[1].split(','):
+          result[controller] = parts[2]
+  except (OSError, IOError):
+    pass
+  return result
+
+
+def _read_cgroup_file(controller, name):
+  """
+  Reads the file *name* of the cgroup of the current process for the
+  specified *controller* (``''`` for cgroup v2). Inside a container, the
+  cgroup of the process is usually mounted as the root directory, thus
+  the root is checked if the file can not be found in the cgroup path.
+
+  :return: The stripped contents of the file or :const:`None`.
+  """
+
+  cgroup = _cgroup_paths().get(controller)
+  if cgroup is None:
+    return None
+  base = os.path.join(CGROUP_ROOT, controller) if controller else CGROUP_ROOT
+  for directory in (base + cgroup, base):
+    try:
+      with open(os.path.join(directory, name)) as fp:
+        return fp.read().strip()
+    except (OSError, IOError):
+      pass
+  return None
+
+
+def cgroup_cpu_quota():
+  """
+  Returns the number of CPUs that the cgroup of the current process may
+  use as a float or :const:`None` if there is no CPU quota.
+  """
+
+  data = _read_cgroup_file('', 'cpu.max')
+  if data:
+    quota, __, period = data.partition(' ')
+  else:
+    quota = _read_cgroup_file('cpu', 'cpu.cfs_quota_us')
+    period = _read_cgroup_file('cpu', 'cpu.cfs_period_us')
+  try:
+    quota, period = int(quota), int(period)
+  except (TypeError, ValueError):
+    return None
+  if quota <= 0 or period <= 0:
+    return None
+  return quota / period
+
+
+def cpu_count():
+  """
+  Returns the number of CPUs that the current process can use, respecting
+  the CPU affinity and the cgroup CPU quota. At least one is returned.
+  """
+
+  try:
+    count = len(os.sched_getaffinity(0))
+  except (AttributeError, OSError):
+    count = os.cpu_count() or 1
+  quota = cgroup_cpu_quota()
+  if quota is not None:
+    count = min(count, int(math.ceil(quota)))
+  return max(1, count)
+
+
+def default_jobs():
+  """
+  Returns the default number of jobs for a build, like Ninja does it:
+  The number of usable CPUs plus two.
+  """
+
+  return cpu_count() + 2
+
+
+def _meminfo_available():
+  try:
+    with open('/proc/meminfo') as fp:
+      for line in fp:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except (OSError, IOError, ValueError, IndexError):
+    pass
+  try:
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+  except (AttributeError, ValueError, OSError):
+    return None
+
+
+def _cgroup_memory_available():
+  limit = _read_cgroup_file('', 'memory.max')
+  if limit is not None:
+    usage = _read_cgroup_file('', 'memory.current')
+  else:
+    limit = _read_cgroup_file('memory', 'memory.limit_in_bytes')
+    usage = _read_cgroup_file('memory', 'memory.usage_in_bytes')
+  try:
+    limit, usage = int(limit), int(usage or 0)
+  except (TypeError, ValueError):
+    return None  # also for "max" in cgroup v2
+  if limit >= _V1_UNLIMITED:
+    return None
+  return max(0, limit - usage)
+
+
+def available_memory():
+  """
+  Returns the number of bytes of memory that are available to the current
+  process without swapping, or :const:`None` if it can not be determined.
+  """
+
+  values = [x for x in (_meminfo_available(), _cgroup_memory_available())
+            if x is not None]
+  return min(values) if values else None
+
+
+def pool_depth(memory_per_job, cpus=None, memory=None):
+  """
+  Computes the depth of a pool for jobs that each use up to
+  *memory_per_job* bytes of memory.
+
+  :param memory_per_job: The (estimated) peak memory usage of a job.
+  :param cpus: The number of CPUs. Defaults to :func:`cpu_count`.
+  :param memory: The available memory. Defaults to :func:`available_memory`.
+  :return: The number of jobs that can run in parallel, at least one.
+  """
+
+  if cpus is None:
+    cpus = cpu_count()
+  if memory is None:
+    memory = available_memory()
+  depth = cpus
+  if memory is not None and memory_per_job > 0:
+    depth = min(depth, memory // memory_per_job)
+  return max(1, int(depth))
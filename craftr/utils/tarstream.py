@@ -0,0 +1,221 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Extract tar archives while they are downloaded, without storing the
+archive on disk. The download and the decompression run in separate
+threads that are connected with a pipe.
+"""
+
+from craftr.core.logging import logger
+from craftr.utils import httputils
+from craftr.utils import path
+
+import hashlib
+import os
+import tarfile
+import threading
+import uuid
+import zlib
+
+#: Maps the suffixes of tar archives to the :func:`tarfile.open` mode to
+#: read them as a stream.
+STREAM_MODES = [
+  ('.tar.gz', 'r|gz'),
+  ('.tgz', 'r|gz'),
+  ('.tar.bz2', 'r|bz2'),
+  ('.tbz2', 'r|bz2'),
+  ('.tar.xz', 'r|xz'),
+  ('.txz', 'r|xz'),
+  ('.tar', 'r|'),
+]
+
+# Python 3.12+ can reject members that would be extracted outside of the
+# target directory or that have unsafe permissions.
+_extract_kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+
+class ExtractError(Exception):
+  """
+  Raised when an archive stream can not be extracted.
+  """
+
+
+def get_stream_mode(filename):
+  """
+  Returns a tuple of the suffix of *filename* and the mode to read it as
+  a stream with :mod:`tarfile`, or ``(None, None)`` if *filename* is not
+  a tar archive.
+  """
+
+  lower = filename.lower()
+  for suffix, mode in STREAM_MODES:
+    if lower.endswith(suffix):
+      return suffix, mode
+  return None, None
+
+
+def _is_safe_name(name):
+  if os.path.isabs(name) or name.startswith(('/', '\\')):
+    return False
+  return '..' not in name.replace('\\', '/').split('/')
+
+
+def _is_inside(root, filename):
+  return filename == root or filename.startswith(root + os.sep)
+
+
+def _is_safe_member(member, root):
+  # *root* is the real path of the extraction directory. Members are
+  # resolved against the files that were already extracted, so that a
+  # member can not be written through a link that leaves *root*.
+  filename = os.path.realpath(os.path.join(root, member.name))
+  if not _is_inside(root, filename):
+    return False
+  if member.issym():
+    if os.path.isabs(member.linkname):
+      return False
+    target = os.path.join(root, os.path.dirname(member.name), member.linkname)
+  elif member.islnk():
+    if not _is_safe_name(member.linkname):
+      return False
+    target = os.path.join(root, member.linkname)
+  else:
+    return True
+  return _is_inside(root, os.path.realpath(target))
+
+
+def extract_stream(fileobj, directory, mode, unpack_single_dir=False,
+    check_extract_file=None):
+  """
+  Extract the tar archive that is read from *fileobj* to *directory*. The
+  members are extracted in the order in which they are read. The directory
+  should not exist or be empty.
+
+  :param mode: The :func:`tarfile.open` stream mode (see :func:`get_stream_mode`).
+  :param unpack_single_dir: If the archive contains only a single directory,
+    its contents are moved to *directory* after the extraction.
+  :param check_extract_file: A function that is called with the name of
+    every member and returns False if it should not be extracted.
+  :raise ExtractError: If the stream is not a valid archive.
+  :return: The number of extracted members.
+
+  Members with absolute names or ``..`` components, links that point
+  outside of *directory* and members that would be written through such
+  a link are skipped.
+  """
+
+  path.makedirs(directory)
+  root = os.path.realpath(directory)
+  count = 0
+  try:
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+      for member in tar:
+        if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+          continue
+        if not _is_safe_name(member.name) or not _is_safe_member(member, root):
+          logger.warn('skipping unsafe archive member:', member.name)
+          continue
+        if check_extract_file and not check_extract_file(member.name):
+          continue
+        tar.extract(member, directory, **_extract_kwargs)
+        count += 1
+  except (tarfile.TarError, EOFError, zlib.error) as exc:
+    raise ExtractError(exc)
+
+  if unpack_single_dir:
+    # Strip the top-level directory by renaming it, which doesn't have to
+    # touch its contents.
+    names = os.listdir(directory)
+    if len(names) == 1:
+      single = path.join(directory, names[0])
+      if path.isdir(single) and not os.path.islink(single):
+        temp = directory + '.' + uuid.uuid4().hex
+        os.rename(single, temp)
+        os.rmdir(directory)
+        os.rename(temp, directory)
+  return count
+
+
+class _PipeWriter(object):
+  # Writes the downloaded data into the pipe and computes its hash.
+
+  def __init__(self, fp):
+    self.fp = fp
+    self.hasher = hashlib.sha256()
+
+  def write(self, data):
+    self.hasher.update(data)
+    self.fp.write(data)
+
+
+def download_and_extract(url, directory, mode, progress=None, sha256=None,
+    unpack_single_dir=True, check_extract_file=None, urlopen_kwargs=None):
+  """
+  Download the tar archive at *url* and extract it to *directory* while it
+  is downloaded (see :func:`extract_stream`). The *directory* is removed if
+  the download or the extraction fails. Interrupted downloads can not be
+  resumed.
+
+  :param progress: Passed to :func:`httputils.download_file`.
+  :param sha256: The expected SHA256 of the archive. The extracted files
+    are removed if the archive does not match.
+  :raise httputils.URLError:
+  :raise httputils.HTTPError:
+  :raise httputils.ChecksumError:
+  :raise httputils.UserInterrupt:
+  :raise ExtractError:
+  :return: The SHA256 of the archive.
+  """
+
+  rfd, wfd = os.pipe()
+  reader = os.fdopen(rfd, 'rb')
+  writer = _PipeWriter(os.fdopen(wfd, 'wb'))
+  errors = []
+
+  def extract():
+    try:
+      extract_stream(reader, directory, mode, unpack_single_dir, check_extract_file)
+      while reader.read(1 << 16):
+        pass  # Read the padding after the end of the archive.
+    except BaseException as exc:
+      errors.append(exc)
+    finally:
+      reader.close()
+
+  thread = threading.Thread(target=extract, name='extract ' + url)
+  thread.start()
+  success = False
+  try:
+    try:
+      httputils.download_file(url, file=writer, progress=progress,
+          sha256=sha256, urlopen_kwargs=urlopen_kwargs)
+    except BrokenPipeError:
+      pass  # The extraction failed, its error is raised below.
+    finally:
+      try:
+        writer.fp.close()
+      except BrokenPipeError:
+        pass
+      thread.join()
+    if errors:
+      if isinstance(errors[0], ExtractError):
+        raise errors[0]
+      raise ExtractError(errors[0])
+    success = True
+  finally:
+    if not success:
+      path.remove(directory, recursive=True, silent=True)
+  return writer.hasher.hexdigest()
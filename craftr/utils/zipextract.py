@@ -0,0 +1,201 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Parallel and incremental extraction of zip archives. The members are
+decompressed by multiple threads (:mod:`zlib` releases the GIL) and files
+that already exist with the same size and CRC are not written again.
+"""
+
+from craftr.core.logging import logger
+from craftr.utils import path
+from craftr.utils import sysinfo
+
+import concurrent.futures
+import fnmatch
+import os
+import re
+import shutil
+import stat
+import threading
+import zipfile
+import zlib
+
+#: The number of members that a worker extracts at once.
+BATCH_SIZE = 64
+
+
+def compile_patterns(patterns):
+  """
+  Compile a list of :mod:`fnmatch` *patterns* into a single regular
+  expression, or return :const:`None` if there are no patterns. Like
+  :func:`fnmatch.fnmatch`, the match is case-insensitive if file names are
+  case-insensitive on this platform.
+  """
+
+  if not patterns:
+    return None
+  flags = re.IGNORECASE if os.path.normcase('A') == 'a' else 0
+  return re.compile('|'.join('(?:{})'.format(fnmatch.translate(x)) for x in patterns), flags)
+
+
+def _is_safe_name(name):
+  if name.startswith(('/', '\\')) or ':' in name.split('/')[0]:
+    return False
+  return '..' not in name.replace('\\', '/').split('/')
+
+
+def _get_single_dir(names):
+  # Returns the top-level directory that contains all *names* or None.
+  prefix = None
+  for name in names:
+    top, sep, rest = name.partition('/')
+    if not sep:
+      return None
+    if prefix is None:
+      prefix = top
+    elif top != prefix:
+      return None
+  return prefix
+
+
+def _crc32_file(filename, blocksize=1 << 20):
+  crc = 0
+  with open(filename, 'rb') as fp:
+    while True:
+      data = fp.read(blocksize)
+      if not data:
+        break
+      crc = zlib.crc32(data, crc)
+  return crc & 0xffffffff
+
+
+def _is_up_to_date(info, filename):
+  try:
+    st = os.stat(filename)
+  except OSError:
+    return False
+  if not stat.S_ISREG(st.st_mode) or st.st_size != info.file_size:
+    return False
+  return _crc32_file(filename) == info.CRC
+
+
+class _Extractor(object):
+  # Extracts batches of members, every thread reads from its own ZipFile.
+
+  def __init__(self, archive):
+    self.archive = archive
+    self.local = threading.local()
+    self.files = []
+    self.lock = threading.Lock()
+
+  def _get_zipfile(self):
+    zf = getattr(self.local, 'zipfile', None)
+    if zf is None:
+      zf = self.local.zipfile = zipfile.ZipFile(self.archive)
+      with self.lock:
+        self.files.append(zf)
+    return zf
+
+  def extract(self, batch):
+    zf = self._get_zipfile()
+    extracted = 0
+    for info, filename in batch:
+      if _is_up_to_date(info, filename):
+        continue
+      if os.path.islink(filename):
+        os.remove(filename)
+      with zf.open(info) as src, open(filename, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+      mode = (info.external_attr >> 16) & 0o777
+      if mode & 0o111:
+        os.chmod(filename, os.stat(filename).st_mode | (mode & 0o111))
+      extracted += 1
+    return extracted
+
+  def close(self):
+    for zf in self.files:
+      zf.close()
+
+
+def extract(archive, directory, unpack_single_dir=False,
+    check_extract_file=None, progress_callback=None, jobs=None):
+  """
+  Extract the zip *archive* to *directory*. Files in *directory* that
+  already have the same size and CRC as the archive member are skipped.
+
+  :param unpack_single_dir: If all members are in a single top-level
+    directory, its contents are extracted to *directory* instead.
+  :param check_extract_file: A function that is called with the name of
+    every member and returns False if it should not be extracted.
+  :param progress_callback: A function that is called with the index of
+    the member, the number of members and the name of the member (the same
+    signature as for :func:`nr.misc.archive.extract`).
+  :param jobs: The number of threads. Defaults to the number of CPUs.
+  :raise zipfile.BadZipFile:
+  :return: A tuple of the number of extracted and skipped files.
+  """
+
+  with zipfile.ZipFile(archive) as zf:
+    infos = zf.infolist()
+
+  prefix = _get_single_dir(x.filename for x in infos) if unpack_single_dir else None
+  directories = set([directory])
+  files = []
+  for info in infos:
+    name = info.filename
+    if not _is_safe_name(name):
+      logger.warn('skipping unsafe archive member:', name)
+      continue
+    if check_extract_file and not check_extract_file(name):
+      continue
+    if prefix is not None:
+      name = name[len(prefix) + 1:]
+      if not name:
+        continue
+    filename = path.join(directory, *name.rstrip('/').split('/'))
+    if name.endswith('/'):
+      directories.add(filename)
+    else:
+      directories.add(path.dirname(filename))
+      files.append((info, filename))
+
+  for dirname in sorted(directories):
+    path.makedirs(dirname)
+
+  # Large members first, so that they don't end up as the last job.
+  files.sort(key=lambda x: -x[0].file_size)
+  batches = [files[i:i + BATCH_SIZE] for i in range(0, len(files), BATCH_SIZE)]
+  jobs = max(1, min(jobs or sysinfo.cpu_count(), len(batches)))
+  extractor = _Extractor(archive)
+  extracted = 0
+  done = 0
+  try:
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+      futures = {pool.submit(extractor.extract, batch): batch for batch in batches}
+      try:
+        for future in concurrent.futures.as_completed(futures):
+          extracted += future.result()
+          for info, __ in futures[future]:
+            if progress_callback:
+              progress_callback(done, len(files), info.filename)
+            done += 1
+      except BaseException:
+        for future in futures:
+          future.cancel()
+        raise
+  finally:
+    extractor.close()
+  return extracted, len(files) - extracted
@@ -34,10 +34,10 @@ setup(
   install_requires = [str(x.req) for x in parse_requirements('requirements.txt')],
   entry_points = dict(
     console_scripts = [
-      'craftr = craftr.__main__:main_and_exit'
+      'craftr = craftr.client:main_and_exit'
     ]
   ),
-  packages = find_packages(),
+  packages = find_packages(exclude=['benchmarks', 'tests', 'tests.*']),
   package_data = {
     'craftr': ['stl/**/*']
   }
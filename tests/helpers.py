@@ -0,0 +1,163 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`tests.helpers`
+====================
+
+Utilities that are shared by the tests: a test case that runs in a fresh
+temporary directory, a local HTTP server that is started in a thread and
+an executor that records the results of the actions instead of printing
+them.
+"""
+
+from craftr.core import build
+from craftr.core.executor import Executor
+from craftr.utils import path
+
+import http.server
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import unittest
+
+
+class TempDirTestCase(unittest.TestCase):
+  """
+  Creates a temporary directory for every test and makes it the current
+  working directory while the test runs.
+
+  .. attribute:: directory
+  """
+
+  def setUp(self):
+    self.directory = path.norm(tempfile.mkdtemp(prefix='craftr-test-'))
+    self._old_cwd = os.getcwd()
+    os.chdir(self.directory)
+
+  def tearDown(self):
+    os.chdir(self._old_cwd)
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def path(self, *parts):
+    return path.join(self.directory, *parts)
+
+  def write(self, filename, data):
+    filename = self.path(filename)
+    path.makedirs(path.dirname(filename))
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with open(filename, mode) as fp:
+      fp.write(data)
+    return filename
+
+  def read(self, filename):
+    with open(self.path(filename)) as fp:
+      return fp.read()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class HTTPServerThread(object):
+  """
+  Serves the *handler* class on a free port of the loopback interface in a
+  daemon thread. The server can be accessed from the handler as
+  ``self.server`` and the *state* is available as ``self.server.state``.
+
+  .. attribute:: url
+
+    The base URL of the server without a trailing slash.
+  """
+
+  def __init__(self, handler, state=None):
+    self.server = _ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    self.server.state = state
+    self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+
+
+class QuietHandler(http.server.BaseHTTPRequestHandler):
+  """
+  A request handler that does not log requests to stderr.
+  """
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def send_body(self, status, body=b'', headers=()):
+    self.send_response(status)
+    self.send_header('Content-Length', str(len(body)))
+    for key, value in headers:
+      self.send_header(key, value)
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(body)
+
+
+class RecordingExecutor(Executor):
+  """
+  An :class:`Executor` that collects the results of the executed actions
+  in :attr:`results` instead of printing them.
+  """
+
+  def __init__(self, graph, **kwargs):
+    kwargs.setdefault('jobs', 2)
+    super().__init__(graph, build.get_platform_helper(), **kwargs)
+    self.results = []
+
+  def build(self, targets=None):
+    self.results = []
+    return super().build(targets)
+
+  def report(self, result, finished, total):
+    self.results.append(result)
+
+  @property
+  def executed(self):
+    """
+    The sorted names of the targets whose actions were executed (or
+    restored from the cache) by the last :meth:`build`.
+    """
+
+    return sorted(r.action.target.name for r in self.results)
+
+
+def python_command(code, *args):
+  """
+  Returns a command that runs the Python *code* with the current
+  interpreter, for use in :attr:`build.Target.commands`.
+  """
+
+  return [sys.executable, '-c', code] + list(args)
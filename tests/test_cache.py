@@ -0,0 +1,166 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.core import build
+from craftr.core.cache import ActionCache, PLACEHOLDER, RemoteCache
+from craftr.core.executor import DepLog
+from tests.helpers import HTTPServerThread, QuietHandler, RecordingExecutor, \
+    TempDirTestCase, python_command
+
+import json
+import os
+import socket
+
+#: Writes the upper-cased contents of the first argument to the second.
+UPPER = 'import sys; open(sys.argv[2], "w").write(open(sys.argv[1]).read().upper())'
+
+
+class CacheServerHandler(QuietHandler):
+  """
+  A stand-in for a remote cache server that keeps the action entries and
+  blobs in memory (``self.server.state``).
+  """
+
+  def do_GET(self):
+    data = self.server.state['files'].get(self.path)
+    if data is None:
+      self.send_body(404)
+    else:
+      self.send_body(200, data)
+
+  do_HEAD = do_GET
+
+  def do_PUT(self):
+    size = int(self.headers['Content-Length'])
+    self.server.state['files'][self.path] = self.rfile.read(size)
+    self.send_body(201)
+
+
+class ActionCacheTest(TempDirTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.servers = []
+    self.caches = []
+
+  def tearDown(self):
+    for cache in self.caches:
+      if cache.remote is not None:
+        cache.remote.close()
+    for server in self.servers:
+      server.close()
+    super().tearDown()
+
+  def start_server(self):
+    server = HTTPServerThread(CacheServerHandler, {'files': {}})
+    self.servers.append(server)
+    return server
+
+  def create_checkout(self, name):
+    """
+    Create a project directory with two dependent targets and return the
+    graph.
+    """
+
+    self.write(name + '/a.txt', 'hello')
+    graph = build.Graph()
+    graph.add_target(build.Target('first', [python_command(UPPER, '$in', '$out')],
+        [self.path(name, 'a.txt')], [self.path(name, 'build', 'b.txt')]))
+    graph.add_target(build.Target('second', [python_command(UPPER, '$in', '$out')],
+        [self.path(name, 'build', 'b.txt')], [self.path(name, 'build', 'c.txt')]))
+    return graph
+
+  def create_cache(self, name, base_dir, remote=None):
+    cache = ActionCache(self.path(name), base_dir=base_dir,
+        remote=RemoteCache(remote) if remote else None)
+    self.caches.append(cache)
+    return cache
+
+  def build(self, graph, checkout, cache):
+    deplog = DepLog(self.path(checkout, 'build', '.deplog'))
+    executor = RecordingExecutor(graph, deplog=deplog, cache=cache)
+    self.assertTrue(executor.build())
+    return executor
+
+  def test_restore_from_local_cache(self):
+    graph = self.create_checkout('a')
+    cache = self.create_cache('cache', self.path('a'))
+    self.build(graph, 'a', cache)
+    self.assertEqual(cache.stores, 2)
+
+    os.remove(self.path('a', 'build', 'c.txt'))
+    os.remove(self.path('a', 'build', '.deplog'))
+    executor = self.build(graph, 'a', cache)
+    self.assertEqual(executor.executed, ['first', 'second'])
+    self.assertTrue(all(r.cached for r in executor.results))
+    self.assertEqual(self.read('a/build/c.txt'), 'HELLO')
+    self.assertEqual(cache.hits, 2)
+
+  def test_changed_input_misses(self):
+    graph = self.create_checkout('a')
+    cache = self.create_cache('cache', self.path('a'))
+    self.build(graph, 'a', cache)
+    self.write('a/a.txt', 'world')
+    os.remove(self.path('a', 'build', '.deplog'))
+    executor = self.build(graph, 'a', cache)
+    self.assertFalse(any(r.cached for r in executor.results))
+    self.assertEqual(self.read('a/build/c.txt'), 'WORLD')
+
+  def test_local_cache_shared_between_checkouts(self):
+    cache = self.create_cache('cache', self.path('a'))
+    self.build(self.create_checkout('a'), 'a', cache)
+    cache = self.create_cache('cache', self.path('b'))
+    executor = self.build(self.create_checkout('b'), 'b', cache)
+    self.assertTrue(all(r.cached for r in executor.results))
+    self.assertEqual(self.read('b/build/c.txt'), 'HELLO')
+
+  def test_remote_cache_shared_between_machines(self):
+    server = self.start_server()
+    cache = self.create_cache('cache1', self.path('a'), server.url)
+    self.build(self.create_checkout('a'), 'a', cache)
+    self.assertEqual(cache.remote.uploaded, 2)
+    self.assertEqual(cache.remote.errors, 0)
+
+    files = server.server.state['files']
+    entries = [json.loads(v.decode('utf8')) for k, v in files.items() if k.startswith('/ac/')]
+    self.assertEqual(len(entries), 2)
+    for candidates in entries:
+      for output in candidates[0]['outputs']:
+        self.assertTrue(output.startswith(PLACEHOLDER + '/build/'), output)
+
+    # Another machine with an empty local cache and a different checkout
+    # directory.
+    cache = self.create_cache('cache2', self.path('b'), server.url)
+    executor = self.build(self.create_checkout('b'), 'b', cache)
+    self.assertTrue(all(r.cached for r in executor.results))
+    self.assertEqual(cache.remote_hits, 2)
+    self.assertEqual(self.read('b/build/c.txt'), 'HELLO')
+
+    # The results are in the local cache now.
+    cache = self.create_cache('cache2', self.path('c'))
+    executor = self.build(self.create_checkout('c'), 'c', cache)
+    self.assertEqual(cache.hits, 2)
+
+  def test_remote_errors_do_not_fail_the_build(self):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    url = 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+    sock.close()
+    cache = self.create_cache('cache', self.path('a'), url)
+    executor = self.build(self.create_checkout('a'), 'a', cache)
+    self.assertEqual(executor.executed, ['first', 'second'])
+    self.assertGreater(cache.remote.errors, 0)
+    self.assertEqual(self.read('a/build/c.txt'), 'HELLO')
@@ -0,0 +1,47 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.core.compilecache import CompileCache, CompileCommand
+from tests.helpers import TempDirTestCase
+
+import os
+
+
+class CompileCacheTest(TempDirTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.cache = CompileCache(self.path('cache'), base_dir=self.path('src'))
+    os.makedirs(self.path('src'))
+    self.command = CompileCommand(['cc', '-c', self.path('src', 'main.c'),
+        '-o', self.path('src', 'main.o'), '-MD'])
+
+  def test_restore_depfile(self):
+    # The depfile is stored with the base directory replaced and byte by
+    # byte, independent of the locale and whether the names are UTF-8.
+    depfile = self.path('src', 'main.o').encode('utf8') + b': ' + \
+        self.path('src', 'h\xe9ader.h').encode('utf8') + b' /usr/include/\xe9.h\n'
+    self.write('src/main.o', 'object')
+    with open(self.command.depfile, 'wb') as fp:
+      fp.write(depfile)
+    self.cache.store_result('key', self.command, b'', b'')
+    os.remove(self.path('src', 'main.o'))
+    os.remove(self.command.depfile)
+
+    self.assertTrue(self.cache.restore('key', self.command))
+    self.assertEqual(self.read('src/main.o'), 'object')
+    with open(self.command.depfile, 'rb') as fp:
+      self.assertEqual(fp.read(), depfile)
@@ -0,0 +1,90 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.core import digest
+from craftr.core.digest import DigestDatabase, hash_file
+from tests.helpers import TempDirTestCase
+from unittest import mock
+
+import os
+import time
+
+
+class DigestDatabaseTest(TempDirTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.db = DigestDatabase(self.path('.digests'))
+
+  def write_old(self, filename, data, age=60):
+    """
+    Write *data* to *filename* in place and set its modification time to
+    *age* seconds ago.
+    """
+
+    filename = self.path(filename)
+    with open(filename, 'a+') as fp:
+      fp.seek(0)
+      fp.truncate()
+      fp.write(data)
+    mtime = int((time.time() - age) * 10**9)
+    os.utime(filename, ns=(mtime, mtime))
+    return filename
+
+  def count_hashes(self):
+    return mock.patch.object(digest, 'hash_file', side_effect=hash_file)
+
+  def test_cached_digest(self):
+    filename = self.write_old('a.txt', 'hello')
+    self.assertEqual(self.db.digest(filename), hash_file(filename))
+    with self.count_hashes() as hasher:
+      self.assertEqual(self.db.digest(filename), hash_file(filename))
+      self.assertEqual(hasher.call_count, 0)
+    self.assertIsNone(self.db.digest(self.path('missing.txt')))
+
+  def test_changed_file(self):
+    filename = self.write_old('a.txt', 'hello')
+    self.db.digest(filename)
+    self.write_old('a.txt', 'hello world', age=30)
+    self.assertEqual(self.db.digest(filename), hash_file(filename))
+
+  def test_racy_file(self):
+    # The file is rewritten with the same size within the granularity of
+    # the modification time, the stat information does not change.
+    filename = self.write('a.txt', 'aaaa')
+    st = os.stat(filename)
+    first = self.db.digest(filename)
+    self.write('a.txt', 'bbbb')
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+    self.assertEqual(digest.stat_key(os.stat(filename)), digest.stat_key(st))
+    self.assertNotEqual(self.db.digest(filename), first)
+    self.assertEqual(self.db.digest(filename), hash_file(filename))
+
+  def test_save_and_load(self):
+    filename = self.write_old('a.txt', 'hello')
+    value = self.db.digest(filename)
+    self.db.save()
+    db = DigestDatabase(self.path('.digests'))
+    db.load()
+    with self.count_hashes() as hasher:
+      self.assertEqual(db.digest(filename), value)
+      self.assertEqual(hasher.call_count, 0)
+
+    # Entries without the time of the digest are computed again.
+    db.entries[filename] = db.entries[filename][:2]
+    with self.count_hashes() as hasher:
+      self.assertEqual(db.digest(filename), value)
+      self.assertEqual(hasher.call_count, 1)
@@ -0,0 +1,162 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.utils import httputils
+from tests.helpers import HTTPServerThread, QuietHandler, TempDirTestCase
+
+import hashlib
+import http.client
+import os
+import re
+import urllib.error
+
+#: Nine MiB, large enough to be downloaded in two segments.
+LARGE_DATA = bytes(range(256)) * (9 * 4096)
+SMALL_DATA = b'hello world\n' * 1000
+
+
+class FileServerHandler(QuietHandler):
+  """
+  Serves ``self.server.state['data']`` at every path, with support for
+  range requests unless the ``ranges`` state is false. The ``Range``
+  header of every request is recorded in ``ranges_requested``. If
+  ``drop_after`` is set, the connection is closed once after sending
+  that many bytes of the body.
+  """
+
+  def do_GET(self):
+    state = self.server.state
+    data = state['data']
+    headers = [('ETag', state['etag'])]
+    status = 200
+    match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+    if_range = self.headers.get('If-Range')
+    state['requests'].append(self.headers.get('Range'))
+    if state['ranges']:
+      headers.append(('Accept-Ranges', 'bytes'))
+      if match and (if_range is None or if_range == state['etag']):
+        start = int(match.group(1))
+        end = int(match.group(2)) + 1 if match.group(2) else len(data)
+        headers.append(('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, len(data))))
+        data = data[start:end]
+        status = 206
+
+    drop_after = state['drop_after']
+    if drop_after is None:
+      self.send_body(status, data, headers)
+      return
+    state['drop_after'] = None
+    self.send_response(status)
+    self.send_header('Content-Length', str(len(data)))
+    for key, value in headers:
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(data[:drop_after])
+    self.wfile.flush()
+    self.close_connection = True
+
+  def handle(self):
+    try:
+      super().handle()
+    except (BrokenPipeError, ConnectionResetError):
+      # The client does not read the initial response of a resumed or
+      # segmented download to the end.
+      pass
+
+
+class DownloadTest(TempDirTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.state = {'data': SMALL_DATA, 'etag': '"v1"', 'ranges': True,
+        'drop_after': None, 'requests': []}
+    self.server = HTTPServerThread(FileServerHandler, self.state)
+    self.url = self.server.url + '/file.bin'
+    self.filename = self.path('file.bin')
+
+  def tearDown(self):
+    self.server.close()
+    super().tearDown()
+
+  def read_bytes(self, filename):
+    with open(filename, 'rb') as fp:
+      return fp.read()
+
+  def test_download(self):
+    size = httputils.download_file(self.url, filename=self.filename)
+    self.assertEqual(size, len(SMALL_DATA))
+    self.assertEqual(self.read_bytes(self.filename), SMALL_DATA)
+    self.assertEqual(self.state['requests'], [None])
+    self.assertFalse(os.path.exists(self.filename + '.part'))
+    self.assertFalse(os.path.exists(self.filename + '.part.json'))
+
+  def test_download_to_directory(self):
+    filename, existed = httputils.download_file(self.url, directory=self.path('dl'))
+    self.assertEqual(filename, self.path('dl', 'file.bin'))
+    self.assertFalse(existed)
+    sha256 = hashlib.sha256(SMALL_DATA).hexdigest()
+    filename, existed = httputils.download_file(self.url, directory=self.path('dl'),
+        on_exists='skip', sha256=sha256)
+    self.assertTrue(existed)
+
+  def test_segmented_download(self):
+    self.state['data'] = LARGE_DATA
+    httputils.download_file(self.url, filename=self.filename, connections=4)
+    self.assertEqual(self.read_bytes(self.filename), LARGE_DATA)
+    # The initial request serves the first segment, the second segment
+    # is requested with a range.
+    half = len(LARGE_DATA) // 2
+    self.assertEqual(self.state['requests'], [None, 'bytes={}-{}'.format(half, len(LARGE_DATA) - 1)])
+
+  def test_no_range_support(self):
+    self.state['data'] = LARGE_DATA
+    self.state['ranges'] = False
+    httputils.download_file(self.url, filename=self.filename, connections=4)
+    self.assertEqual(self.read_bytes(self.filename), LARGE_DATA)
+    self.assertEqual(self.state['requests'], [None])
+
+  def test_resume(self):
+    self.state['drop_after'] = 5000
+    with self.assertRaises((urllib.error.URLError, http.client.HTTPException)):
+      httputils.download_file(self.url, filename=self.filename, chunksize=1000)
+    self.assertFalse(os.path.exists(self.filename))
+    self.assertTrue(os.path.isfile(self.filename + '.part'))
+    self.assertTrue(os.path.isfile(self.filename + '.part.json'))
+
+    httputils.download_file(self.url, filename=self.filename)
+    self.assertEqual(self.read_bytes(self.filename), SMALL_DATA)
+    self.assertFalse(os.path.exists(self.filename + '.part'))
+    self.assertEqual(self.state['requests'][-1], 'bytes=5000-{}'.format(len(SMALL_DATA) - 1))
+
+  def test_resume_changed_file(self):
+    self.state['drop_after'] = 5000
+    with self.assertRaises((urllib.error.URLError, http.client.HTTPException)):
+      httputils.download_file(self.url, filename=self.filename, chunksize=1000)
+    self.state['etag'] = '"v2"'
+    self.state['data'] = SMALL_DATA.upper()
+    httputils.download_file(self.url, filename=self.filename)
+    self.assertEqual(self.read_bytes(self.filename), SMALL_DATA.upper())
+
+  def test_checksum_mismatch(self):
+    with self.assertRaises(httputils.ChecksumError):
+      httputils.download_file(self.url, filename=self.filename, sha256='0' * 64)
+    self.assertFalse(os.path.exists(self.filename))
+    self.assertFalse(os.path.exists(self.filename + '.part'))
+    self.assertFalse(os.path.exists(self.filename + '.part.json'))
+
+    sha256 = hashlib.sha256(SMALL_DATA).hexdigest().upper()
+    httputils.download_file(self.url, filename=self.filename, sha256=sha256)
+    self.assertEqual(self.read_bytes(self.filename), SMALL_DATA)
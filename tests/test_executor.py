@@ -0,0 +1,186 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.core import build
+from craftr.core.digest import DigestDatabase
+from craftr.core.executor import BuildError
+from tests.helpers import RecordingExecutor, TempDirTestCase, python_command
+
+import os
+import time
+
+#: Writes the upper-cased contents of the first argument to the second.
+UPPER = 'import sys; open(sys.argv[2], "w").write(open(sys.argv[1]).read().upper())'
+
+#: Like :data:`UPPER`, but appends an exclamation mark.
+SHOUT = 'import sys; open(sys.argv[2], "w").write(open(sys.argv[1]).read().upper() + "!")'
+
+#: Concatenates the first two arguments into the third and writes a
+#: depfile that lists the second argument to the fourth.
+CONCAT = ('import sys; a, b, out, dep = sys.argv[1:]; '
+    'open(out, "w").write(open(a).read() + open(b).read()); '
+    'open(dep, "w").write(out + ": " + a + " " + b + "\\n")')
+
+
+class ExecutorTest(TempDirTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.graph = build.Graph()
+
+  def add_target(self, name, command, inputs=(), outputs=(), **kwargs):
+    target = build.Target(name, [command], [self.path(x) for x in inputs],
+        [self.path(x) for x in outputs], **kwargs)
+    self.graph.add_target(target)
+    return target
+
+  def add_chain(self):
+    self.write('a.txt', 'hello')
+    self.add_target('first', python_command(UPPER, '$in', '$out'),
+        ['a.txt'], ['b.txt'])
+    self.add_target('second', python_command(SHOUT, '$in', '$out'),
+        ['b.txt'], ['c.txt'])
+
+  def touch(self, filename):
+    # Make sure that the modification time is newer than the outputs.
+    mtime = time.time() + 10
+    os.utime(self.path(filename), (mtime, mtime))
+
+  def test_build_and_up_to_date(self):
+    self.add_chain()
+    executor = RecordingExecutor(self.graph)
+    self.assertTrue(executor.build())
+    self.assertEqual(executor.executed, ['first', 'second'])
+    self.assertEqual(self.read('c.txt'), 'HELLO!')
+
+    self.assertTrue(executor.build())
+    self.assertEqual(executor.executed, [])
+
+    # A new executor reads the dependency log of the previous one.
+    executor = RecordingExecutor(self.graph)
+    self.assertTrue(executor.build())
+    self.assertEqual(executor.executed, [])
+
+  def test_changed_input_rebuilds_dependents(self):
+    self.add_chain()
+    executor = RecordingExecutor(self.graph)
+    self.assertTrue(executor.build())
+    self.write('a.txt', 'world')
+    self.touch('a.txt')
+    self.assertTrue(executor.build())
+    self.assertEqual(executor.executed, ['first', 'second'])
+    self.assertEqual(self.read('c.txt'), 'WORLD!')
+
+  def test_changed_command_rebuilds_target(self):
+    self.add_chain()
+    self.assertTrue(RecordingExecutor(self.graph).build())
+    self.graph = build.Graph()
+    self.add_target('first', python_command(UPPER, '$in', '$out'),
+        ['a.txt'], ['b.txt'])
+    self.add_target('second', python_command(UPPER, '$in', '$out'),
+        ['b.txt'], ['c.txt'])
+    executor = RecordingExecutor(self.graph)
+    self.assertTrue(executor.build())
+    self.assertEqual(executor.executed, ['second'])
+    self.assertEqual(self.read('c.txt'), 'HELLO')
+
+  def test_build_selected_target(self):
+    self.add_chain()
+    executor = RecordingExecutor(self.graph)
+    self.assertTrue(executor.build(['first']))
+    self.assertEqual(executor.executed, ['first'])
+    self.assertFalse(os.path.exists(self.path('c.txt')))
+    with self.assertRaises(BuildError):
+      executor.build(['missing'])
+
+  def test_failure_stops_dependents(self):
+    self.write('a.txt', 'hello')
+    self.add_target('fails', python_command('import sys; sys.exit(3)', '$in', '$out'),
+        ['a.txt'], ['b.txt'])
+    self.add_target('after', python_command(UPPER, '$in', '$out'), ['b.txt'], ['c.txt'])
+    executor = RecordingExecutor(self.graph)
+    self.assertFalse(executor.build())
+    self.assertEqual(executor.executed, ['fails'])
+    self.assertEqual(executor.results[0].returncode, 3)
+    self.assertFalse(os.path.exists(self.path('c.txt')))
+
+  def test_missing_input(self):
+    self.add_target('first', python_command(UPPER, '$in', '$out'), ['nope.txt'], ['b.txt'])
+    executor = RecordingExecutor(self.graph)
+    self.assertFalse(executor.build())
+    self.assertIn('missing and no known rule', executor.results[0].output)
+
+  def test_foreach(self):
+    for name in ('x', 'y', 'z'):
+      self.write(name + '.txt', name)
+    self.add_target('each', python_command(UPPER, '$in', '$out'),
+        ['x.txt', 'y.txt', 'z.txt'], ['x.out', 'y.out', 'z.out'], foreach=True)
+    executor = RecordingExecutor(self.graph)
+    self.assertTrue(executor.build())
+    self.assertEqual(executor.executed, ['each'] * 3)
+    self.assertEqual([self.read(x + '.out') for x in 'xyz'], ['X', 'Y', 'Z'])
+
+    self.write('y.txt', 'why')
+    self.touch('y.txt')
+    self.assertTrue(executor.build())
+    self.assertEqual(len(executor.results), 1)
+    self.assertEqual(self.read('y.out'), 'WHY')
+
+  def test_depfile_dependencies(self):
+    self.write('a.txt', 'a')
+    self.write('b.txt', 'b')
+    self.add_target('concat', python_command(CONCAT, '$in', self.path('b.txt'),
+        '$out', '$depfile'), ['a.txt'], ['c.txt'], depfile='$out.d', deps='gcc')
+    executor = RecordingExecutor(self.graph)
+    self.assertTrue(executor.build())
+    self.assertEqual(self.read('c.txt'), 'ab')
+    # The depfile is removed and the dependencies are kept in the log.
+    self.assertFalse(os.path.exists(self.path('c.txt.d')))
+    self.assertTrue(executor.build())
+    self.assertEqual(executor.executed, [])
+
+    self.write('b.txt', 'B')
+    self.touch('b.txt')
+    self.assertTrue(executor.build())
+    self.assertEqual(executor.executed, ['concat'])
+    self.assertEqual(self.read('c.txt'), 'aB')
+
+  def test_content_digests(self):
+    self.add_chain()
+    executor = RecordingExecutor(self.graph, digests=DigestDatabase(self.path('.digests')))
+    self.assertTrue(executor.build())
+    # Only the modification time changed.
+    self.touch('a.txt')
+    self.assertTrue(executor.build())
+    self.assertEqual(executor.executed, [])
+
+  def test_pool_depth(self):
+    # Every action appends its start and end to the log, the pool allows
+    # only one of them to run at a time.
+    code = ('import sys, time; log = open(sys.argv[1], "a"); log.write("+"); '
+        'log.flush(); time.sleep(0.1); log.write("-"); open(sys.argv[2], "w")')
+    for index in range(3):
+      self.add_target('t{}'.format(index), python_command(code, self.path('log'), '$out'),
+          outputs=['out{}'.format(index)], pool='single')
+    executor = RecordingExecutor(self.graph, jobs=3, pools={'single': 1})
+    self.assertTrue(executor.build())
+    self.assertEqual(self.read('log'), '+-+-+-')
+
+  def test_dependency_cycle(self):
+    self.add_target('a', python_command(UPPER, '$in', '$out'), ['y'], ['x'])
+    self.add_target('b', python_command(UPPER, '$in', '$out'), ['x'], ['y'])
+    with self.assertRaises(BuildError):
+      RecordingExecutor(self.graph).build()
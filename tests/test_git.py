@@ -0,0 +1,142 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.core.dlcache import DownloadCache
+from craftr.core.manifest import GitLoader, LoaderContext, LoaderError
+from craftr.utils import shell
+from tests.helpers import TempDirTestCase
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import types
+import unittest
+import unittest.mock
+
+#: Commits are created without the configuration of the user.
+GIT_ENVIRON = dict(os.environ, GIT_AUTHOR_NAME='Craftr', GIT_AUTHOR_EMAIL='craftr@localhost',
+    GIT_COMMITTER_NAME='Craftr', GIT_COMMITTER_EMAIL='craftr@localhost',
+    GIT_CONFIG_NOSYSTEM='1', GIT_TERMINAL_PROMPT='0')
+
+
+def get_git_version():
+  output = subprocess.check_output(['git', '--version'], universal_newlines=True)
+  return tuple(map(int, re.search(r'(\d+)\.(\d+)', output).groups()))
+
+
+@unittest.skipUnless(shell.test_program('git'), 'git is not installed')
+class GitLoaderTest(TempDirTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.repo = self.path('origin', 'lib')
+    self.url = 'file://' + self.repo
+    os.makedirs(self.repo)
+    self.git('init', '--quiet')
+    self.write('origin/lib/README', 'version 1\n')
+    self.write('origin/lib/src/a.c', 'int a;\n')
+    self.write('origin/lib/docs/index.txt', 'docs\n')
+    self.commit('v1')
+    self.write('origin/lib/README', 'version 2\n')
+    os.remove(self.path('origin/lib/src/a.c'))
+    self.write('origin/lib/src/b.c', 'int b;\n')
+    self.commit('v2')
+    self.download_cache = DownloadCache(self.path('cache'))
+
+  def git(self, *args):
+    return subprocess.check_output(['git', '-C', self.repo] + list(args),
+        env=GIT_ENVIRON, universal_newlines=True).strip()
+
+  def commit(self, tag):
+    self.git('add', '--all')
+    self.git('commit', '--quiet', '-m', tag)
+    self.git('tag', tag)
+
+  def load(self, ref, installdir='install', cache=None, sparse=()):
+    context = LoaderContext(self.path('.'), None, types.SimpleNamespace(),
+        self.path(installdir), download_cache=self.download_cache)
+    loader = GitLoader('src', self.url, ref=ref, sparse=sparse)
+    return loader, loader.load(context, cache)
+
+  def test_checkout(self):
+    loader, data = self.load('v1')
+    self.assertEqual(loader.directory, self.path('install', 'lib'))
+    self.assertEqual(loader.commit, self.git('rev-parse', 'v1^{commit}'))
+    self.assertEqual(data['commit'], loader.commit)
+    self.assertEqual(self.read('install/lib/README'), 'version 1\n')
+    self.assertTrue(os.path.isfile(self.path('install/lib/src/a.c')))
+
+    # The commits are stored in a bare repository in the download cache.
+    git_dir = self.download_cache.get_git_dir(self.url)
+    self.assertTrue(os.path.isfile(os.path.join(git_dir, 'HEAD')))
+    self.assertFalse(os.path.exists(os.path.join(git_dir, '.git')))
+
+  def test_cached_checkout(self):
+    loader, data = self.load('v1')
+    shutil.rmtree(self.repo)
+    loader, cached = self.load('v1', cache=data)
+    self.assertIs(cached, data)
+    self.assertEqual(loader.directory, data['directory'])
+    self.assertEqual(loader.commit, data['commit'])
+
+  def test_update_checkout(self):
+    __, data = self.load('v1')
+    loader, data = self.load('v2', cache=data)
+    self.assertEqual(data['ref'], 'v2')
+    self.assertEqual(loader.commit, self.git('rev-parse', 'v2^{commit}'))
+    self.assertEqual(self.read('install/lib/README'), 'version 2\n')
+    self.assertFalse(os.path.exists(self.path('install/lib/src/a.c')))
+    self.assertTrue(os.path.isfile(self.path('install/lib/src/b.c')))
+
+  def test_shared_repository(self):
+    loader, __ = self.load('v1', installdir='first')
+    # A commit that was fetched before is checked out from the shared
+    # repository without contacting the remote.
+    shutil.rmtree(self.repo)
+    other, __ = self.load(loader.commit, installdir='second')
+    self.assertEqual(other.commit, loader.commit)
+    self.assertEqual(self.read('second/lib/README'), 'version 1\n')
+
+  @unittest.skipIf(get_git_version() < (2, 25), 'git sparse-checkout requires git 2.25')
+  def test_sparse_checkout(self):
+    loader, data = self.load('v2', sparse=['src'])
+    self.assertEqual(data['sparse'], ['src'])
+    self.assertTrue(os.path.isfile(self.path('install/lib/src/b.c')))
+    self.assertTrue(os.path.isfile(self.path('install/lib/README')))
+    self.assertFalse(os.path.exists(self.path('install/lib/docs')))
+
+    # The full tree is checked out again without the sparse patterns.
+    self.load('v2', cache=data)
+    self.assertTrue(os.path.isfile(self.path('install/lib/docs/index.txt')))
+
+  def test_git_warnings(self):
+    # A git that prints a warning to stderr for every command.
+    real_git = shutil.which('git')
+    self.write('bin/git', '#!{}\nimport os, sys\nsys.stderr.write("warning: test\\n")\n'
+        'os.execv({!r}, [{!r}] + sys.argv[1:])\n'.format(sys.executable, real_git, real_git))
+    os.chmod(self.path('bin', 'git'), 0o755)
+    environ = {'PATH': self.path('bin') + os.pathsep + os.environ['PATH']}
+    with unittest.mock.patch.dict(os.environ, environ):
+      loader, data = self.load('v1')
+    self.assertEqual(loader.commit, self.git('rev-parse', 'v1^{commit}'))
+    self.assertEqual(self.read('install/lib/README'), 'version 1\n')
+
+  def test_missing_ref(self):
+    with self.assertRaises(LoaderError) as cm:
+      self.load('v3')
+    self.assertIn('v3', str(cm.exception))
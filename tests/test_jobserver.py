@@ -0,0 +1,53 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.core import jobwrapper
+from craftr.core.jobserver import Jobserver
+
+import os
+import select
+import unittest
+
+
+@unittest.skipIf(os.name == 'nt', 'the make jobserver is not supported on Windows')
+class JobserverTest(unittest.TestCase):
+
+  def setUp(self):
+    self.parent = Jobserver(2)
+    self.addCleanup(self.parent.close)
+
+  def join(self):
+    return Jobserver.from_environ(self.parent.get_environ())
+
+  def test_lend_implicit(self):
+    # The parent keeps its implicit token and puts one into the pipe, the
+    # joined process lends its implicit token to the pipe.
+    jobserver = self.join()
+    jobserver.lend_implicit()
+    tokens = [jobserver.acquire(), jobserver.acquire()]
+    for token in tokens:
+      token.release()
+    jobserver.close()
+    self.assertTrue(select.select([self.parent.read_fd], [], [], 0)[0])
+    self.assertEqual(os.read(self.parent.read_fd, 2), b'+')
+
+  def test_get_environ(self):
+    environ = {'MAKEFLAGS': ' -j2', 'MFLAGS': '-j2'}
+    self.assertEqual(jobwrapper.get_environ(None, environ=environ), environ)
+    environ = jobwrapper.get_environ(self.parent, environ=environ)
+    self.assertNotIn('MAKEFLAGS', environ)
+    self.assertNotIn('MFLAGS', environ)
+    self.assertEqual(environ[jobwrapper.MAKEFLAGS_VAR], self.parent.makeflags)
@@ -0,0 +1,91 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.core import jobtokens
+from craftr.core.jobtokens import TokenPool
+from tests.helpers import TempDirTestCase
+
+import os
+import stat
+import unittest
+
+
+def get_mode(filename):
+  return stat.S_IMODE(os.lstat(filename).st_mode)
+
+
+@unittest.skipIf(jobtokens.fcntl is None, 'job tokens require fcntl')
+class TokenPoolTest(TempDirTestCase):
+
+  def make_shared_directory(self, name='tokens', mode=0o1777):
+    directory = self.path(name)
+    os.mkdir(directory)
+    os.chmod(directory, mode)
+    return directory
+
+  def test_acquire_and_release(self):
+    pool = TokenPool(self.path('tokens'), 2)
+    self.assertEqual(get_mode(self.path('tokens')), 0o1777)
+    first, second = pool.acquire(), pool.acquire()
+    self.assertEqual({first.slot, second.slot}, {0, 1})
+    self.assertIsNone(pool.try_acquire())
+    first.release()
+    with pool.acquire() as token:
+      self.assertEqual(token.slot, first.slot)
+    second.release()
+    self.assertEqual(get_mode(self.path('tokens', 'slot-0.lock')), 0o666)
+
+  def test_private_pool(self):
+    pool = TokenPool(self.path('tokens'), 1, shared=False)
+    pool.acquire().release()
+    self.assertEqual(get_mode(self.path('tokens')), 0o700)
+    self.assertEqual(get_mode(self.path('tokens', 'slot-0.lock')), 0o600)
+
+  def test_symlink_is_not_followed(self):
+    directory = self.make_shared_directory()
+    victim = self.write('authorized_keys', 'secret')
+    os.chmod(victim, 0o600)
+    os.symlink(victim, os.path.join(directory, 'slot-0.lock'))
+    pool = TokenPool(directory, 1)
+    self.assertIsNone(pool.try_acquire())
+    self.assertEqual(get_mode(victim), 0o600)
+    self.assertEqual(self.read('authorized_keys'), 'secret')
+
+  def test_existing_slot_is_not_modified(self):
+    directory = self.make_shared_directory()
+    slot = self.write('tokens/slot-0.lock', '')
+    os.chmod(slot, 0o644)
+    TokenPool(directory, 1).acquire().release()
+    self.assertEqual(get_mode(slot), 0o644)
+
+  def test_special_file_is_skipped(self):
+    directory = self.make_shared_directory()
+    os.mkfifo(os.path.join(directory, 'slot-0.lock'))
+    self.assertIsNone(TokenPool(directory, 1).try_acquire())
+
+  def test_unsafe_directory(self):
+    with self.assertRaises(PermissionError):
+      TokenPool(self.make_shared_directory(mode=0o777), 1)
+    os.symlink(self.make_shared_directory('real'), self.path('link'))
+    with self.assertRaises(PermissionError):
+      TokenPool(self.path('link'), 1)
+
+  @unittest.skipUnless(os.getuid() == 0, 'requires root')
+  def test_directory_of_other_user(self):
+    directory = self.make_shared_directory()
+    os.chown(directory, 12345, 12345)
+    with self.assertRaises(PermissionError):
+      TokenPool(directory, 1)
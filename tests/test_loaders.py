@@ -0,0 +1,91 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.core.manifest import BaseLoader, LoaderError
+from craftr.core.session import LoaderInitializationError, Session
+from tests.helpers import TempDirTestCase
+
+import json
+import threading
+import time
+
+#: The ``(module, start, end)`` of every :class:`SleepLoader` that ran.
+loaded = []
+loaded_lock = threading.Lock()
+
+
+class SleepLoader(BaseLoader):
+  """
+  A loader that takes a moment, like a download.
+  """
+
+  def load(self, context, cache):
+    start = time.perf_counter()
+    time.sleep(0.2)
+    with loaded_lock:
+      loaded.append((context.manifest.name, start, time.perf_counter()))
+    return {}
+
+
+class FailingLoader(BaseLoader):
+
+  def load(self, context, cache):
+    raise LoaderError(self, 'not available on this platform')
+
+
+class InitLoadersTest(TempDirTestCase):
+
+  def setUp(self):
+    super().setUp()
+    del loaded[:]
+
+  def write_module(self, directory, name, dependencies=(), loader=None, script=''):
+    manifest = {'name': name, 'version': '1.0.0',
+        'dependencies': {x: '1.0.0' for x in dependencies}}
+    if loader:
+      manifest['loaders'] = [{'name': 'source', 'type': __name__ + '.' + loader}]
+    self.write(directory + '/manifest.json', json.dumps(manifest))
+    self.write(directory + '/Craftrfile', script)
+
+  def create_project(self, script):
+    for name in ('a', 'b', 'c'):
+      self.write_module('craftr/modules/' + name, name, loader='SleepLoader')
+    self.write_module('craftr/modules/broken', 'broken', loader='FailingLoader')
+    self.write_module('.', 'main', ['a', 'b', 'c', 'broken'], script=script)
+
+  def run_main(self):
+    with Session(self.directory) as session:
+      session.options = {'craftr.download_cache': 'false'}
+      module = session.find_module('main', '1.0.0')
+      module.run()
+      return session
+
+  def test_dependencies_load_concurrently(self):
+    # A fresh build directory, without a cache from a previous export.
+    self.create_project('load_module("a")\nload_module("b")\nload_module("c")\n')
+    session = self.run_main()
+    self.assertEqual(sorted(x[0] for x in loaded), ['a', 'b', 'c'])
+    self.assertLess(max(x[1] for x in loaded), min(x[2] for x in loaded))
+    self.assertEqual(sorted(session.cache['loaders']), ['a-1.0.0', 'b-1.0.0', 'c-1.0.0'])
+
+    # The module that failed is not loaded by the build script.
+    broken = session.find_module('broken', '1.0.0')
+    self.assertIsInstance(broken.loader_error, LoaderInitializationError)
+
+  def test_loader_error_is_raised_when_executed(self):
+    self.create_project('load_module("a")\nload_module("broken")\n')
+    with self.assertRaises(LoaderInitializationError):
+      self.run_main()
@@ -0,0 +1,120 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.core.manifest import LoaderContext, UrlLoader
+from craftr.utils import httputils
+from tests.helpers import HTTPServerThread, QuietHandler
+
+import socket
+import time
+import unittest
+import urllib.error
+
+
+class MirrorHandler(QuietHandler):
+  """
+  Answers probes after ``self.server.state['delay']`` seconds with the
+  ``status`` of the state. If the ``head`` state is false, ``HEAD`` requests are rejected with 405. The
+  requests are recorded in ``requests``.
+  """
+
+  def do_HEAD(self):
+    state = self.server.state
+    state['requests'].append(('HEAD', None))
+    if not state['head']:
+      self.send_body(405)
+      return
+    time.sleep(state['delay'])
+    self.send_body(state['status'], b'data')
+
+  def do_GET(self):
+    state = self.server.state
+    state['requests'].append(('GET', self.headers.get('Range')))
+    time.sleep(state['delay'])
+    self.send_body(206, b'd', [('Content-Range', 'bytes 0-0/4')])
+
+
+def get_closed_port():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+class MirrorTest(unittest.TestCase):
+
+  def setUp(self):
+    self.servers = []
+
+  def tearDown(self):
+    for server in self.servers:
+      server.close()
+
+  def start_server(self, delay=0.0, head=True, status=200):
+    state = {'delay': delay, 'head': head, 'status': status, 'requests': []}
+    server = HTTPServerThread(MirrorHandler, state)
+    self.servers.append(server)
+    return server
+
+  def test_fastest_mirror_wins(self):
+    closed = 'http://127.0.0.1:{}/file.zip'.format(get_closed_port())
+    slow = self.start_server(delay=0.5).url + '/file.zip'
+    fast = self.start_server().url + '/file.zip'
+    results = list(httputils.race_urls([closed, slow, fast], timeout=5, stagger=0.05))
+    self.assertEqual(sorted(x[0] for x in results), sorted([closed, slow, fast]))
+    successes = [url for url, latency, error in results if error is None]
+    self.assertEqual(successes, [fast, slow])
+    errors = [url for url, latency, error in results if error is not None]
+    self.assertEqual(errors, [closed])
+
+  def test_fast_first_mirror(self):
+    first = self.start_server()
+    second = self.start_server()
+    race = httputils.race_urls([first.url + '/a', second.url + '/a'], stagger=0.5)
+    url, latency, error = next(race)
+    race.close()
+    self.assertEqual(url, first.url + '/a')
+    self.assertIsNone(error)
+    self.assertLess(latency, 0.5)
+    self.assertEqual(second.server.state['requests'], [])
+
+  def test_head_not_allowed(self):
+    server = self.start_server(head=False)
+    httputils.probe_url(server.url + '/a')
+    self.assertEqual(server.server.state['requests'], [('HEAD', None), ('GET', 'bytes=0-0')])
+
+  def test_missing_file(self):
+    missing = self.start_server(status=404).url + '/a'
+    url = self.start_server().url + '/a'
+    results = list(httputils.race_urls([missing, url], stagger=0.05))
+    self.assertEqual([x[0] for x in results], [missing, url])
+    self.assertIsInstance(results[0][2], urllib.error.HTTPError)
+    self.assertEqual(results[0][2].code, 404)
+    self.assertIsNone(results[1][2])
+
+  def test_loader_prefers_known_fast_host(self):
+    first = self.start_server()
+    second = self.start_server()
+    host = second.url.split('//')[1]
+    context = LoaderContext('.', None, None, '.', host_latency={host: 0.001})
+    loader = UrlLoader('src', [first.url + '/a.zip', second.url + '/a.zip'])
+    mirrors = loader._race_mirrors(context, loader.urls)
+    self.assertEqual(next(mirrors), second.url + '/a.zip')
+    mirrors.close()
+    self.assertEqual(first.server.state['requests'], [])
+    self.assertEqual(set(context.host_latency), {host})
+    self.assertNotEqual(context.host_latency[host], 0.001)
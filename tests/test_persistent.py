@@ -0,0 +1,139 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.core import build
+from craftr.core.persistent import WorkerError, WorkerPool, serve
+from tests.helpers import RecordingExecutor, TempDirTestCase
+
+import io
+import json
+import sys
+
+#: A stand-in for a tool that supports persistent workers. The last two
+#: arguments are the input and output file. In the worker, an input file
+#: that contains "crash" makes the process exit.
+WORKER_SCRIPT = '''
+import os, sys
+from craftr.core.persistent import serve
+
+def handler(args, persistent=False):
+  src, dst = args[-2:]
+  with open(src) as fp:
+    data = fp.read()
+  if data == 'crash' and persistent:
+    os._exit(1)
+  if data == 'fail':
+    print('can not convert', src)
+    return 2
+  with open(dst, 'w') as fp:
+    fp.write(data.upper())
+  sys.stderr.write('converted {} in {}\\n'.format(src, os.getpid()))
+  return 0
+
+if sys.argv[1:] == ['--persistent']:
+  serve(lambda args: handler(args, True))
+else:
+  sys.exit(handler(sys.argv[1:]))
+'''
+
+
+class PersistentWorkerTest(TempDirTestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.script = self.write('tool.py', WORKER_SCRIPT)
+    self.command = [sys.executable, self.script, '--persistent']
+    self.pool = WorkerPool()
+
+  def tearDown(self):
+    self.pool.close()
+    super().tearDown()
+
+  def test_worker_is_reused(self):
+    outputs = []
+    for name in ('a', 'b', 'c'):
+      self.write(name + '.txt', name)
+      code, output = self.pool.run(self.command, [self.path(name + '.txt'), self.path(name + '.out')])
+      self.assertEqual(code, 0)
+      outputs.append(output)
+    self.assertEqual(self.pool.started, 1)
+    self.assertEqual(self.pool.requests, 3)
+    self.assertEqual(self.read('c.out'), 'C')
+    # The output of the handler is captured and all requests were served
+    # by the same process.
+    pids = set(x.split()[-1] for x in outputs)
+    self.assertEqual(len(pids), 1)
+
+  def test_exit_code_and_output(self):
+    self.write('a.txt', 'fail')
+    code, output = self.pool.run(self.command, [self.path('a.txt'), self.path('a.out')])
+    self.assertEqual(code, 2)
+    self.assertIn('can not convert', output)
+
+  def test_crashed_worker(self):
+    self.write('a.txt', 'crash')
+    with self.assertRaises(WorkerError):
+      self.pool.run(self.command, [self.path('a.txt'), self.path('a.out')])
+    self.write('b.txt', 'b')
+    self.assertEqual(self.pool.run(self.command, [self.path('b.txt'), self.path('b.out')])[0], 0)
+    self.assertEqual(self.pool.started, 2)
+
+  def create_graph(self, contents):
+    graph = build.Graph()
+    inputs = []
+    for index, data in enumerate(contents):
+      inputs.append(self.write('in{}.txt'.format(index), data))
+    outputs = [self.path('out{}.txt'.format(i)) for i in range(len(inputs))]
+    graph.add_target(build.Target('convert', [[sys.executable, self.script, '$in', '$out']],
+        inputs, outputs, foreach=True, worker=self.command))
+    return graph
+
+  def test_executor_uses_workers(self):
+    executor = RecordingExecutor(self.create_graph('abcd'), jobs=1, workers=self.pool)
+    self.assertTrue(executor.build())
+    self.assertEqual(self.pool.started, 1)
+    self.assertEqual(self.pool.requests, 4)
+    self.assertEqual([self.read('out{}.txt'.format(i)) for i in range(4)], list('ABCD'))
+
+  def test_executor_falls_back_to_command(self):
+    executor = RecordingExecutor(self.create_graph(['a', 'crash']), jobs=1, workers=self.pool)
+    self.assertTrue(executor.build())
+    self.assertEqual(self.read('out1.txt'), 'CRASH')
+
+  def test_serve(self):
+    def handler(args):
+      print('out', *args)
+      sys.stderr.write('err\n')
+      if args == ['exit']:
+        raise SystemExit('exiting')
+      if args == ['raise']:
+        raise KeyError('boom')
+      return len(args)
+
+    requests = [['a', 'b'], ['exit'], ['raise']]
+    stdin = io.StringIO(''.join(json.dumps({'id': i, 'arguments': x}) + '\n'
+        for i, x in enumerate(requests)))
+    stdout = io.StringIO()
+    real_streams = sys.stdout, sys.stderr
+    serve(handler, stdin, stdout)
+    self.assertEqual((sys.stdout, sys.stderr), real_streams)
+
+    responses = [json.loads(x) for x in stdout.getvalue().splitlines()]
+    self.assertEqual([x['id'] for x in responses], [0, 1, 2])
+    self.assertEqual([x['exit_code'] for x in responses], [2, 1, 1])
+    self.assertEqual(responses[0]['output'], 'out a b\nerr\n')
+    self.assertTrue(responses[1]['output'].endswith('exiting\n'))
+    self.assertIn('KeyError', responses[2]['output'])
@@ -0,0 +1,67 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.utils import pyutils
+
+import unittest
+
+
+class UniqueTest(unittest.TestCase):
+
+  def test_unique_iter(self):
+    self.assertEqual(list(pyutils.unique_iter('abcabd')), list('abcd'))
+    self.assertEqual(list(pyutils.unique_iter('abcabd', exclude='b')), list('acd'))
+    self.assertEqual(list(pyutils.unique_iter([])), [])
+
+  def test_unique_iter_unhashable(self):
+    items = [[1], 'a', [2], [1], 'a', {'x': 1}, {'x': 1}, [2]]
+    self.assertEqual(list(pyutils.unique_iter(items)), [[1], 'a', [2], {'x': 1}])
+
+  def test_unique_iter_id_compare(self):
+    a, b = [1], [1]
+    self.assertEqual(list(pyutils.unique_iter([a, b, a])), [a])
+    result = list(pyutils.unique_iter([a, b, a, b], id_compare=True))
+    self.assertEqual(len(result), 2)
+    self.assertIs(result[0], a)
+    self.assertIs(result[1], b)
+
+  def test_unique_extend(self):
+    lst = ['-lm', '-lz']
+    pyutils.unique_extend(lst, ['-lz', '-ldl', '-lm', '-lpthread', '-ldl'])
+    self.assertEqual(lst, ['-lm', '-lz', '-ldl', '-lpthread'])
+    lst = [[1]]
+    pyutils.unique_extend(lst, [[1], [2], [2]])
+    self.assertEqual(lst, [[1], [2]])
+
+  def test_unique_list(self):
+    self.assertEqual(pyutils.unique_list([3, 1, 3, 2, 1]), [3, 1, 2])
+    a, b = [1], [1]
+    self.assertEqual(len(pyutils.unique_list([a, b], id_compare=True)), 2)
+    self.assertEqual(len(pyutils.unique_list([a, b])), 1)
+
+
+class StripFlagsTest(unittest.TestCase):
+
+  def test_strip_flags(self):
+    command = ['cc', '-O2', '-g', 'a.c', '-O2', '-Wall', '-g']
+    result = pyutils.strip_flags(command, ['-O2', '-g'])
+    self.assertIs(result, command)
+    self.assertEqual(command, ['cc', 'a.c', '-Wall'])
+
+  def test_missing_flags(self):
+    command = ['cc', '-O2', 'a.c']
+    self.assertEqual(pyutils.strip_flags(command, ['-g', '-O2']), ['cc', 'a.c'])
+    self.assertEqual(pyutils.strip_flags(command, []), ['cc', 'a.c'])
@@ -0,0 +1,114 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.core import build
+from craftr.core.digest import DigestDatabase
+from craftr.core.remote import RemoteExecutor
+from tests.helpers import RecordingExecutor, TempDirTestCase, python_command
+
+import re
+import socket
+import subprocess
+import sys
+
+#: Writes the upper-cased contents of the first argument to the second.
+UPPER = 'import sys; open(sys.argv[2], "w").write(open(sys.argv[1]).read().upper())'
+
+#: Like :data:`UPPER`, but also appends the contents of ``extra.txt`` in
+#: the current directory, which is not declared as an input.
+UPPER_EXTRA = ('import sys; open(sys.argv[2], "w").write('
+    'open(sys.argv[1]).read().upper() + open("extra.txt").read())')
+
+
+class WorkerTest(TempDirTestCase):
+  """
+  Runs ``craftr worker`` on the loopback interface and dispatches actions
+  to it.
+  """
+
+  def setUp(self):
+    super().setUp()
+    self.remote = None
+    self.process = subprocess.Popen([sys.executable, '-u', '-m', 'craftr',
+        'worker', '--port', '0', '--jobs', '2', '--dir', self.path('worker')],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
+    line = self.process.stdout.readline()
+    match = re.search(r'listening on ([\d.]+):(\d+)', line)
+    if not match:
+      self.stop_worker()
+      self.fail('craftr worker did not start: ' + line)
+    self.address = (match.group(1), int(match.group(2)))
+
+  def tearDown(self):
+    if self.remote is not None:
+      self.remote.close()
+    self.stop_worker()
+    super().tearDown()
+
+  def stop_worker(self):
+    self.process.terminate()
+    self.process.wait()
+    self.process.stdout.close()
+
+  def build(self, graph, address=None):
+    self.remote = RemoteExecutor([address or self.address], roots=[self.directory],
+        digests=DigestDatabase(self.path('.digests')))
+    executor = RecordingExecutor(graph, remote=self.remote)
+    self.assertTrue(executor.build())
+    return executor
+
+  def create_graph(self, hermetic=True, code=UPPER):
+    self.write('a.txt', 'hello')
+    graph = build.Graph()
+    graph.add_target(build.Target('first', [python_command(code, '$in', '$out')],
+        [self.path('a.txt')], [self.path('build', 'b.txt')], hermetic=hermetic))
+    graph.add_target(build.Target('second', [python_command(UPPER, '$in', '$out')],
+        [self.path('build', 'b.txt')], [self.path('build', 'c.txt')],
+        hermetic=hermetic))
+    return graph
+
+  def test_hermetic_actions_run_on_worker(self):
+    executor = self.build(self.create_graph())
+    self.assertEqual(self.remote.slots, 2)
+    self.assertEqual(self.remote.executed, 2)
+    self.assertEqual(executor.executed, ['first', 'second'])
+    self.assertEqual(self.read('build/c.txt'), 'HELLO')
+
+  def test_other_actions_run_locally(self):
+    self.build(self.create_graph(hermetic=False))
+    self.assertEqual(self.remote.executed, 0)
+    self.assertEqual(self.read('build/c.txt'), 'HELLO')
+
+  def test_failed_action_runs_locally_again(self):
+    # The undeclared file is not shipped to the worker, thus the command
+    # fails there but succeeds on the local machine.
+    self.write('extra.txt', '!')
+    executor = self.build(self.create_graph(code=UPPER_EXTRA))
+    self.assertEqual(self.remote.executed, 2)
+    self.assertTrue(all(r.returncode == 0 for r in executor.results))
+    self.assertEqual(self.read('build/b.txt'), 'HELLO!')
+    self.assertEqual(self.read('build/c.txt'), 'HELLO!')
+
+  def test_unavailable_worker(self):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    self.build(self.create_graph(), address)
+    self.assertEqual(self.remote.slots, 0)
+    self.assertEqual(self.remote.executed, 0)
+    self.assertEqual(self.read('build/c.txt'), 'HELLO')
@@ -0,0 +1,80 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.targetbuilder import Framework, OptionMerge, expand_frameworks
+
+import unittest
+
+
+class OptionMergeTest(unittest.TestCase):
+
+  def test_precedence(self):
+    first = Framework('first', std='c++11', defines=['A'])
+    second = Framework('second', std='c++98', debug=True, defines=['B'])
+    merge = OptionMerge(first, second)
+    self.assertEqual(merge['std'], 'c++11')
+    self.assertEqual(merge['debug'], True)
+    self.assertEqual(merge.get('missing', 42), 42)
+    self.assertEqual(merge.get_list('defines'), ['A', 'B'])
+    with self.assertRaises(ValueError):
+      merge.get_list('debug')
+
+  def test_local_frameworks(self):
+    shared = Framework('shared', std='c++11', defines=['A'])
+    local = Framework('local', std='c++14', defines=['L'])
+    merge = OptionMerge(shared, local=[local])
+    self.assertEqual(merge['std'], 'c++14')
+    self.assertEqual(merge.get_list('defines'), ['L', 'A'])
+    local['std'] = 'c++17'
+    self.assertEqual(merge['std'], 'c++17')
+    self.assertEqual(OptionMerge(shared)['std'], 'c++11')
+
+  def test_assignment_invalidates_index(self):
+    fw = Framework('x', defines=['A'])
+    self.assertEqual(OptionMerge(fw).get_list('defines'), ['A'])
+    fw['defines'] = ['B']
+    fw['std'] = 'c++11'
+    merge = OptionMerge(fw)
+    self.assertEqual(merge.get_list('defines'), ['B'])
+    self.assertEqual(merge['std'], 'c++11')
+    del fw['std']
+    self.assertIsNone(OptionMerge(fw).get('std'))
+
+  def test_list_modified_in_place(self):
+    fw = Framework('x', defines=['A'])
+    merge = OptionMerge(fw)
+    self.assertEqual(merge.get_list('defines'), ['A'])
+    fw['defines'].append('B')
+    self.assertEqual(OptionMerge(fw).get_list('defines'), ['A', 'B'])
+    self.assertEqual(merge.get_list('defines'), ['A', 'B'])
+
+  def test_result_is_a_copy(self):
+    fw = Framework('x', defines=['A'])
+    OptionMerge(fw).get_list('defines').append('B')
+    self.assertEqual(OptionMerge(fw).get_list('defines'), ['A'])
+    self.assertEqual(fw['defines'], ['A'])
+
+  def test_nested_frameworks(self):
+    inner = Framework('inner', libs=['m'])
+    outer = Framework('outer', libs=['z'], frameworks=[inner])
+    self.assertEqual(expand_frameworks([outer]), (outer, inner))
+    self.assertEqual(OptionMerge(outer).get_list('libs'), ['z', 'm'])
+
+    # The closure is computed again when the list is modified in place.
+    extra = Framework('extra', libs=['dl'])
+    inner.setdefault('frameworks', []).append(extra)
+    self.assertEqual(expand_frameworks([outer]), (outer, inner, extra))
+    self.assertEqual(OptionMerge(outer).get_list('libs'), ['z', 'm', 'dl'])
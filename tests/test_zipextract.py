@@ -0,0 +1,69 @@
+# The Craftr build system
+# Copyright (C) 2016  Niklas Rosenstein
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from craftr.utils import zipextract
+from tests.helpers import TempDirTestCase
+
+import os
+import zipfile
+
+
+class ZipExtractTest(TempDirTestCase):
+
+  def create_archive(self, members, prefix='project-1.0/'):
+    filename = self.path('archive.zip')
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as zf:
+      for name, data in members.items():
+        info = zipfile.ZipInfo(prefix + name)
+        if name.endswith('.sh'):
+          info.external_attr = 0o755 << 16
+        zf.writestr(info, data)
+    return filename
+
+  def test_extract_single_dir(self):
+    archive = self.create_archive({'a.txt': 'a', 'src/b.c': 'b', 'run.sh': 'echo'})
+    self.assertEqual(zipextract.extract(archive, self.path('out'), unpack_single_dir=True), (3, 0))
+    self.assertEqual(self.read('out/a.txt'), 'a')
+    self.assertEqual(self.read('out/src/b.c'), 'b')
+    self.assertTrue(os.access(self.path('out/run.sh'), os.X_OK))
+
+    zipextract.extract(archive, self.path('full'))
+    self.assertEqual(self.read('full/project-1.0/a.txt'), 'a')
+
+  def test_skip_up_to_date_files(self):
+    archive = self.create_archive({'a.txt': 'a', 'b.txt': 'b', 'c.txt': 'c'})
+    zipextract.extract(archive, self.path('out'), unpack_single_dir=True, jobs=2)
+    self.write('out/b.txt', 'x')  # same size, different CRC
+    self.write('out/c.txt', 'longer')
+    self.assertEqual(zipextract.extract(archive, self.path('out'),
+        unpack_single_dir=True, jobs=2), (2, 1))
+    self.assertEqual(self.read('out/b.txt'), 'b')
+    self.assertEqual(self.read('out/c.txt'), 'c')
+
+  def test_exclude_patterns(self):
+    regex = zipextract.compile_patterns(['*/doc/*', '*.md'])
+    self.assertIsNone(zipextract.compile_patterns([]))
+    archive = self.create_archive({'README.md': '', 'doc/index.html': '', 'src/a.c': ''})
+    check = lambda name: not regex.match(name)
+    self.assertEqual(zipextract.extract(archive, self.path('out'),
+        unpack_single_dir=True, check_extract_file=check), (1, 0))
+    self.assertEqual(os.listdir(self.path('out')), ['src'])
+
+  def test_unsafe_members_are_skipped(self):
+    archive = self.create_archive({'../evil.txt': 'x', '/abs.txt': 'x', 'ok.txt': 'y'}, prefix='')
+    self.assertEqual(zipextract.extract(archive, self.path('out')), (1, 0))
+    self.assertFalse(os.path.exists(self.path('evil.txt')))
+    self.assertEqual(os.listdir(self.path('out')), ['ok.txt'])